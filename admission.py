@@ -0,0 +1,179 @@
+"""Controlo de admissão das chamadas ao Gemini, com prioridade para o Plus.
+
+A mensagem de limite promete "Priority responses" ao Luna Plus, mas todos os
+pedidos seguiam o mesmo caminho. Agora cada worker tem um número limitado de
+chamadas ao Gemini em simultâneo (`GEMINI_MAX_CONCURRENCY`); os pedidos que não
+cabem esperam numa fila por tier.
+
+- Quando uma vaga liberta, a próxima fila é escolhida por weighted fair queuing
+  (stride scheduling): com as duas filas cheias, o Plus recebe
+  `ADMISSION_PLUS_WEIGHT` vagas por cada vaga do free, e um pedido Plus passa à
+  frente dos pedidos free que já estavam à espera.
+- Um pedido free que espera mais do que `ADMISSION_FREE_MAX_WAIT` segundos (ou
+  que encontra a fila cheia) é recusado com 503 e `Retry-After`, em vez de
+  ficar a ocupar o servidor. O Plus espera até `ADMISSION_PLUS_MAX_WAIT`.
+- Os tempos de espera por tier (p50/p95/máx. das últimas amostras) aparecem no
+  `/api/v1/admin/admission`.
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from logs import get_logger, fields
+
+log = get_logger('admission')
+
+TIERS = ('plus', 'free')
+
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "24"))
+WEIGHTS = {
+    'plus': float(os.getenv("ADMISSION_PLUS_WEIGHT", "4")),
+    'free': 1.0
+}
+MAX_WAIT_SECONDS = {
+    'plus': float(os.getenv("ADMISSION_PLUS_MAX_WAIT", "30")),
+    'free': float(os.getenv("ADMISSION_FREE_MAX_WAIT", "8"))
+}
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "200"))
+WAIT_SAMPLES = 500
+MAX_RETRY_AFTER_SECONDS = 30
+
+
+class Overloaded(Exception):
+    """Pedido recusado pelo controlo de admissão (responder 503 com Retry-After)"""
+
+    def __init__(self, tier, retry_after, reason):
+        super().__init__(f"Admissão recusada ({tier}): {reason}")
+        self.tier = tier
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ('tier', 'enqueued', 'granted', 'started', 'released')
+
+    def __init__(self, tier):
+        self.tier = tier
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.started = None
+        self.released = False
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, weights=None, max_wait=None, max_queue=MAX_QUEUE):
+        self.max_concurrency = max_concurrency
+        self.weights = weights or WEIGHTS
+        self.max_wait = max_wait or MAX_WAIT_SECONDS
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queues = {tier: deque() for tier in TIERS}
+        # Tempo virtual de cada fila (stride scheduling)
+        self._passes = {tier: 0.0 for tier in TIERS}
+        self._vtime = 0.0
+        self._hold_ewma = 5.0  # Duração média de uma chamada ao Gemini (segundos)
+        self._waits = {tier: deque(maxlen=WAIT_SAMPLES) for tier in TIERS}
+        self._admitted = {tier: 0 for tier in TIERS}
+        self._shed = {tier: 0 for tier in TIERS}
+
+    @contextmanager
+    def slot(self, tier):
+        ticket = self.acquire(tier)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def acquire(self, tier):
+        """Esperar por uma vaga; levanta Overloaded se a espera passar do limite"""
+        ticket = _Ticket(tier)
+        with self._cond:
+            queue = self._queues[tier]
+            if len(queue) >= self.max_queue:
+                raise self._reject(ticket, "fila cheia")
+            if not queue:
+                # Uma fila que estava vazia não acumula crédito do tempo em que esteve parada
+                self._passes[tier] = max(self._passes[tier], self._vtime)
+            queue.append(ticket)
+            self._dispatch()
+            deadline = ticket.enqueued + self.max_wait[tier]
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    queue.remove(ticket)
+                    raise self._reject(ticket, f"espera acima de {self.max_wait[tier]:.0f}s")
+                self._cond.wait(remaining)
+            ticket.started = time.monotonic()
+            self._waits[tier].append(ticket.started - ticket.enqueued)
+            self._admitted[tier] += 1
+        return ticket
+
+    def release(self, ticket):
+        """Libertar a vaga (idempotente: chamadas repetidas com o mesmo ticket são ignoradas)"""
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._active -= 1
+            held = time.monotonic() - ticket.started
+            self._hold_ewma = 0.9 * self._hold_ewma + 0.1 * held
+            self._dispatch()
+
+    def _dispatch(self):
+        # Chamado com o lock: dar as vagas livres às filas com menor tempo virtual
+        granted = False
+        while self._active < self.max_concurrency:
+            waiting = [tier for tier in TIERS if self._queues[tier]]
+            if not waiting:
+                break
+            tier = min(waiting, key=lambda name: (self._passes[name], TIERS.index(name)))
+            self._vtime = self._passes[tier]
+            self._passes[tier] += 1.0 / self.weights[tier]
+            self._queues[tier].popleft().granted = True
+            self._active += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _reject(self, ticket, reason):
+        # Chamado com o lock
+        self._shed[ticket.tier] += 1
+        queued = sum(len(queue) for queue in self._queues.values())
+        estimate = self._hold_ewma * (queued + 1) / max(1, self.max_concurrency)
+        retry_after = int(min(MAX_RETRY_AFTER_SECONDS, max(1, round(estimate))))
+        log.warning("Admissão recusada (%s, %s): %d ativos, %d em fila", ticket.tier, reason, self._active, queued,
+                    extra=fields(tier=ticket.tier, active=self._active, queued=queued))
+        return Overloaded(ticket.tier, retry_after, reason)
+
+    def stats(self):
+        def summary(samples):
+            if not samples:
+                return {'p50Ms': 0, 'p95Ms': 0, 'maxMs': 0}
+            ordered = sorted(samples)
+            pick = lambda pct: ordered[min(len(ordered) - 1, int(pct * len(ordered)))]
+            return {
+                'p50Ms': round(pick(0.5) * 1000),
+                'p95Ms': round(pick(0.95) * 1000),
+                'maxMs': round(ordered[-1] * 1000)
+            }
+        with self._cond:
+            return {
+                'maxConcurrency': self.max_concurrency,
+                'active': self._active,
+                'avgCallSeconds': round(self._hold_ewma, 2),
+                'tiers': {
+                    tier: {
+                        'queued': len(self._queues[tier]),
+                        'admitted': self._admitted[tier],
+                        'shed': self._shed[tier],
+                        'weight': self.weights[tier],
+                        'maxWaitSeconds': self.max_wait[tier],
+                        'wait': summary(list(self._waits[tier]))
+                    }
+                    for tier in TIERS
+                }
+            }
+
+
+admission = AdmissionController()
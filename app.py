@@ -1,32 +1,59 @@
+import time
+_boot_started = time.perf_counter()  # Antes dos imports pesados (genai, stripe, firebase)
 import os
+_boot_pid = os.getpid()
+from dotenv import load_dotenv
+# Carregar variáveis do ficheiro .env antes dos outros imports (vários módulos leem o ambiente no import)
+load_dotenv()
+from logs import configure_logging, get_logger, fields, set_request_id, get_request_id, log_stats
+configure_logging()
 import sys
+import json
+import threading
 import flask
-import requests
 from flask import request, jsonify
-from utils import validate_user_id, validate_message, validate_persona, PERSONA_PROMPTS
+from utils import validate_user_id, validate_message, validate_persona
+from counters import get_counter
+from quota import reserve_slot, release_slot, get_usage, FREE_DAILY_LIMIT
+from entitlements import entitlement_cache, invalidate_entitlement
+from preflight import run_preflight
+from model_health import model_health
+from chat_writer import chat_writer
+from history import fetch_history_page, history_etag, parse_cursor, parse_limit, format_cursor, merge_pending
+from history_cache import history_cache, turn_from_queued
+from context_builder import (load_conversation, load_summary, build_history_context, summary_is_due,
+                             schedule_summary_refresh, clear_summaries, estimate_tokens)
+from prompt_cache import prompt_cache, static_prefix, uncached_config
+from opener_pool import opener_pool, classify_greeting
+from delete_jobs import delete_jobs
+from daily_report import collect_daily_metrics
+from rollups import rollups, query_range
+from job_lease import run_exclusive, list_jobs
+from notifications import notifications, telegram_config, format_report
+from stripe_events import stripe_events
+from serving import init_async_runtime, worker_class
+from admission import admission, Overloaded
+from metrics import metrics
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from google import genai
-from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials, firestore
+from rate_limits import tier_limits, rate_limit_key, TIER_LIMITS, IP_LIMITS, DEFAULT_STORAGE as DEFAULT_RATE_LIMIT_STORAGE
+from clients import get_db, get_gemini_client, configure_stripe, boot_timings
+from firebase_admin import firestore
 import stripe
 from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.background import BackgroundScheduler
 import pytz
 
-# Debug: Mostrar informações de inicialização
-print("=" * 60)
-print("🚀 Luna Backend - Initializing...")
-print(f"Python: {sys.version}")
-print(f"PORT env: {os.getenv('PORT', 'NOT SET')}")
-print("=" * 60)
-
-# Carregar variáveis do ficheiro .env
-load_dotenv()
+log = get_logger('app')
+chat_log = get_logger('chat')
+history_log = get_logger('history')
+payments_log = get_logger('payments')
+support_log = get_logger('support')
+scheduler_log = get_logger('scheduler')
 
-app = flask.Flask(__name__)
+# As rotas ficam num blueprint; a app é criada em create_app() (no fim do ficheiro)
+api = flask.Blueprint('api', __name__)
 
 # Configurar CORS restritivo
 # Permitir apenas o frontend (localhost em dev, domínio de produção em prod)
@@ -55,7 +82,7 @@ def get_frontend_url():
                  parsed = urlparse(referer)
                  return f"{parsed.scheme}://{parsed.netloc}"
     except Exception as e:
-        print(f"Warning: Could not get request origin: {e}")
+        log.warning("Could not get request origin: %s", e)
 
     # 1. Try explicit FRONTEND_URL env var (singular)
     env_url = os.getenv('FRONTEND_URL')
@@ -75,78 +102,31 @@ def get_frontend_url():
         return allowed_origins[0].rstrip('/')
     return "http://localhost:3000"
 
-CORS(app, 
-     origins=allowed_origins,
-     methods=["GET", "POST", "DELETE", "OPTIONS"],
-     allow_headers=["Content-Type", "Authorization"],
-     supports_credentials=True)
-
-# Configurar Rate Limiting
-# Em produção, usar Redis: storage_uri="redis://localhost:6379"
-rate_limit_storage = os.getenv("RATE_LIMIT_STORAGE", "memory://")
+# Configurar Rate Limiting (por utilizador, partilhado entre workers - ver rate_limits.py)
+# Uma só máquina: sqlite:///caminho (por defeito); várias instâncias: redis://host:6379
+rate_limit_storage = os.getenv("RATE_LIMIT_STORAGE", DEFAULT_RATE_LIMIT_STORAGE)
+# Por defeito a chave é o IP; os limites por utilizador passam key_func=rate_limit_key
 limiter = Limiter(
-    app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri=rate_limit_storage
+    storage_uri=rate_limit_storage,
+    headers_enabled=True,
+    in_memory_fallback_enabled=True,
+    on_breach=tier_limits.on_breach
 )
+# Os dois endpoints de chat partilham o mesmo orçamento (free ou Plus)
+chat_rate_limit = limiter.shared_limit(tier_limits.limit_for('chat'), scope='chat', key_func=rate_limit_key)
+# Tetos por IP: o userId não é autenticado, rodar ids não pode furar os limites acima
+chat_ip_limit = limiter.shared_limit(IP_LIMITS['chat'], scope='chat-ip')
+ip_limit = limiter.shared_limit(IP_LIMITS['default'], scope='ip')
 
-# 1. Configurar Google Gemini (Corrigido para evitar o erro 404)
+# Clientes do Gemini e do Firestore: criados por processo em init_worker(), não no
+# import (com --preload o master não abre canais gRPC que os workers herdariam)
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 client = None
-if not gemini_api_key:
-    print("⚠️  WARNING: GEMINI_API_KEY not set")
-else:
-    try:
-        client = genai.Client(api_key=gemini_api_key)
-        print("✅ Gemini client initialized")
-    except Exception as e:
-        print(f"❌ Error initializing Gemini client: {e}")
-
-# 2. Configurar Firebase (Usando o teu ficheiro de configuração ou variáveis de ambiente)
 db = None
-if not firebase_admin._apps:
-    firebase_initialized = False
-    
-    # Prioridade 1: Tentar usar variáveis de ambiente primeiro (mais seguro para produção)
-    firebase_creds_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
-    if firebase_creds_json:
-        try:
-            import json
-            cred_dict = json.loads(firebase_creds_json)
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("✅ Firebase initialized from environment variable")
-            firebase_initialized = True
-        except Exception as e:
-            print(f"❌ Error initializing Firebase from env variable: {e}")
-    
-    # Prioridade 2: Se variável de ambiente não funcionou, tentar arquivo
-    if not firebase_initialized:
-        firebase_config_path = os.getenv("FIREBASE_CONFIG_PATH", "luna_config.json")
-        if os.path.exists(firebase_config_path) and os.path.getsize(firebase_config_path) > 0:
-            try:
-                cred = credentials.Certificate(firebase_config_path)
-                firebase_admin.initialize_app(cred)
-                db = firestore.client()
-                print("✅ Firebase initialized from config file")
-                firebase_initialized = True
-            except Exception as e:
-                print(f"❌ Error initializing Firebase from file: {e}")
-        else:
-            if firebase_config_path == "luna_config.json":
-                print("⚠️  WARNING: luna_config.json not found")
-    
-    if not firebase_initialized:
-        print("❌ CRITICAL: Firebase could not be initialized!")
-        print("   Configure FIREBASE_CREDENTIALS_JSON environment variable or upload luna_config.json")
-else:
-    db = firestore.client()
-    print("✅ Firebase already initialized")
-
-# 3. Configurar Stripe
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+# Stripe: a chave é aplicada em init_worker()
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
 
 # Preços dos planos (em centavos - €14.99 = 1499 centavos)
@@ -173,8 +153,20 @@ PLAN_PRICES = {
 
 
 
+@api.before_app_request
+def _assign_request_id():
+    # Incluído em todas as linhas de log deste pedido (ver logs.py)
+    set_request_id(request.headers.get('X-Request-ID'))
+
+
+@api.after_app_request
+def _add_request_id_header(response):
+    response.headers['X-Request-ID'] = get_request_id()
+    return response
+
+
 # Headers de segurança
-@app.after_request
+@api.after_app_request
 def set_security_headers(response):
     """Adicionar headers de segurança"""
     response.headers['X-Content-Type-Options'] = 'nosniff'
@@ -183,23 +175,102 @@ def set_security_headers(response):
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
     return response
 
-@app.route('/api/v1/chat', methods=['POST'])
-@limiter.limit("10 per minute")  # Rate limit: 10 requests por minuto por IP
-def chat():
+@api.app_errorhandler(429)
+def rate_limit_exceeded(e):
+    """Resposta JSON para o rate limit (o flask-limiter acrescenta Retry-After e X-RateLimit-*)"""
+    retry_after = None
+    current = limiter.current_limit
+    if current:
+        retry_after = max(1, int(current.window[0] - datetime.now(timezone.utc).timestamp()))
+    return jsonify({
+        "error": "Too many requests. Please slow down.",
+        "limit": str(e.description),
+        "retryAfter": retry_after
+    }), 429
+
+# Modelos Gemini por ordem de preferência
+MODELS_TO_TRY = ['gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-2.0-flash']
+
+LIMIT_REACHED_MESSAGE = "You've used all 20 free messages today! 💔\n\nUpgrade to Luna Plus for:\n✨ Unlimited messages\n💜 Access to ALL Luna personalities\n🔥 Priority responses\n\nStart your unlimited experience now!"
+
+
+def _is_quota_error(error_str):
+    return '429' in error_str or 'RESOURCE_EXHAUSTED' in error_str or 'quota' in error_str.lower()
+
+
+def _chat_error_response(e):
+    """Converter um erro do chat numa resposta amigável para o cliente"""
+    error_str = str(e)
+    
+    # Better error message for quota issues
+    if _is_quota_error(error_str):
+        return jsonify({
+            "error": "Quota da API excedida. Por favor, verifica o teu plano do Google Gemini API ou espera alguns minutos antes de tentar novamente.",
+            "details": "Todos os modelos disponíveis excederam a quota gratuita."
+        }), 429
+    
+    # Erro genérico - retornar mensagem mais amigável
+    error_message = "An error occurred while processing your message. Please try again."
+    if "timeout" in error_str.lower() or "timed out" in error_str.lower():
+        error_message = "Request timed out. Please try again."
+    elif "connection" in error_str.lower():
+        error_message = "Connection error. Please check your internet connection."
+    
+    return jsonify({
+        "error": error_message,
+        "details": str(e) if flask.current_app.debug else None
+    }), 500
+
+
+def _overloaded_response(e):
+    """503 com Retry-After quando o controlo de admissão recusa o pedido"""
+    response = jsonify({
+        "error": "Luna is very busy right now. Please try again in a few seconds.",
+        "retryAfter": e.retry_after
+    })
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+
+def _build_dynamic_prompt(user_message, message_count, history_context=""):
+    """Parte dinâmica do prompt. A parte estática (persona + CRITICAL RULES) vai
+    como system instruction / cached content, ver prompt_cache.py"""
+    # Adicionar contexto de conversa nova se for o caso
+    if message_count == 0:
+        conversation_context = "This is the FIRST message in your conversation. You're meeting them for the first time. Be friendly, curious, and show genuine interest in getting to know them. Keep it natural and authentic - like you're really meeting someone new and you're excited to chat with them."
+    else:
+        conversation_context = f"You've been chatting for a while now ({message_count} messages exchanged). You know each other better, so you can be more comfortable and natural. Keep building on your connection."
+    
+    # Histórico (resumo + mensagens recentes) antes da mensagem atual
+    history_block = f"\n{history_context}\n" if history_context else ""
+    
+    return f"""{conversation_context}
+{history_block}
+User: {user_message}
+Luna:"""
+
+
+def _prepare_chat():
+    """Validações, pre-flight, quota e prompt comuns a /chat e /chat/stream.
+
+    Devolve (ctx, None) se o pedido pode seguir para o Gemini, ou (None, resposta)
+    com o erro a devolver ao cliente.
+    """
+    started = time.perf_counter()
     # Verificar se as dependências estão configuradas
     if not db:
-        return jsonify({"error": "Database not configured"}), 500
+        return None, (jsonify({"error": "Database not configured"}), 500)
     
     if not client or not gemini_api_key:
-        return jsonify({"error": "Gemini API not configured"}), 500
+        return None, (jsonify({"error": "Gemini API not configured"}), 500)
     
     # Validar Content-Type
     if not request.is_json:
-        return jsonify({"error": "Content-Type must be application/json"}), 400
+        return None, (jsonify({"error": "Content-Type must be application/json"}), 400)
     
     data = request.get_json()
     if not data:
-        return jsonify({"error": "Invalid JSON data"}), 400
+        return None, (jsonify({"error": "Invalid JSON data"}), 400)
     
     user_message = data.get('message')
     persona = data.get('persona', 'Luna')
@@ -207,211 +278,462 @@ def chat():
     
     # Validações
     if not user_id:
-        return jsonify({"error": "User ID is required"}), 400
+        return None, (jsonify({"error": "User ID is required"}), 400)
     
     if not validate_user_id(user_id):
-        return jsonify({"error": "Invalid user ID format"}), 400
+        return None, (jsonify({"error": "Invalid user ID format"}), 400)
     
     if not user_message:
-        return jsonify({"error": "Message is required"}), 400
+        return None, (jsonify({"error": "Message is required"}), 400)
     
     if not validate_message(user_message):
-        return jsonify({"error": "Invalid message. Message must be between 1 and 5000 characters."}), 400
+        return None, (jsonify({"error": "Invalid message. Message must be between 1 and 5000 characters."}), 400)
     
     if not validate_persona(persona):
-        return jsonify({"error": "Invalid persona"}), 400
-    
-    print(f"📥 Chat request: User={user_id}, Persona={persona}, Msg={user_message[:50]}...")
+        return None, (jsonify({"error": "Invalid persona"}), 400)
+    metrics.observe_stage('validation', time.perf_counter() - started)
 
-    # Verificar se é uma conversa nova (contar mensagens anteriores com esta persona)
-    # Filtrar apenas por userId e depois por persona em memória (evita necessidade de índice composto)
-    try:
-        existing_msgs = db.collection('chats')\
-            .where(filter=firestore.FieldFilter('userId', '==', user_id))\
-            .stream()
-        message_count = 0
-        for msg in existing_msgs:
-            msg_data = msg.to_dict()
-            if msg_data.get('persona') == persona:
-                message_count += 1
-        is_new_conversation = message_count == 0
-    except Exception as e:
-        print(f"⚠️ Erro ao contar mensagens da persona: {e}")
-        is_new_conversation = True
-        message_count = 0
-    
-    # Definir personalidades para cada persona - mais naturais, como uma rapariga real
+    # Fila de escrita dos chats cheia: recusar antes de gastar uma chamada ao Gemini
+    if chat_writer.saturated():
+        return None, _overloaded_response(Overloaded('writer', 5, "fila de escrita dos chats cheia"))
     
-    # Obter o prompt da persona (ou usar o padrão)
-    persona_prompt = PERSONA_PROMPTS.get(persona, PERSONA_PROMPTS['Luna'])
+    # Sem o texto da mensagem nos logs, só o tamanho
+    chat_log.info("Chat request", extra=fields(sample='chat', userId=user_id, persona=persona,
+                                               messageChars=len(user_message)))
+
+    # Pre-flight: leituras independentes ao Firestore em paralelo
+    # (contador e mensagens recentes da persona, resumo, subscrição e quota das últimas 24h)
+    preflight_tasks = {
+        'conversation': lambda: load_conversation(db, user_id, persona),
+        'summary': lambda: load_summary(db, user_id, persona),
+        'subscription': lambda: entitlement_cache.get(db, user_id),
+    }
+    # A quota só interessa a utilizadores free: se o cache já sabe que é Plus, não ler
+    cached, cached_sub = entitlement_cache.peek(user_id)
+    if not (cached and cached_sub and cached_sub.get('status') == 'active'):
+        preflight_tasks['quota_usage'] = lambda: get_usage(db, user_id)
+    preflight = run_preflight(preflight_tasks)
+    chat_log.info("Pre-flight: %s", preflight.timings_summary(),
+                  extra=fields(sample='chat', preflightMs=round(preflight.total_ms)))
+    metrics.observe_preflight(preflight.timings)
     
-    # Adicionar contexto de conversa nova se for o caso
-    conversation_context = ""
-    if is_new_conversation:
-        conversation_context = "\n\nThis is the FIRST message in your conversation. You're meeting them for the first time. Be friendly, curious, and show genuine interest in getting to know them. Keep it natural and authentic - like you're really meeting someone new and you're excited to chat with them."
+    # Verificar se é uma conversa nova (contador materializado em chat_counters)
+    if 'conversation' in preflight.errors:
+        chat_log.warning("Erro ao contar mensagens da persona: %s", preflight.errors['conversation'])
+        counter, recent_turns = {'messageCount': 0, 'version': 0}, []
     else:
-        conversation_context = f"\n\nYou've been chatting for a while now ({message_count} messages exchanged). You know each other better, so you can be more comfortable and natural. Keep building on your connection."
+        counter, recent_turns = preflight.get('conversation')
+    message_count = counter['messageCount']
     
-    # Criar o prompt completo com a personalidade
-    full_prompt = f"""{persona_prompt}{conversation_context}
-
-CRITICAL RULES:
-- ALWAYS respond in EXACTLY the same language the user writes in. If they write in Portuguese, respond in Portuguese. If they write in English, respond in English. NEVER mix languages.
-- Write like a REAL GIRL would text - natural, authentic, not robotic or AI-like
-- Vary your message length - sometimes short (1-2 sentences), sometimes longer (3-5 sentences) when you have more to say
-- Use emojis naturally but don't overdo it (1-3 emojis max per message)
-- Be genuine, authentic, and personal - like you're really texting a friend or someone you're interested in
-- Match their energy and vibe
-- Don't be overly formal or robotic - be casual and natural
-- Show personality and emotion naturally
-
-User: {user_message}
-Luna:"""
+    # Contexto multi-turno: mensagens recentes + resumo, dentro de um orçamento fixo de tokens
+    if 'summary' in preflight.errors:
+        chat_log.warning("Erro ao ler resumo da conversa: %s", preflight.errors['summary'])
+    summary = preflight.get('summary')
+    history_context, turns_in_context, context_tokens = build_history_context(recent_turns, summary)
+    chat_log.info("Context: %d turns + %s (~%d tokens)", turns_in_context, 'summary' if summary else 'no summary',
+                  context_tokens, extra=fields(sample='chat'))
+    
+    ctx = {
+        'user_id': user_id,
+        'persona': persona,
+        'user_message': user_message,
+        'message_count': message_count,
+        'is_new_conversation': message_count == 0,
+        'prompt': _build_dynamic_prompt(user_message, message_count, history_context),
+        'summary_due': summary_is_due(counter, summary, turns_in_context),
+        'counter_version': counter.get('version', 0),
+        'turns_in_context': turns_in_context,
+        'is_plus': False,
+        'quota_bucket': None
+    }
     
     try:
-        # 1. Verificar se o utilizador é Plus
-        user_sub = db.collection('subscriptions').document(user_id).get()
-        is_plus = False
-        if user_sub.exists:
-            status = user_sub.to_dict().get('status')
-            if status == 'active':
-                is_plus = True
-        
-        # 2. Se não for Plus, verificar limite diário (30 mensagens nas últimas 24h)
-        if not is_plus:
-            from datetime import timezone
-            # Forma moderna: timezone-aware UTC
-            last_24h = datetime.now(timezone.utc) - timedelta(hours=24)
-            
-            # Estratégia simplificada: buscar apenas por userId (não precisa de índice composto)
-            # e filtrar por timestamp em memória
+        # 1. Verificar se o utilizador é Plus (cache partilhado com subscription-status)
+        if 'subscription' in preflight.errors:
+            user_sub = _subscription_fallback(user_id, preflight.errors['subscription'])
+        else:
+            user_sub = preflight.get('subscription')
+        ctx['is_plus'] = bool(user_sub) and user_sub.get('status') == 'active'
+        
+        # 2. Se não for Plus, reservar uma mensagem na quota diária (janela de 24h)
+        # A reserva é feita numa transação antes de chamar o Gemini, por isso
+        # pedidos simultâneos não conseguem ultrapassar o limite
+        if not ctx['is_plus']:
             try:
-                user_msgs = db.collection('chats')\
-                    .where(filter=firestore.FieldFilter('userId', '==', user_id))\
-                    .stream()
-                
-                msg_count = 0
-                for msg in user_msgs:
-                    msg_data = msg.to_dict()
-                    msg_timestamp = msg_data.get('timestamp')
-                    # Verificar se a mensagem é das últimas 24h
-                    if msg_timestamp:
-                        # Converter timestamp do Firestore para datetime
-                        if hasattr(msg_timestamp, 'timestamp'):
-                            msg_time = datetime.fromtimestamp(msg_timestamp.timestamp(), tz=timezone.utc)
-                        else:
-                            msg_time = msg_timestamp
-                        if msg_time > last_24h:
-                            msg_count += 1
+                usage = preflight.get('quota_usage')
+                if usage is not None and usage >= FREE_DAILY_LIMIT:
+                    # Limite já atingido segundo a leitura do pre-flight: rejeitar sem transação
+                    allowed, msg_count = False, usage
+                else:
+                    with metrics.stage('quota_reserve'):
+                        allowed, msg_count, ctx['quota_bucket'] = reserve_slot(db, user_id, FREE_DAILY_LIMIT)
             except Exception as e:
-                print(f"⚠️ Erro ao contar mensagens (limite não aplicado): {e}")
-                msg_count = 0 # Se houver erro, deixamos passar para não bloquear o utilizador
+                chat_log.warning("Erro ao reservar quota (limite não aplicado): %s", e)
+                allowed, msg_count = True, 0 # Se houver erro, deixamos passar para não bloquear o utilizador
             
-            print(f"📊 User {user_id} message count (last 24h): {msg_count}/20")
+            chat_log.info("Message count (last 24h): %d/%d", msg_count, FREE_DAILY_LIMIT,
+                          extra=fields(sample='chat', userId=user_id))
             
-            if msg_count >= 20:
-                print(f"🛑 Limite diário atingido para user {user_id}")
-                return jsonify({
+            if not allowed:
+                chat_log.info("Limite diário atingido", extra=fields(userId=user_id))
+                rollups.record_limit_hit(user_id)
+                metrics.record_quota_rejection()
+                return None, (jsonify({
                     "error": "Daily limit reached",
                     "limit_reached": True,
-                    "message": "You've used all 20 free messages today! 💔\n\nUpgrade to Luna Plus for:\n✨ Unlimited messages\n💜 Access to ALL Luna personalities\n🔥 Priority responses\n\nStart your unlimited experience now!"
-                }), 403
+                    "message": LIMIT_REACHED_MESSAGE
+                }), 403)
+    except Exception as e:
+        chat_log.exception("Erro no Servidor: %s", e)
+        return None, _chat_error_response(e)
+    
+    return ctx, None
 
 
-        # 3. Prosseguir com a chamada à API Gemini
-        # Generate content using the Gemini API
-        # Try different models in order of preference
-        models_to_try = ['gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-2.0-flash']
-        response = None
-        last_error = None
-        
-        used_model = None
-        for model_name in models_to_try:
-            try:
-                response = client.models.generate_content(
-                    model=model_name,
-                    contents=full_prompt  # Usar o prompt completo com a persona
-                )
-                used_model = model_name
-                print(f"\n{'='*50}")
-                print(f"✅ MODELO USADO: {model_name}")
-                print(f"{'='*50}\n")
-                break  # Success, exit the loop
-            except Exception as model_error:
-                last_error = model_error
-                error_str = str(model_error)
-                # If it's a quota error, try next model
-                if '429' in error_str or 'RESOURCE_EXHAUSTED' in error_str or 'quota' in error_str.lower():
-                    print(f"⚠️  Modelo {model_name} sem quota disponível, a tentar próximo...")
-                    continue
-                else:
-                    # If it's a different error (like 404), try next model too
-                    print(f"⚠️  Modelo {model_name} não disponível, a tentar próximo...")
-                    continue
-        
-        if response is None:
-            raise last_error if last_error else Exception("Nenhum modelo disponível")
-        
-        if used_model is None:
-            print("❌ ERRO: Nenhum modelo foi usado!")
-        
-        reply_text = response.text
+def _subscription_fallback(user_id, error):
+    """Subscrição quando a leitura do pre-flight falhou: uma leitura direta se o
+    erro não foi timeout; se também falhar (ou foi timeout), o pedido segue como free"""
+    if not isinstance(error, TimeoutError):
+        try:
+            snapshot = db.collection('subscriptions').document(user_id).get()
+            return snapshot.to_dict() if snapshot.exists else None
+        except Exception as e:
+            error = e
+    chat_log.warning("Subscrição indisponível, a tratar o pedido como free: %s", error,
+                     extra=fields(userId=user_id))
+    return None
+
+
+def _release_quota(ctx):
+    """Devolver a mensagem reservada na quota quando o utilizador não recebeu resposta"""
+    if not ctx['quota_bucket']:
+        return
+    try:
+        release_slot(db, ctx['user_id'], ctx['quota_bucket'])
+    except Exception as release_err:
+        chat_log.warning("Erro ao libertar quota: %s", release_err)
+
+
+def _log_token_usage(response):
+    # Log de uso de tokens (se disponível na resposta)
+    try:
+        if hasattr(response, 'usage_metadata'):
+            usage = response.usage_metadata
+            input_tokens = getattr(usage, 'prompt_token_count', 0)
+            output_tokens = getattr(usage, 'candidates_token_count', 0)
+            total_tokens = getattr(usage, 'total_token_count', 0)
+            cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+            chat_log.info("Tokens", extra=fields(sample='chat.tokens', inputTokens=input_tokens,
+                                                  cachedTokens=cached_tokens, outputTokens=output_tokens,
+                                                  totalTokens=total_tokens))
+    except:
+        pass
+
+
+def _save_turn(ctx, reply_text):
+    # Guardar no Firestore associado ao utilizador e persona (write-behind:
+    # o turno é gravado em background, a resposta não espera pelo Firestore)
+    try:
+        with metrics.stage('save_enqueue'):
+            turn = chat_writer.enqueue(db, ctx['user_id'], ctx['persona'], ctx['user_message'], reply_text)
+        rollups.record_chat_turn(ctx['persona'], ctx['is_plus'])
+        # Write-through: o histórico pedido a seguir já inclui este turno (no primeiro
+        # turno da conversa a entrada é criada, não há mais nada a ler do Firestore)
+        if ctx['is_new_conversation']:
+            earlier = [turn_from_queued(queued) for queued in chat_writer.pending_turns(ctx['user_id'], ctx['persona'])
+                       if queued['id'] != turn['id']]
+            history_cache.append(ctx['user_id'], ctx['persona'], turn_from_queued(turn),
+                                 base_version=ctx['counter_version'], earlier=earlier)
+        else:
+            history_cache.append(ctx['user_id'], ctx['persona'], turn_from_queued(turn))
+        chat_log.info("Chat queued for Firestore", extra=fields(sample='chat', chatId=turn['id'],
+                                                                userId=ctx['user_id'], persona=ctx['persona']))
         
-        # Log de uso de tokens (se disponível na resposta)
+        # Mensagens antigas suficientes fora da janela recente: atualizar o resumo em background
+        if ctx['summary_due']:
+            schedule_summary_refresh(db, _generate_summary, ctx['user_id'], ctx['persona'],
+                                     ctx['turns_in_context'])
+    except Exception as db_err:
+        chat_log.error("Error saving to Firestore: %s", db_err)
+        # We don't raise here to ensure the user still gets the reply
+
+
+def _generate_summary(prompt):
+    """Texto do resumo da conversa (em background, numa vaga 'free' da admissão)"""
+    # Sem vaga (Overloaded) o resumo fica para a próxima mensagem
+    with admission.slot('free'):
+        return _generate_reply(prompt)[0].text
+
+
+def _generate_opener(prompt, persona):
+    """Cumprimento para o pool (refill em background, numa vaga 'free' da admissão)"""
+    # Sem vaga (Overloaded) o refill desiste; o pool volta a tentar no próximo cumprimento
+    with admission.slot('free'):
+        return _generate_reply(prompt, persona)[0].text
+
+
+def _pooled_opener(ctx):
+    """Resposta pré-gerada quando a primeira mensagem é só um cumprimento (ou None)"""
+    if not ctx['is_new_conversation']:
+        return None
+    language = classify_greeting(ctx['user_message'])
+    if not language:
+        return None
+    reply = opener_pool.take(ctx['persona'], language, _generate_opener)
+    if reply:
+        chat_log.info("Cumprimento servido do pool", extra=fields(sample='chat', persona=ctx['persona'],
+                                                                  language=language))
+    return reply
+
+
+def _log_model_failure(model_name, model_error):
+    """Registar a falha de um modelo -> 'quota' ou 'error' (resultado da tentativa nas métricas)"""
+    # If it's a quota error, try next model
+    if _is_quota_error(str(model_error)):
+        chat_log.warning("Modelo %s sem quota disponível, a tentar próximo...", model_name)
+        return 'quota'
+    # If it's a different error (like 404), try next model too
+    chat_log.warning("Modelo %s não disponível, a tentar próximo...", model_name, extra=fields(error=str(model_error)))
+    return 'error'
+
+
+def _log_prompt_size(ctx):
+    # Tamanho estimado antes da chamada: a parte estática vem do cache do Gemini
+    static_tokens = estimate_tokens(static_prefix(ctx['persona']))
+    dynamic_tokens = estimate_tokens(ctx['prompt'])
+    chat_log.info("Prompt size", extra=fields(sample='chat', staticTokens=static_tokens, dynamicTokens=dynamic_tokens))
+
+
+def _call_with_prompt_cache(call, model_name, persona):
+    """Chamar o modelo com o cached content da persona; se o cache tiver sido
+    recusado (expirado/apagado), repetir com a system instruction normal"""
+    if not persona:
+        return call(None)
+    config = prompt_cache.generation_config(client, model_name, persona)
+    if not config.cached_content:
+        return call(config)
+    try:
+        return call(config)
+    except Exception as cache_error:
+        chat_log.warning("Prompt cache recusado (%s/%s), a repetir sem cache: %s", model_name, persona, cache_error)
+        prompt_cache.invalidate(persona, model_name)
+        return call(uncached_config(persona))
+
+
+def _generate_reply(contents, persona=None):
+    """Gerar a resposta completa, tentando os modelos por ordem de preferência.
+
+    Com `persona`, a parte estática do prompt vai como cached content.
+    """
+    last_error = None
+    # Modelos com o circuito aberto (404/429 recentes) são saltados
+    for model_name in model_health.candidates(MODELS_TO_TRY):
+        attempt_started = time.perf_counter()
         try:
-            if hasattr(response, 'usage_metadata'):
-                usage = response.usage_metadata
-                input_tokens = getattr(usage, 'prompt_token_count', 0)
-                output_tokens = getattr(usage, 'candidates_token_count', 0)
-                total_tokens = getattr(usage, 'total_token_count', 0)
-                print(f"📊 Tokens: Input={input_tokens}, Output={output_tokens}, Total={total_tokens}")
-        except:
-            pass
-
-        # Guardar no Firestore associado ao utilizador e persona
-        print(f"💾 Saving to Firestore: User={user_id}, Persona={persona}")
+            response = _call_with_prompt_cache(
+                lambda config: client.models.generate_content(model=model_name, contents=contents, config=config),
+                model_name, persona
+            )
+            model_health.record_success(model_name)
+            metrics.record_model_attempt(model_name, 'generate', 'ok', time.perf_counter() - attempt_started)
+            chat_log.info("Modelo usado: %s", model_name, extra=fields(sample='chat', model=model_name))
+            return response, model_name
+        except Exception as model_error:
+            last_error = model_error
+            model_health.record_failure(model_name, model_error)
+            outcome = _log_model_failure(model_name, model_error)
+            metrics.record_model_attempt(model_name, 'generate', outcome, time.perf_counter() - attempt_started)
+    
+    raise last_error if last_error else Exception("Nenhum modelo disponível")
+
+
+def _open_reply_stream(contents, persona):
+    """Abrir um stream de resposta, tentando os modelos por ordem de preferência.
+
+    Os erros de quota/modelo inexistente só aparecem no primeiro chunk, por isso
+    o primeiro chunk é lido aqui antes de se escolher o modelo.
+    Devolve (stream, primeiro_chunk, modelo).
+    """
+    last_error = None
+    for model_name in model_health.candidates(MODELS_TO_TRY):
+        stream = None
+        attempt_started = time.perf_counter()
         try:
-            doc_ref = db.collection('chats').document()
-            doc_ref.set({
-                'userId': user_id,
-                'persona': persona,
-                'message': user_message,
-                'reply': reply_text,
-                'timestamp': firestore.SERVER_TIMESTAMP
-            })
-            print(f"✅ Chat saved with ID: {doc_ref.id}")
-        except Exception as db_err:
-            print(f"❌ Error saving to Firestore: {db_err}")
-            # We don't raise here to ensure the user still gets the reply
+            def open_stream(config):
+                # O primeiro chunk é lido aqui para os erros do modelo/cache aparecerem já
+                opened = client.models.generate_content_stream(model=model_name, contents=contents, config=config)
+                try:
+                    return opened, next(opened, None)
+                except Exception:
+                    opened.close()
+                    raise
+            stream, first_chunk = _call_with_prompt_cache(open_stream, model_name, persona)
+            model_health.record_success(model_name)
+            # No stream a tentativa mede o tempo até ao primeiro chunk
+            metrics.record_model_attempt(model_name, 'stream', 'ok', time.perf_counter() - attempt_started)
+            chat_log.info("Modelo usado (stream): %s", model_name, extra=fields(sample='chat', model=model_name))
+            return stream, first_chunk, model_name
+        except Exception as model_error:
+            if stream is not None:
+                stream.close()
+            last_error = model_error
+            model_health.record_failure(model_name, model_error)
+            outcome = _log_model_failure(model_name, model_error)
+            metrics.record_model_attempt(model_name, 'stream', outcome, time.perf_counter() - attempt_started)
+    
+    raise last_error if last_error else Exception("Nenhum modelo disponível")
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(events):
+    return flask.Response(
+        events,
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Não deixar proxies fazer buffer do stream
+        }
+    )
+
+
+@api.route('/api/v1/chat', methods=['POST'])
+@chat_rate_limit  # Orçamento por utilizador e tier (RATE_LIMIT_CHAT_FREE/PLUS)
+@chat_ip_limit
+def chat():
+    with metrics.stage('total'):
+        return _chat()
+
+
+def _chat():
+    ctx, error_response = _prepare_chat()
+    if error_response:
+        return error_response
+    
+    reply_text = None
+    try:
+        # 3. Primeira mensagem que é só "hi"/"olá": resposta do pool, sem chamar o Gemini
+        reply_text = _pooled_opener(ctx)
+        if reply_text:
+            _save_turn(ctx, reply_text)
+            return jsonify({"reply": reply_text})
+        
+        # 4. Prosseguir com a chamada à API Gemini (o Plus tem prioridade na fila)
+        _log_prompt_size(ctx)
+        queued = time.perf_counter()
+        with admission.slot('plus' if ctx['is_plus'] else 'free'):
+            metrics.observe_stage('admission_wait', time.perf_counter() - queued)
+            response, used_model = _generate_reply(ctx['prompt'], ctx['persona'])
+        reply_text = response.text
+        _log_token_usage(response)
+        _save_turn(ctx, reply_text)
         
         return jsonify({"reply": reply_text})
 
+    except Overloaded as e:
+        _release_quota(ctx)
+        return _overloaded_response(e)
     except Exception as e:
-        # Imprime o erro real no terminal
-        error_str = str(e)
-        print(f"❌ Erro no Servidor: {e}")
+        # O erro real fica no log (com traceback); o cliente recebe uma mensagem genérica
+        chat_log.exception("Erro no Servidor: %s", e)
         
-        # Better error message for quota issues
-        if '429' in error_str or 'RESOURCE_EXHAUSTED' in error_str or 'quota' in error_str.lower():
-            return jsonify({
-                "error": "Quota da API excedida. Por favor, verifica o teu plano do Google Gemini API ou espera alguns minutos antes de tentar novamente.",
-                "details": "Todos os modelos disponíveis excederam a quota gratuita."
-            }), 429
-        else:
-            # Erro genérico - retornar mensagem mais amigável
-            error_message = "An error occurred while processing your message. Please try again."
-            if "timeout" in error_str.lower() or "timed out" in error_str.lower():
-                error_message = "Request timed out. Please try again."
-            elif "connection" in error_str.lower():
-                error_message = "Connection error. Please check your internet connection."
-            
-            return jsonify({
-                "error": error_message,
-                "details": str(e) if app.debug else None
-            }), 500
+        # Se o utilizador não recebeu resposta, devolver a mensagem reservada na quota
+        if reply_text is None:
+            _release_quota(ctx)
+        
+        return _chat_error_response(e)
+
 
-@app.route('/api/v1/chat/history', methods=['GET'])
-@limiter.limit("30 per minute")  # Rate limit: 30 requests por minuto por IP
+@api.route('/api/v1/chat/stream', methods=['POST'])
+@chat_rate_limit  # Partilha o orçamento do /api/v1/chat
+@chat_ip_limit
+def chat_stream():
+    """Chat com a resposta enviada em Server-Sent Events à medida que é gerada
+
+    Eventos: `token` ({"text": ...}) para cada pedaço de texto, `done`
+    ({"reply": ...}) com a resposta completa, ou `error` se a geração falhar.
+    """
+    ctx, error_response = _prepare_chat()
+    if error_response:
+        return error_response
+    
+    opener = _pooled_opener(ctx)
+    if opener:
+        _save_turn(ctx, opener)
+        return _sse_response([_sse_event('token', {"text": opener}), _sse_event('done', {"reply": opener})])
+    
+    # A vaga de admissão fica ocupada até o stream terminar (libertada no cleanup)
+    queued = time.perf_counter()
+    try:
+        ticket = admission.acquire('plus' if ctx['is_plus'] else 'free')
+        metrics.observe_stage('admission_wait', time.perf_counter() - queued)
+    except Overloaded as e:
+        _release_quota(ctx)
+        return _overloaded_response(e)
+    
+    try:
+        _log_prompt_size(ctx)
+        stream, first_chunk, used_model = _open_reply_stream(ctx['prompt'], ctx['persona'])
+    except Exception as e:
+        admission.release(ticket)
+        chat_log.exception("Erro no Servidor: %s", e)
+        _release_quota(ctx)
+        return _chat_error_response(e)
+    
+    parts = []
+    cleaned_up = []
+
+    def cleanup():
+        # Corre no fim do generate e quando o servidor fecha a resposta (mesmo que o
+        # generate nunca tenha começado, ex.: o cliente desligou-se antes do 1º chunk)
+        if cleaned_up:
+            return
+        cleaned_up.append(True)
+        stream.close()
+        admission.release(ticket)
+        # Se não chegou nenhum texto ao utilizador, devolver a quota
+        if not parts:
+            _release_quota(ctx)
+
+    def generate():
+        last_chunk = None
+        completed = False
+        try:
+            chunk = first_chunk
+            while chunk is not None:
+                last_chunk = chunk
+                text = chunk.text
+                if text:
+                    parts.append(text)
+                    yield _sse_event('token', {"text": text})
+                chunk = next(stream, None)
+            completed = True
+        except GeneratorExit:
+            # O cliente desligou-se: o finally fecha o stream e cancela a geração no Gemini
+            chat_log.warning("Cliente desligou-se a meio do stream", extra=fields(userId=ctx['user_id']))
+            raise
+        except Exception as e:
+            chat_log.exception("Erro no stream: %s", e)
+            body, status = _chat_error_response(e)
+            yield _sse_event('error', {**body.get_json(), "status": status})
+        finally:
+            cleanup()
+        
+        if completed:
+            reply_text = ''.join(parts)
+            _log_token_usage(last_chunk)
+            _save_turn(ctx, reply_text)
+            yield _sse_event('done', {"reply": reply_text})
+    
+    response = _sse_response(flask.stream_with_context(generate()))
+    response.call_on_close(cleanup)
+    return response
+
+@api.route('/api/v1/chat/history', methods=['GET'])
+@limiter.limit("30 per minute", key_func=rate_limit_key)  # Rate limit: 30 requests por minuto por utilizador
+@ip_limit
 def get_chat_history():
     """Carregar histórico de conversas do utilizador"""
     try:
@@ -430,44 +752,77 @@ def get_chat_history():
         if not validate_persona(persona):
             return jsonify({"error": "Invalid persona"}), 400
         
-        # Buscar mensagens do utilizador com a persona específica
-        # Estratégia: filtrar só por userId e depois filtrar persona em memória
-        # Isto evita a necessidade de índices compostos
-        chats_ref = db.collection('chats')
+        # Paginação por cursor: ?limit=&before=<timestamp ISO> ou ?after=<timestamp ISO>
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            before = parse_cursor(request.args.get('before'))
+            after = parse_cursor(request.args.get('after'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if before and after:
+            return jsonify({"error": "Use either before or after, not both"}), 400
+        
+        # Watermark da conversa (1 leitura): se o cliente já tem esta versão, 304 sem ler chats
+        # Turnos deste worker ainda na fila de escrita deixam a versão local à frente da remota
+        counter = get_counter(db, user_id, persona)
+        remote_version = counter['version']
+        counter['version'] = max(remote_version, history_cache.version(user_id, persona))
+        # Turnos deste worker ainda por gravar: entram na página e no ETag (a versão só
+        # muda com o commit, sem isto o 304 devolvia a página sem o turno acabado de enviar)
+        pending = [turn_from_queued(turn) for turn in chat_writer.pending_turns(user_id, persona)]
+        if counter['hiddenBefore']:
+            pending = [turn for turn in pending if turn['timestamp'] > counter['hiddenBefore']]
+        etag = history_etag(user_id, persona, counter, limit, request.args.get('before'), request.args.get('after'),
+                            pending[-1]['id'] if pending else None)
+        if etag in request.if_none_match:
+            not_modified = flask.Response(status=304)
+            not_modified.set_etag(etag)
+            return not_modified
         
         try:
-            # Filtrar apenas por userId (não precisa de índice composto)
-            docs = chats_ref.where(filter=firestore.FieldFilter('userId', '==', user_id)).stream()
-            messages = []
-            
-            for doc in docs:
-                data = doc.to_dict()
-                # Filtrar por persona em memória
-                if data.get('persona') == persona:
-                    messages.append({
-                        'id': doc.id,
-                        'message': data.get('message', ''),
-                        'reply': data.get('reply', ''),
-                        'timestamp': data.get('timestamp')
-                    })
-            
-            # Ordenar por timestamp em memória
-            messages.sort(key=lambda x: x.get('timestamp') or 0)
-            
+            # A página mais recente vem do cache em memória; páginas antigas do Firestore
+            page = None
+            if not before and not after:
+                page = history_cache.get_page(user_id, persona, limit, remote_version, counter['hiddenBefore'])
+            if page:
+                messages, has_more = page
+                metrics.record_history_size('cache', len(messages))
+            else:
+                # Filtro por persona e ordenação feitos no Firestore (índice composto)
+                messages, has_more = fetch_history_page(db, user_id, persona, limit, before, after,
+                                                        counter['hiddenBefore'])
+                metrics.record_history_size('firestore', len(messages))
+                if pending and not before:
+                    messages, has_more = merge_pending(messages, has_more, pending, limit, after)
+                elif not before and not after:
+                    history_cache.store(user_id, persona, messages, has_more, remote_version)
         except Exception as query_error:
-            print(f"⚠️ Erro na query do histórico: {query_error}")
-            messages = []
-
+            history_log.warning("Erro na query do histórico: %s", query_error)
+            return jsonify({"messages": [], "hasMore": False, "cursors": {"before": None, "after": None}})
         
-        return jsonify({"messages": messages})
+        response = jsonify({
+            "messages": messages,
+            "hasMore": has_more,
+            "cursors": {
+                "before": format_cursor(messages[0]['timestamp']) if messages else None,
+                "after": format_cursor(messages[-1]['timestamp']) if messages else None
+            }
+        })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if counter['lastMessageAt']:
+            response.headers['X-History-Watermark'] = format_cursor(counter['lastMessageAt'])
+        return response
     
     except Exception as e:
-        print(f"❌ Erro ao carregar histórico: {e}")
+        history_log.exception("Erro ao carregar histórico: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/api/v1/chat/history', methods=['DELETE'])
-@limiter.limit("10 per minute")
+@api.route('/api/v1/chat/history', methods=['DELETE'])
+@limiter.limit("10 per minute", key_func=rate_limit_key)
+@ip_limit
 def delete_chat_history():
     """Apagar histórico de conversas (por persona ou tudo)"""
     try:
@@ -482,54 +837,63 @@ def delete_chat_history():
         
         if not validate_user_id(user_id):
             return jsonify({"error": "Invalid user ID format"}), 400
+        
+        if persona and not validate_persona(persona):
+            return jsonify({"error": "Invalid persona"}), 400
             
-        # Preparar query
-        chats_ref = db.collection('chats')
-        query = chats_ref.where(filter=firestore.FieldFilter('userId', '==', user_id))
+        # O cache e os resumos das conversas deixam de ser válidos
+        history_cache.invalidate(user_id, persona)
+        try:
+            clear_summaries(db, user_id, persona)
+        except Exception as e:
+            history_log.warning("Erro ao apagar resumos: %s", e)
         
-        # Filtrar por persona se fornecida
-        # Nota: Como não temos índice composto, filtramos em memória para apagar
-        # Isto não é o ideal para milhões de registos, mas funciona bem para este MVP
+        # As mensagens ficam escondidas já; o job apaga-as em background
+        job_id = delete_jobs.create_job(db, user_id, persona)
+        history_log.info("Delete job criado", extra=fields(jobId=job_id, userId=user_id, persona=persona or 'todas'))
         
-        batch = db.batch()
-        docs = query.stream()
-        count = 0
-        
-        for doc in docs:
-            # Se persona foi especificada, verificar se corresponde
-            if persona:
-                doc_data = doc.to_dict()
-                if doc_data.get('persona') != persona:
-                    continue
-            
-            # Adicionar ao batch de delete
-            batch.delete(doc.reference)
-            count += 1
-            
-            # Firestore batch limit is 500
-            if count % 400 == 0:
-                batch.commit()
-                batch = db.batch()
-                
-        # Commit final
-        if count > 0:
-            batch.commit()
-            
         return jsonify({
-            "success": True, 
-            "message": f"Deleted {count} messages",
-            "count": count
-        })
+            "success": True,
+            "message": "Deletion started",
+            "jobId": job_id,
+            "status": "pending"
+        }), 202
         
     except Exception as e:
-        print(f"❌ Erro ao apagar histórico: {e}")
+        history_log.exception("Erro ao apagar histórico: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@api.route('/api/v1/chat/history/delete-jobs/<job_id>', methods=['GET'])
+@limiter.limit("60 per minute", key_func=rate_limit_key)
+@ip_limit
+def get_delete_job(job_id):
+    """Estado de um job de apagar histórico"""
+    try:
+        if not db:
+            return jsonify({"error": "Database not configured"}), 500
+        
+        user_id = request.args.get('userId')
+        if not user_id or not validate_user_id(user_id):
+            return jsonify({"error": "Invalid user ID format"}), 400
+        
+        job = delete_jobs.get_job(db, job_id)
+        # Um utilizador só vê os próprios jobs
+        if not job or job['userId'] != user_id:
+            return jsonify({"error": "Job not found"}), 404
+        
+        return jsonify(job), 200
+    
+    except Exception as e:
+        history_log.exception("Erro ao ler job de apagar: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
 # ==================== STRIPE PAYMENT ENDPOINTS ====================
 
-@app.route('/api/v1/payment/create-checkout', methods=['POST'])
-@limiter.limit("10 per minute")
+@api.route('/api/v1/payment/create-checkout', methods=['POST'])
+@limiter.limit("10 per minute", key_func=rate_limit_key)
+@ip_limit
 def create_checkout():
     """Criar sessão de checkout do Stripe"""
     try:
@@ -581,6 +945,7 @@ def create_checkout():
                     'plan_id': plan_id
                 }
             )
+            rollups.record_checkout('created')
             
             return jsonify({
                 "checkoutUrl": checkout_session.url,
@@ -591,10 +956,10 @@ def create_checkout():
             return jsonify({"error": f"Stripe error: {str(e)}"}), 400
     
     except Exception as e:
-        print(f"❌ Erro ao criar checkout: {e}")
+        payments_log.exception("Erro ao criar checkout: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/v1/payment/webhook', methods=['POST'])
+@api.route('/api/v1/payment/webhook', methods=['POST'])
 def stripe_webhook():
     """Webhook do Stripe para processar eventos de pagamento"""
     payload = request.get_data(as_text=True)
@@ -606,66 +971,35 @@ def stripe_webhook():
             payload, sig_header, webhook_secret
         )
     except ValueError as e:
-        print(f"❌ Erro ao parsear payload: {e}")
+        payments_log.error("Erro ao parsear payload: %s", e)
+        metrics.record_webhook_event(None, 'invalid_payload')
         return jsonify({"error": "Invalid payload"}), 400
     except stripe.error.SignatureVerificationError as e:
-        print(f"❌ Erro de assinatura: {e}")
+        payments_log.error("Erro de assinatura: %s", e)
+        metrics.record_webhook_event(None, 'invalid_signature')
         return jsonify({"error": "Invalid signature"}), 400
     
-    # Processar eventos
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        user_id = session.get('client_reference_id') or session.get('metadata', {}).get('user_id')
-        subscription_id = session.get('subscription')
-        customer_id = session.get('customer')
-        
-        if user_id:
-            # Guardar subscrição no Firestore
-            db.collection('subscriptions').document(user_id).set({
-                'subscriptionId': subscription_id,
-                'customerId': customer_id,
-                'status': 'active',
-                'planId': session.get('metadata', {}).get('plan_id', 'monthly'),
-                'createdAt': firestore.SERVER_TIMESTAMP,
-                'updatedAt': firestore.SERVER_TIMESTAMP
-            }, merge=True)
-            print(f"✅ Subscrição criada para user: {user_id}")
-    
-    elif event['type'] == 'customer.subscription.updated':
-        subscription = event['data']['object']
-        subscription_id = subscription.get('id')
-        status = subscription.get('status')
-        
-        # Encontrar user pelo subscriptionId
-        subs_ref = db.collection('subscriptions')
-        query = subs_ref.where(filter=firestore.FieldFilter('subscriptionId', '==', subscription_id)).limit(1).stream()
-        
-        for doc in query:
-            db.collection('subscriptions').document(doc.id).update({
-                'status': 'active' if status == 'active' else 'inactive',
-                'updatedAt': firestore.SERVER_TIMESTAMP
-            })
-            print(f"✅ Subscrição atualizada: {subscription_id} -> {status}")
-    
-    elif event['type'] == 'customer.subscription.deleted':
-        subscription = event['data']['object']
-        subscription_id = subscription.get('id')
-        
-        # Encontrar user pelo subscriptionId
-        subs_ref = db.collection('subscriptions')
-        query = subs_ref.where(filter=firestore.FieldFilter('subscriptionId', '==', subscription_id)).limit(1).stream()
-        
-        for doc in query:
-            db.collection('subscriptions').document(doc.id).update({
-                'status': 'cancelled',
-                'updatedAt': firestore.SERVER_TIMESTAMP
-            })
-            print(f"✅ Subscrição cancelada: {subscription_id}")
+    if not db:
+        return jsonify({"error": "Database not configured"}), 500
+    
+    # Gravar o evento e responder já; a thread de eventos aplica-o por ordem
+    try:
+        if stripe_events.enqueue(event):
+            metrics.record_webhook_event(event['type'], 'queued')
+        else:
+            payments_log.info("Evento Stripe %s já recebido (%s)", event['id'], event['type'])
+            metrics.record_webhook_event(event['type'], 'duplicate')
+    except Exception as e:
+        # Sem 200 o Stripe volta a enviar o evento
+        payments_log.exception("Erro ao gravar evento Stripe %s: %s", event['id'], e)
+        metrics.record_webhook_event(event['type'], 'error')
+        return jsonify({"error": "Could not record event"}), 500
     
     return jsonify({"status": "success"}), 200
 
-@app.route('/api/v1/payment/subscription-status', methods=['GET'])
-@limiter.limit("30 per minute")
+@api.route('/api/v1/payment/subscription-status', methods=['GET'])
+@limiter.limit("30 per minute", key_func=rate_limit_key)
+@ip_limit
 def get_subscription_status():
     """Verificar status da subscrição do utilizador"""
     try:
@@ -680,16 +1014,15 @@ def get_subscription_status():
         if not validate_user_id(user_id):
             return jsonify({"error": "Invalid user ID format"}), 400
         
-        # Buscar subscrição no Firestore
-        sub_doc = db.collection('subscriptions').document(user_id).get()
+        # Buscar subscrição (cache partilhado com o chat, invalidado pelo webhook)
+        sub_data = entitlement_cache.get(db, user_id)
         
-        if not sub_doc.exists:
+        if not sub_data:
             return jsonify({
                 "isSubscribed": False,
                 "status": "none"
             }), 200
         
-        sub_data = sub_doc.to_dict()
         subscription_id = sub_data.get('subscriptionId')
         status = sub_data.get('status', 'inactive')
         
@@ -706,6 +1039,7 @@ def get_subscription_status():
                         'status': 'active' if is_active else 'inactive',
                         'updatedAt': firestore.SERVER_TIMESTAMP
                     })
+                    invalidate_entitlement(db, user_id)
             except:
                 pass
         
@@ -716,11 +1050,12 @@ def get_subscription_status():
         }), 200
     
     except Exception as e:
-        print(f"❌ Erro ao verificar subscrição: {e}")
+        payments_log.exception("Erro ao verificar subscrição: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/v1/payment/create-portal-session', methods=['POST'])
-@limiter.limit("10 per minute")
+@api.route('/api/v1/payment/create-portal-session', methods=['POST'])
+@limiter.limit("10 per minute", key_func=rate_limit_key)
+@ip_limit
 def create_portal_session():
     """Criar sessão do Customer Portal para gerir subscrição"""
     try:
@@ -766,11 +1101,12 @@ def create_portal_session():
             return jsonify({"error": f"Stripe error: {str(e)}"}), 400
     
     except Exception as e:
-        print(f"❌ Erro ao criar portal session: {e}")
+        payments_log.exception("Erro ao criar portal session: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/v1/support/report-issue', methods=['POST'])
-@limiter.limit("5 per minute")
+@api.route('/api/v1/support/report-issue', methods=['POST'])
+@limiter.limit("5 per minute", key_func=rate_limit_key)
+@ip_limit
 def report_issue():
     try:
         if not db:
@@ -788,7 +1124,8 @@ def report_issue():
         if user_id and not validate_user_id(user_id):
             return jsonify({"error": "Invalid user ID format"}), 400
         doc_ref = db.collection('reports').document()
-        doc_ref.set({
+        batch = db.batch()
+        batch.set(doc_ref, {
             'reportId': doc_ref.id,
             'userId': user_id or None,
             'email': email or None,
@@ -800,43 +1137,25 @@ def report_issue():
             'updatedAt': firestore.SERVER_TIMESTAMP
         })
         
-        # Enviar notificação para o Telegram
-        telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
-        telegram_chat_id = os.getenv("TELEGRAM_CHAT_ID")
-        
-        
-        print(f"🔍 Checking Telegram config: TOKEN={'Set' if telegram_token else 'Missing'}, ID={'Set' if telegram_chat_id else 'Missing'}")
-        if telegram_token and telegram_chat_id:
-            print(f"📨 Sending Telegram report to {telegram_chat_id}...")
-            try:
-                msg_text = f"🚨 *New Report from Luna AI*\n\n" \
-                           f"👤 *User:* `{user_id or 'Anonymous'}`\n" \
-                           f"📧 *Email:* `{email or 'N/A'}`\n" \
-                           f"⚠️ *Severity:* {severity.upper()}\n" \
-                           f"📄 *Page:* `{page}`\n\n" \
-                           f"📝 *Description:*\n{description}"
-                
-                resp = requests.post(
-                    f"https://api.telegram.org/bot{telegram_token}/sendMessage",
-                    json={
-                        "chat_id": telegram_chat_id,
-                        "text": msg_text,
-                        "parse_mode": "Markdown"
-                    },
-                    timeout=5
-                )
-                print(f"📨 Telegram response: {resp.status_code} - {resp.text}")
-            except Exception as e:
-                print(f"⚠️ Erro ao enviar notificação Telegram: {e}")
+        # Notificação para o Telegram: gravada no outbox com o report e enviada em background
+        telegram_token, telegram_chat_id = telegram_config()
+        if telegram_token:
+            msg_text, digest_line = format_report(user_id, email, severity, page, description)
+            notifications.add_to_batch(batch, 'report', msg_text, digest_line, parse_mode='Markdown')
         else:
-            print("⚠️ Telegram not configured (TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID missing)")
+            support_log.warning("Telegram not configured (TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID missing)")
+        batch.commit()
+        if telegram_token:
+            notifications.wake()
+        rollups.record_report(severity)
         return jsonify({"ok": True, "reportId": doc_ref.id}), 200
     except Exception as e:
-        print(f"❌ Erro ao reportar issue: {e}")
+        support_log.exception("Erro ao reportar issue: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # Health check endpoint (sem rate limiting)
-@app.route('/health', methods=['GET'])
+@api.route('/health', methods=['GET'])
+@limiter.exempt  # Health checks da plataforma e testes de carga
 def health_check():
     """Endpoint para verificar se o servidor está online"""
     return jsonify({"status": "ok", "service": "Luna Backend"}), 200
@@ -846,8 +1165,48 @@ def health_check():
 # DAILY REPORT SCHEDULER
 # ============================================================================
 
-@app.route('/api/v1/admin/trigger-report', methods=['POST'])
+def is_admin_request(allow_unconfigured=False):
+    """Pedido com a chave de admin (header X-Admin-Key ou Bearer).
+
+    Sem ADMIN_API_KEY definida os endpoints de admin ficam fechados; só o
+    trigger-report (que já era aberto) passa `allow_unconfigured=True`.
+    """
+    admin_key = os.getenv("ADMIN_API_KEY")
+    if not admin_key:
+        return allow_unconfigured
+    # O Prometheus envia a chave como `Authorization: Bearer` (authorization.credentials no scrape config)
+    return request.headers.get('X-Admin-Key') == admin_key or \
+        request.headers.get('Authorization') == f"Bearer {admin_key}"
+
+
+def _admin_denied(allow_unconfigured=False):
+    """Resposta de erro para um pedido de admin sem autorização (ou None)"""
+    if is_admin_request(allow_unconfigured):
+        return None
+    if not os.getenv("ADMIN_API_KEY"):
+        return jsonify({"error": "Admin API disabled (ADMIN_API_KEY not set)"}), 403
+    return jsonify({"error": "Unauthorized"}), 401
+
+
+@api.route('/metrics', methods=['GET'])
+@limiter.exempt  # Scrapes do Prometheus
+def prometheus_metrics():
+    """Métricas Prometheus agregadas de todos os workers (ver metrics.py)"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    rendered = metrics.render()
+    if rendered is None:
+        return jsonify({"error": "prometheus_client not installed"}), 501
+    body, content_type = rendered
+    return flask.Response(body, content_type=content_type)
+
+
+@api.route('/api/v1/admin/trigger-report', methods=['POST'])
 def trigger_report():
+    denied = _admin_denied(allow_unconfigured=True)
+    if denied:
+        return denied
     try:
         generate_daily_report()
         return jsonify({"status": "Report triggered manually"}), 200
@@ -855,97 +1214,291 @@ def trigger_report():
         return jsonify({"error": str(e)}), 500
 
 
-def generate_daily_report():
-    print("📊 Generating daily report...")
+@api.route('/api/v1/admin/model-health', methods=['GET'])
+def get_model_health():
+    """Estado dos circuitos dos modelos Gemini neste worker"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify({
+        "pid": os.getpid(),
+        "preferenceOrder": MODELS_TO_TRY,
+        "models": model_health.snapshot()
+    }), 200
+
+
+@api.route('/api/v1/admin/chat-writer', methods=['GET'])
+def get_chat_writer_stats():
+    """Profundidade e lag da fila de escrita dos chats neste worker"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify({"pid": os.getpid(), **chat_writer.stats()}), 200
+
+
+@api.route('/api/v1/admin/admission', methods=['GET'])
+def get_admission_stats():
+    """Vagas do Gemini, filas e tempos de espera por tier neste worker"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify({"pid": os.getpid(), **admission.stats()}), 200
+
+
+@api.route('/api/v1/admin/caches', methods=['GET'])
+def get_cache_stats():
+    """Estatísticas (hits/misses/tamanho) dos caches em memória deste worker"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify({
+        "pid": os.getpid(),
+        "entitlements": entitlement_cache.stats(),
+        "history": history_cache.stats(),
+        "promptCaches": prompt_cache.snapshot(),
+        "openers": opener_pool.stats(),
+        "notifications": notifications.stats(),
+        "stripeEvents": stripe_events.stats(),
+        "rateLimits": tier_limits.stats(),
+        "logs": log_stats()
+    }), 200
+
+
+@api.route('/api/v1/admin/scheduled-jobs', methods=['GET'])
+def get_scheduled_jobs():
+    """Holder do lease e última execução de cada job agendado"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    if not db:
+        return jsonify({"error": "Database not configured"}), 500
+    try:
+        return jsonify({"jobs": list_jobs(db)}), 200
+    except Exception as e:
+        log.exception("Erro ao ler jobs agendados: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@api.route('/api/v1/admin/stats', methods=['GET'])
+def get_stats():
+    """Métricas agregadas por hora (rollups) num intervalo
+
+    Query: `from`/`to` (ISO 8601, padrão: últimas 24h) e `group` (`total`, `hour` ou `day`).
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    if not db:
+        return jsonify({"error": "Database not configured"}), 500
     try:
-        # 1. Setup Dates (Yesterday)
-        now = datetime.now(timezone.utc)
-        yesterday = now - timedelta(days=1)
-        start_of_day = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_of_day = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
-        
-        # 2. Count New Users (Firebase Auth)
-        new_users = 0
-        try:
-            from firebase_admin import auth
-            # Iterate all users (might be slow if millions, but ok for now)
-            for user in auth.list_users().iterate_all():
-                # creation_timestamp is in milliseconds
-                created = datetime.fromtimestamp(user.user_metadata.creation_timestamp / 1000, tz=timezone.utc)
-                if start_of_day <= created <= end_of_day:
-                    new_users += 1
-        except Exception as e:
-            print(f"⚠️ Error counting users: {e}")
+        end = parse_cursor(request.args.get('to')) or datetime.now(timezone.utc)
+        start = parse_cursor(request.args.get('from')) or end - timedelta(hours=24)
+        group = request.args.get('group', 'total')
+        if group not in ('total', 'hour', 'day'):
+            return jsonify({"error": "group must be total, hour or day"}), 400
+        return jsonify(query_range(db, start, end, group)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log.exception("Erro ao ler rollups: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-        # 3. Count Messages (Firestore)
-        messages_sent = 0
-        try:
-            # Query Firestore
-            # Note: This requires an index on 'timestamp'. If missing, it might fail.
-            # We use a try/except to handle missing index gracefully
-            if db:
-                msgs = db.collection('chats')\
-                    .where(filter=firestore.FieldFilter('timestamp', '>=', start_of_day))\
-                    .where(filter=firestore.FieldFilter('timestamp', '<=', end_of_day))\
-                    .stream()
-                messages_sent = sum(1 for _ in msgs)
-        except Exception as e:
-            print(f"⚠️ Error counting messages: {e}")
 
-        # 4. Count New Subscriptions (Stripe)
-        new_subs = 0
-        try:
-            if stripe.api_key:
-                # Convert to unix timestamp
-                start_ts = int(start_of_day.timestamp())
-                end_ts = int(end_of_day.timestamp())
-                
-                # List new subscriptions created yesterday
-                subs = stripe.Subscription.list(
-                    created={'gte': start_ts, 'lte': end_ts},
-                    limit=100
-                )
-                new_subs = len(subs.data)
-                # If has_more is true, we should fetch more, but for a daily report 100 is likely enough for now
-                if subs.has_more:
-                    new_subs = "100+"
-        except Exception as e:
-            print(f"⚠️ Error counting subscriptions: {e}")
+def generate_daily_report(run=None):
+    """Gerar e enviar o relatório diário.
 
-        # 5. Send Telegram Message
-        telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
-        telegram_chat_id = os.getenv("TELEGRAM_CHAT_ID")
+    Com `run` (execução com lease, ver job_lease.py) o progresso fica no
+    checkpoint: um worker que retome o job não volta a recolher as métricas
+    nem a enviar a mensagem se isso já tiver sido feito. Nesse caso os erros
+    são propagados para a execução ser marcada como falhada e repetida.
+    """
+    scheduler_log.info("Generating daily report...")
+    checkpoint = run.checkpoint if run else {}
+    try:
+        if checkpoint.get('sent'):
+            scheduler_log.info("Daily report already sent for this run")
+            return
         
-        if telegram_token and telegram_chat_id:
-            msg = f"Bom dia Matilde! Ontem tivemos {new_users} novos users, {messages_sent} mensagens enviadas e {new_subs} novas subscrições Plus! 💰"
-            
-            requests.post(
-                f"https://api.telegram.org/bot{telegram_token}/sendMessage",
-                json={
-                    "chat_id": telegram_chat_id,
-                    "text": msg
-                },
-                timeout=10
-            )
-            print("✅ Daily report sent!")
+        msg = checkpoint.get('message')
+        if not msg:
+            # 1-4. Novos users (Auth), mensagens (count() no Firestore) e subscrições
+            # (Stripe) de ontem, lidos em paralelo com timeout por fonte
+            daily = collect_daily_metrics(db)
+            new_users = daily.display('new_users')
+            messages_sent = daily.display('messages_sent')
+            new_subs = daily.display('new_subs')
+            limit_line = ""
+            if 'limit_hit_users' in daily.values:
+                limit_line = f"\n🛑 {daily.display('limit_hit_users')} users free chegaram ao limite diário."
+            scheduler_log.info("Daily report sources: %s", daily.timings_summary())
+            msg = f"Bom dia Matilde! Ontem tivemos {new_users} novos users, {messages_sent} mensagens enviadas e {new_subs} novas subscrições Plus! 💰{limit_line}\n\n⏱️ {daily.timings_summary()}"
+            if run:
+                run.save(message=msg)
+
+        # 5. Send Telegram Message (pelo outbox; o id fixo por dia evita duplicados se o job for retomado)
+        telegram_token, telegram_chat_id = telegram_config()
+        
+        if telegram_token:
+            if db:
+                notifications.enqueue('daily_report', msg, dedupe_key=f"daily-report-{run.run_key}" if run else None)
+            else:
+                notifications.send_now(msg)
+            if run:
+                run.save(sent=True)
+            scheduler_log.info("Daily report queued!")
         else:
-            print("⚠️ Telegram not configured for daily report")
+            scheduler_log.warning("Telegram not configured for daily report")
 
     except Exception as e:
-        print(f"❌ Error generating daily report: {e}")
+        scheduler_log.exception("Error generating daily report: %s", e)
+        if run:
+            raise
 
-# Start Scheduler
-# Run at 09:00 AM Lisbon time (UTC+0 in winter, UTC+1 summer). 
-# We'll use Europe/Lisbon timezone if possible, or just UTC+0 (09:00 UTC is 09:00 Lisbon winter)
-try:
-    scheduler = BackgroundScheduler()
-    # 09:00 Lisbon time
-    scheduler.add_job(generate_daily_report, 'cron', hour=9, minute=0, timezone=pytz.timezone('Europe/Lisbon'))
-    scheduler.start()
-    print("⏰ Daily report scheduled for 09:00 Europe/Lisbon")
-except Exception as e:
-    print(f"⚠️ Could not start scheduler: {e}")
 
+REPORT_TIMEZONE = pytz.timezone('Europe/Lisbon')
+REPORT_HOUR = 9
+
+
+def run_scheduled_daily_report():
+    """Relatório diário com lease: corre uma única vez por dia em toda a frota.
+
+    Chamado às 09:00 e a cada 5 minutos; as chamadas extra só fazem alguma
+    coisa se o relatório do dia ainda não tiver sido feito (ex.: o worker que
+    o estava a gerar morreu a meio).
+    """
+    if not db:
+        return
+    now = datetime.now(REPORT_TIMEZONE)
+    if now.hour < REPORT_HOUR:
+        return
+    try:
+        run_exclusive(db, 'daily-report', now.date().isoformat(), generate_daily_report)
+    except Exception as e:
+        scheduler_log.warning("Erro no lease do relatório diário: %s", e)
+
+scheduler = None
+
+
+def _start_scheduler():
+    """Agendar o relatório diário neste processo.
+
+    Run at 09:00 AM Lisbon time (UTC+0 in winter, UTC+1 summer).
+    Todos os workers agendam o job; o lease no Firestore garante uma única execução.
+    """
+    global scheduler
+    try:
+        scheduler = BackgroundScheduler()
+        # 09:00 Lisbon time
+        scheduler.add_job(run_scheduled_daily_report, 'cron', hour=REPORT_HOUR, minute=0, timezone=REPORT_TIMEZONE)
+        # Retomar o relatório se o worker que o tinha morreu a meio
+        scheduler.add_job(run_scheduled_daily_report, 'interval', minutes=5)
+        scheduler.start()
+        scheduler_log.info("Daily report scheduled for 09:00 Europe/Lisbon")
+    except Exception as e:
+        scheduler_log.warning("Could not start scheduler: %s", e)
+
+
+# ============================================================================
+# APP FACTORY E ARRANQUE DOS WORKERS
+# ============================================================================
+
+_worker_lock = threading.Lock()
+_worker_pid = None
+
+
+def init_worker():
+    """Criar os clientes e arrancar o trabalho em background neste processo.
+
+    Corre uma vez por processo: no hook `post_worker_init` do gunicorn (logo a
+    seguir ao fork, ver gunicorn.conf.py) ou, sem gunicorn, no primeiro pedido.
+    """
+    global db, client, _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        started = time.perf_counter()
+        # Perfil gevent: ligar o gRPC do Firestore ao gevent antes de criar clientes
+        init_async_runtime()
+        client = get_gemini_client()
+        db = get_db()
+        configure_stripe()
+
+        # Partilhar o estado dos circuitos dos modelos Gemini e os prompt caches entre workers
+        if db:
+            model_health.attach(db)
+            prompt_cache.attach(db)
+            # Retomar jobs de apagar histórico de workers que morreram
+            delete_jobs.attach(db)
+            rollups.attach(db)
+            notifications.attach(db)
+            stripe_events.attach(db)
+            tier_limits.attach(db)
+            # Thread de escrita dos chats e recuperação dos spools de workers que morreram
+            chat_writer.attach(db)
+        _start_scheduler()
+
+        _worker_pid = os.getpid()
+        boot_timings['worker_init'] = round((time.perf_counter() - started) * 1000, 1)
+        # Com --preload o import foi feito no master: o arranque do worker é só o init
+        boot_timings['preloaded'] = os.getpid() != _boot_pid
+        boot_timings['cold_start'] = boot_timings['worker_init'] if boot_timings['preloaded'] \
+            else round((time.perf_counter() - _boot_started) * 1000, 1)
+        log.info("Worker %d pronto: %s", os.getpid(), _boot_summary(), extra=fields(timingsMs=dict(boot_timings)))
+
+
+def _boot_summary():
+    labels = [('import', 'import'), ('create_app', 'create_app'), ('firestore', 'Firestore'),
+              ('gemini', 'Gemini'), ('stripe', 'Stripe'), ('worker_init', 'init'), ('cold_start', 'total')]
+    summary = ", ".join(f"{label} {boot_timings[name]:.0f}ms" for name, label in labels if name in boot_timings)
+    return summary + (" (preload: import feito no master)" if boot_timings.get('preloaded') else "")
+
+
+@api.before_app_request
+def _ensure_worker():
+    # Sem gunicorn (flask run, testes) os clientes são criados no primeiro pedido
+    init_worker()
+
+
+@api.route('/api/v1/admin/boot', methods=['GET'])
+def get_boot_stats():
+    """Tempos de arranque deste worker (import, app e cada cliente)"""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify({"pid": os.getpid(), "workerClass": worker_class(), "timingsMs": boot_timings}), 200
+
+
+def create_app():
+    """Criar a aplicação Flask.
+
+    Não cria clientes nem threads (isso é feito em init_worker, por processo),
+    por isso pode correr no master do gunicorn com --preload.
+    """
+    started = time.perf_counter()
+    log.info("Luna Backend - Initializing...", extra=fields(python=sys.version, port=os.getenv('PORT', 'NOT SET'),
+                                                            workerClass=worker_class()))
+
+    flask_app = flask.Flask(__name__)
+    # Configurar CORS restritivo
+    CORS(flask_app,
+         origins=allowed_origins,
+         methods=["GET", "POST", "DELETE", "OPTIONS"],
+         allow_headers=["Content-Type", "Authorization", "If-None-Match", "X-Request-ID"],
+         expose_headers=["ETag", "X-History-Watermark", "Retry-After", "X-Request-ID",
+                         "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset"],
+         supports_credentials=True)
+    # O blueprint primeiro: o init_worker() corre antes do rate limit (que lê o tier)
+    flask_app.register_blueprint(api)
+    limiter.init_app(flask_app)
+
+    boot_timings['create_app'] = round((time.perf_counter() - started) * 1000, 1)
+    boot_timings['import'] = round((started - _boot_started) * 1000, 1)
+    return flask_app
+
+
+app = create_app()
 
 
 if __name__ == '__main__':
@@ -953,33 +1506,20 @@ if __name__ == '__main__':
     port = int(os.getenv("PORT", 5001))
     # Default DEBUG to false in production unless explicitly enabled in env
     debug_mode = os.getenv("DEBUG", "false").lower() == "true"
-    
-    print("=" * 50)
-    print("🚀 Luna Backend - Starting Server")
-    print("=" * 50)
+    init_worker()
     
     # Status das configurações
-    if db:
-        print("✅ Firebase: Connected")
-    else:
-        print("❌ Firebase: NOT CONFIGURED")
-    
-    if client and gemini_api_key:
-        print("✅ Gemini API: Configured")
-    else:
-        print("❌ Gemini API: NOT CONFIGURED")
-    
-    print("🔒 Security: CORS restricted, Rate limiting enabled")
-    print(f"🌐 Allowed Origins: {', '.join(allowed_origins)}")
-    print("📊 Rate Limits: 10 req/min (chat), 30 req/min (history)")
-    
-    if stripe.api_key:
-        print("💳 Stripe: Payment system enabled")
-    else:
-        print("⚠️  Stripe: API key not configured (payments disabled)")
-    
-    print(f"🚀 Starting server on port {port} (debug={debug_mode})")
-    print("=" * 50)
+    if not db:
+        log.error("Firebase: NOT CONFIGURED")
+    if not (client and gemini_api_key):
+        log.error("Gemini API: NOT CONFIGURED")
+    if not stripe.api_key:
+        log.warning("Stripe: API key not configured (payments disabled)")
+    log.info("Luna Backend - Starting server on port %d (debug=%s)", port, debug_mode, extra=fields(
+        firebase=bool(db), gemini=bool(client and gemini_api_key), stripe=bool(stripe.api_key),
+        allowedOrigins=allowed_origins,
+        rateLimits={'chatFree': TIER_LIMITS['chat']['free'], 'chatPlus': TIER_LIMITS['chat']['plus'],
+                    'history': "30 per minute"}))
     # Bind to 0.0.0.0 so hosting providers (Render, etc.) can detect the open port.
     # When running under a WSGI server like gunicorn this block is not executed.
     app.run(host="0.0.0.0", port=port, debug=debug_mode)
@@ -0,0 +1,33 @@
+"""Criar os índices inversos do Stripe para as subscrições existentes.
+
+Os índices `stripe_subscriptions/{subscriptionId}` e `stripe_customers/{customerId}`
+passaram a ser escritos pelo webhook no `checkout.session.completed`; as
+subscrições criadas antes disso precisam deste backfill (corre-se uma vez, e
+voltar a correr é seguro):
+
+    python backfill_stripe_index.py [--dry-run]
+
+Usa as mesmas credenciais do backend (FIREBASE_CREDENTIALS_JSON ou FIREBASE_CONFIG_PATH).
+"""
+import sys
+from dotenv import load_dotenv
+from clients import get_db
+from stripe_events import backfill_reverse_index
+
+
+def main():
+    load_dotenv()
+    dry_run = '--dry-run' in sys.argv[1:]
+    db = get_db()
+    if not db:
+        sys.exit(1)
+
+    count = backfill_reverse_index(db, dry_run=dry_run)
+    if dry_run:
+        print(f"🔎 {count} subscrições seriam indexadas (dry run)")
+    else:
+        print(f"✅ Índices inversos escritos para {count} subscrições")
+
+
+if __name__ == '__main__':
+    main()
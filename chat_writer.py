@@ -0,0 +1,373 @@
+"""Persistência write-behind dos turnos de chat.
+
+O `chat()` deixa de esperar pela escrita no Firestore: o turno entra numa fila
+limitada em memória e uma thread em background agrupa os turnos em batch writes
+(`chats` + `chat_counters`), com retry e backoff. Com a fila cheia o `enqueue`
+não espera pelo Firestore: o turno fica só no spool e numa lista de overflow que
+a thread volta a pôr na fila quando houver espaço; entretanto o `chat()` recusa
+pedidos novos com 503 (`saturated()`).
+
+Cada turno é também escrito num spool em disco (um ficheiro JSONL por processo,
+com lock exclusivo) antes de entrar na fila, e marcado como concluído depois do
+commit. Quando um worker arranca (`attach`, no post_worker_init do gunicorn),
+recupera os spools de processos que já não existem (o lock está livre) e volta
+a enfileirar os turnos pendentes. Turnos que falharam todas as tentativas ficam
+"parked" e voltam à fila a cada `PARKED_RETRY_SECONDS`; quando não há turnos em
+curso o spool é compactado só com esses. Os ids dos documentos são gerados no
+enqueue e os chats são criados com precondição: um
+turno já gravado (ex.: o processo morreu entre o commit e a marca no spool) é
+recusado pelo Firestore, por isso voltar a escrevê-lo não duplica a mensagem
+nem o incremento do contador. A escrita é uma transação que lê o `hiddenBefore`
+dos contadores: turnos anteriores a um pedido de apagar o histórico (ainda na
+fila, em overflow ou num spool recuperado) são descartados em vez de gravados.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from google.api_core.exceptions import AlreadyExists
+from counters import commit_turns
+from metrics import metrics
+from logs import get_logger
+
+log = get_logger('chat_writer')
+
+SPOOL_DIR = os.getenv("CHAT_SPOOL_DIR", "/tmp/luna-chat-spool")
+QUEUE_MAX_SIZE = int(os.getenv("CHAT_WRITER_QUEUE_SIZE", "10000"))
+# Cada turno são até 2 escritas (chat + contador); o limite do Firestore é 500 por batch
+BATCH_SIZE = 200
+FLUSH_INTERVAL_SECONDS = 0.2
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SECONDS = 30
+# Turnos que falharam todas as tentativas voltam a ser tentados com este intervalo
+PARKED_RETRY_SECONDS = int(os.getenv("CHAT_WRITER_PARKED_RETRY", "300"))
+
+
+class ChatWriter:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=QUEUE_MAX_SIZE)
+        self._pending = OrderedDict()  # id -> instante do enqueue (para calcular o lag)
+        self._overflow = deque()  # turnos que não couberam na fila (já estão no spool)
+        self._conversations = {}  # (userId, persona) -> {id: turno} ainda não gravados
+        self._lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        self._spool = None
+        self._spool_path = None
+        self._db = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+        self.overflowed = 0
+        self.recovered = 0
+        self.already_written = 0
+        self.dropped_hidden = 0
+        self._parked = OrderedDict()  # id -> turno que falhou todas as tentativas
+        self._parked_retry_at = 0
+
+    # ---------- API pública ----------
+
+    def attach(self, db):
+        """Arrancar a thread e o spool deste worker e recuperar os spools órfãos"""
+        self._ensure_started(db)
+
+    def enqueue(self, db, user_id, persona, message, reply):
+        """Enfileirar um turno e devolvê-lo (o `id` é o do documento em `chats`)"""
+        self._ensure_started(db)
+        turn = {
+            'id': db.collection('chats').document().id,
+            'userId': user_id,
+            'persona': persona,
+            'message': message,
+            'reply': reply,
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        }
+        with self._lock:
+            self._spool_append({'op': 'turn', 'turn': turn})
+            self._pending[turn['id']] = time.monotonic()
+            self._track(turn)
+        try:
+            self._queue.put_nowait(turn)
+        except queue.Full:
+            # Fila cheia: o turno já está no spool, a thread grava-o quando houver espaço
+            with self._lock:
+                self._overflow.append(turn)
+                self.overflowed += 1
+        return turn
+
+    def pending_turns(self, user_id, persona):
+        """Turnos da conversa enfileirados neste processo e ainda não gravados (por ordem)"""
+        with self._lock:
+            return list(self._conversations.get((user_id, persona), {}).values())
+
+    def saturated(self):
+        """True com a fila de escrita cheia (o chat deve recusar pedidos novos)"""
+        return self._pid == os.getpid() and (self._queue.full() or bool(self._overflow))
+
+    def flush(self, timeout=20):
+        """Esperar até a fila esvaziar (usado no shutdown)"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._pending:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def stats(self):
+        with self._lock:
+            oldest = next(iter(self._pending.values()), None)
+            depth = len(self._pending)
+        return {
+            'depth': depth,
+            'lagSeconds': round(time.monotonic() - oldest, 3) if oldest else 0.0,
+            'written': self.written,
+            'failed': self.failed,
+            'retries': self.retries,
+            'overflow': len(self._overflow),
+            'overflowed': self.overflowed,
+            'recovered': self.recovered,
+            'alreadyWritten': self.already_written,
+            'droppedHidden': self.dropped_hidden,
+            'parked': len(self._parked),
+            'running': self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+        }
+
+    # ---------- Worker ----------
+
+    def _ensure_started(self, db):
+        # Arranque lazy por processo: a thread e o spool pertencem ao worker após o fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._db = db
+            self._queue = queue.Queue(maxsize=QUEUE_MAX_SIZE)
+            self._pending = OrderedDict()
+            self._overflow = deque()
+            self._conversations = {}
+            self._open_spool()
+            self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+        self._recover_orphan_spools()
+        atexit.register(self._shutdown)
+
+    def _run(self):
+        while not self._stopping or not self._queue.empty() or self._overflow:
+            self._retry_parked()
+            self._drain_overflow()
+            try:
+                first = self._queue.get(timeout=FLUSH_INTERVAL_SECONDS)
+            except queue.Empty:
+                continue
+            turns = [first]
+            # Esperar um pouco para juntar rajadas no mesmo batch
+            deadline = time.monotonic() + FLUSH_INTERVAL_SECONDS
+            while len(turns) < BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    turns.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(turns)
+
+    def _retry_parked(self):
+        # Voltar a pôr na fila os turnos parked, com um intervalo longo entre tentativas
+        if self._stopping or not self._parked or time.monotonic() < self._parked_retry_at:
+            return
+        with self._lock:
+            turns = list(self._parked.values())
+            self._parked.clear()
+            now = time.monotonic()
+            self._parked_retry_at = now + PARKED_RETRY_SECONDS
+            for turn in turns:
+                self._pending[turn['id']] = now
+                self._overflow.append(turn)
+        log.info("A tentar de novo %d chats que falharam", len(turns))
+
+    def _drain_overflow(self):
+        with self._lock:
+            while self._overflow:
+                try:
+                    self._queue.put_nowait(self._overflow[0])
+                except queue.Full:
+                    break
+                self._overflow.popleft()
+
+    def _commit(self, turns):
+        batch_turns = [dict(turn, timestamp=datetime.fromisoformat(turn['timestamp'])) for turn in turns]
+        ids = [turn['id'] for turn in turns]
+        committed = False
+        attempt = 1
+        while True:
+            try:
+                if batch_turns:
+                    with metrics.stage('firestore_save'):
+                        dropped = commit_turns(self._db, batch_turns)
+                    self.written += len(batch_turns) - len(dropped)
+                    self.dropped_hidden += len(dropped)
+                self._spool_append({'op': 'done', 'ids': ids})
+                committed = True
+                break
+            except Exception as e:
+                existing = self._existing_ids(batch_turns) if isinstance(e, AlreadyExists) else set()
+                if existing:
+                    # Turnos já gravados (replay do spool): o batch foi recusado inteiro,
+                    # gravar só os que faltam sem voltar a contar os outros
+                    self.already_written += len(existing)
+                    batch_turns = [turn for turn in batch_turns if turn['id'] not in existing]
+                    continue
+                if attempt == MAX_ATTEMPTS or (self._stopping and attempt >= 2):
+                    # Os turnos ficam no spool e são recuperados no próximo arranque
+                    self.failed += len(turns)
+                    log.error("Error saving %d chats to Firestore (kept in spool): %s", len(turns), e)
+                    break
+                self.retries += 1
+                backoff = min(0.5 * (2 ** (attempt - 1)), MAX_BACKOFF_SECONDS)
+                log.warning("Erro ao gravar chats (tentativa %d), nova tentativa em %.1fs: %s", attempt, backoff, e)
+                time.sleep(backoff)
+                attempt += 1
+
+        with self._lock:
+            for chat_id in ids:
+                self._pending.pop(chat_id, None)
+            if committed:
+                self._untrack(turns)
+            else:
+                if not self._parked:
+                    self._parked_retry_at = time.monotonic() + PARKED_RETRY_SECONDS
+                self._parked.update((turn['id'], turn) for turn in turns)
+            # Sem turnos em curso, o spool só precisa dos que falharam (para o próximo arranque)
+            if not self._pending:
+                self._compact_spool(list(self._parked.values()))
+
+    def _track(self, turn):
+        # Chamado com o lock
+        self._conversations.setdefault((turn['userId'], turn['persona']), OrderedDict())[turn['id']] = turn
+
+    def _untrack(self, turns):
+        # Chamado com o lock
+        for turn in turns:
+            key = (turn['userId'], turn['persona'])
+            conversation = self._conversations.get(key)
+            if conversation is not None:
+                conversation.pop(turn['id'], None)
+                if not conversation:
+                    del self._conversations[key]
+
+    def _existing_ids(self, turns):
+        try:
+            refs = [self._db.collection('chats').document(turn['id']) for turn in turns]
+            return {snapshot.id for snapshot in self._db.get_all(refs) if snapshot.exists}
+        except Exception as e:
+            log.warning("Erro ao verificar chats já gravados: %s", e)
+            return set()
+
+    def _shutdown(self):
+        if self._pid != os.getpid():
+            return
+        self._stopping = True
+        if not self.flush():
+            log.warning("Chat writer terminou com %d turnos no spool", self.stats()['depth'])
+            return
+        # Tudo gravado: o spool vazio já não é preciso
+        with self._lock:
+            if self._spool and not self._parked:
+                try:
+                    self._spool.close()
+                    os.remove(self._spool_path)
+                except Exception:
+                    pass
+                self._spool = None
+
+    # ---------- Spool em disco ----------
+
+    def _open_spool(self):
+        try:
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            # O timestamp evita reutilizar o spool de um processo antigo com o mesmo pid
+            self._spool_path = os.path.join(SPOOL_DIR, f"chat-turns-{os.getpid()}-{int(time.time() * 1000)}.jsonl")
+            self._spool = open(self._spool_path, 'a', encoding='utf-8')
+            # O lock mantém-se enquanto o processo estiver vivo
+            fcntl.flock(self._spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except Exception as e:
+            log.warning("Spool de chats indisponível (sem recuperação após restart): %s", e)
+            self._spool = None
+
+    def _spool_append(self, record):
+        if not self._spool:
+            return
+        try:
+            with self._spool_lock:
+                self._spool.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._spool.flush()
+        except Exception as e:
+            log.warning("Erro ao escrever no spool de chats: %s", e)
+
+    def _compact_spool(self, keep=()):
+        if not self._spool:
+            return
+        try:
+            with self._spool_lock:
+                self._spool.truncate(0)
+                self._spool.seek(0)
+                for turn in keep:
+                    self._spool.write(json.dumps({'op': 'turn', 'turn': turn}, ensure_ascii=False) + "\n")
+                self._spool.flush()
+        except Exception as e:
+            log.warning("Erro ao compactar spool de chats: %s", e)
+
+    def _recover_orphan_spools(self):
+        """Voltar a enfileirar turnos pendentes de workers que já terminaram"""
+        for path in glob.glob(os.path.join(SPOOL_DIR, "chat-turns-*.jsonl")):
+            if path == self._spool_path:
+                continue
+            try:
+                with open(path, 'r+', encoding='utf-8') as spool:
+                    try:
+                        fcntl.flock(spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # Outro worker vivo ainda é dono deste spool
+                    if os.fstat(spool.fileno()).st_ino != os.stat(path).st_ino:
+                        continue  # Já recuperado e apagado por outro worker enquanto esperávamos
+                    turns = OrderedDict()
+                    for line in spool:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue  # Linha incompleta (processo morreu a meio da escrita)
+                        if record.get('op') == 'turn':
+                            turns[record['turn']['id']] = record['turn']
+                        elif record.get('op') == 'done':
+                            for chat_id in record.get('ids', []):
+                                turns.pop(chat_id, None)
+                    for turn in turns.values():
+                        with self._lock:
+                            self._spool_append({'op': 'turn', 'turn': turn})
+                            self._pending[turn['id']] = time.monotonic()
+                            self._track(turn)
+                        self._queue.put(turn)
+                    self.recovered += len(turns)
+                    # Apagar ainda com o lock: outro worker não pode ler o ficheiro já recuperado
+                    os.remove(path)
+                if turns:
+                    log.info("Recuperados %d chats do spool %s", len(turns), os.path.basename(path))
+            except FileNotFoundError:
+                continue  # Já recuperado por outro worker
+            except Exception as e:
+                log.warning("Erro ao recuperar spool %s: %s", path, e)
+
+
+chat_writer = ChatWriter()
@@ -0,0 +1,121 @@
+"""Clientes do Firestore, Gemini e Stripe, criados quando são precisos e um por processo.
+
+O app.py criava os clientes ao ser importado. Cada worker do gunicorn pagava
+esse custo no arranque, e com `--preload` os canais gRPC do Firestore e as
+ligações HTTP eram criados no master e herdados pelos workers no fork. Aqui
+cada cliente é criado na primeira utilização e guardado com o pid. Um processo
+filho que herde um cliente do pai cria o seu.
+
+`boot_timings` guarda quanto tempo demorou cada cliente a ser criado neste
+processo (aparece no `/api/v1/admin/boot`).
+"""
+import os
+import json
+import threading
+import time
+import firebase_admin
+from firebase_admin import credentials
+from google.cloud import firestore as gcloud_firestore
+from google import genai
+import stripe
+from logs import get_logger
+
+log = get_logger('clients')
+
+_lock = threading.Lock()
+_clients = {}  # nome -> (pid, cliente)
+
+boot_timings = {}
+
+
+def _per_process(name, factory):
+    entry = _clients.get(name)
+    if entry and entry[0] == os.getpid():
+        return entry[1]
+    with _lock:
+        entry = _clients.get(name)
+        if entry and entry[0] == os.getpid():
+            return entry[1]
+        started = time.perf_counter()
+        value = factory()
+        boot_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+        _clients[name] = (os.getpid(), value)
+        return value
+
+
+def _firebase_app():
+    """App do firebase_admin (credenciais por variável de ambiente ou ficheiro)"""
+    if firebase_admin._apps:
+        return firebase_admin.get_app()
+
+    # Prioridade 1: Tentar usar variáveis de ambiente primeiro (mais seguro para produção)
+    firebase_creds_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
+    if firebase_creds_json:
+        try:
+            cred = credentials.Certificate(json.loads(firebase_creds_json))
+            fb_app = firebase_admin.initialize_app(cred)
+            log.info("Firebase initialized from environment variable")
+            return fb_app
+        except Exception as e:
+            log.error("Error initializing Firebase from env variable: %s", e)
+
+    # Prioridade 2: Se variável de ambiente não funcionou, tentar arquivo
+    firebase_config_path = os.getenv("FIREBASE_CONFIG_PATH", "luna_config.json")
+    if os.path.exists(firebase_config_path) and os.path.getsize(firebase_config_path) > 0:
+        try:
+            fb_app = firebase_admin.initialize_app(credentials.Certificate(firebase_config_path))
+            log.info("Firebase initialized from config file")
+            return fb_app
+        except Exception as e:
+            log.error("Error initializing Firebase from file: %s", e)
+    elif firebase_config_path == "luna_config.json":
+        log.warning("luna_config.json not found")
+
+    log.critical("Firebase could not be initialized! Configure FIREBASE_CREDENTIALS_JSON "
+                 "environment variable or upload luna_config.json")
+    return None
+
+
+def _create_firestore():
+    fb_app = _firebase_app()
+    if fb_app is None:
+        return None
+    # Cliente novo em cada processo (o `firestore.client()` do firebase_admin é
+    # partilhado pela app e, depois de um fork, traria o canal gRPC do pai)
+    return gcloud_firestore.Client(project=fb_app.project_id, credentials=fb_app.credential.get_credential())
+
+
+def _create_gemini():
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        log.warning("GEMINI_API_KEY not set")
+        return None
+    try:
+        gemini = genai.Client(api_key=api_key)
+        log.info("Gemini client initialized")
+        return gemini
+    except Exception as e:
+        log.error("Error initializing Gemini client: %s", e)
+        return None
+
+
+def _configure_stripe():
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    # O cliente HTTP do Stripe (sessão requests) é criado de novo neste processo
+    stripe.default_http_client = None
+    return bool(stripe.api_key)
+
+
+def get_db():
+    """Cliente Firestore deste processo (ou None se o Firebase não estiver configurado)"""
+    return _per_process('firestore', _create_firestore)
+
+
+def get_gemini_client():
+    """Cliente Gemini deste processo (ou None sem GEMINI_API_KEY)"""
+    return _per_process('gemini', _create_gemini)
+
+
+def configure_stripe():
+    """Configurar o Stripe neste processo -> True se houver chave"""
+    return _per_process('stripe', _configure_stripe)
@@ -0,0 +1,195 @@
+"""Contexto multi-turno com orçamento fixo de tokens.
+
+O prompt leva as mensagens mais recentes da conversa até um orçamento de tokens
+(`CONTEXT_TOKEN_BUDGET`) e um resumo das mensagens mais antigas. O resumo fica em
+`conversation_summaries/{userId}__{persona}` e só é refeito em background quando
+já há `SUMMARY_REFRESH_EVERY` mensagens novas fora da janela recente, por isso o
+tamanho do prompt (e a latência/custo) não cresce com a conversa.
+"""
+import os
+import threading
+from datetime import datetime, timezone
+from firebase_admin import firestore
+from counters import get_counter
+from helpers import ProcessExecutor
+from history import fetch_history_page
+from history_cache import history_cache
+from utils import VALID_PERSONAS
+from logs import get_logger, fields
+
+log = get_logger('context')
+
+SUMMARIES_COLLECTION = 'conversation_summaries'
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "250"))
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "20"))
+SUMMARY_REFRESH_EVERY = int(os.getenv("SUMMARY_REFRESH_EVERY", "20"))
+# Máximo de mensagens lidas de uma vez para atualizar o resumo
+SUMMARY_FOLD_BATCH = 200
+# Abaixo disto um turno cortado já não diz nada: fica de fora
+MIN_TRUNCATED_TURN_TOKENS = 20
+
+_executor = ProcessExecutor(2, 'summaries')
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    """Estimativa barata (~4 caracteres por token), sem chamar a API"""
+    return len(text or '') // 4 + 1
+
+
+def _truncate_to_tokens(text, max_tokens):
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(' ', 1)[0] + '...'
+
+
+def summary_ref(db, user_id, persona):
+    return db.collection(SUMMARIES_COLLECTION).document(f"{user_id}__{persona}")
+
+
+def load_conversation(db, user_id, persona):
+    """Contador da conversa e as mensagens mais recentes (do cache se possível).
+
+    Devolve (counter, turns) com os turnos por ordem cronológica.
+    """
+    counter = get_counter(db, user_id, persona)
+    if counter['messageCount'] <= 0:
+        return counter, []
+    page = history_cache.get_page(user_id, persona, CONTEXT_MAX_TURNS, counter['version'], counter['hiddenBefore'])
+    if page:
+        return counter, page[0]
+    turns, has_more = fetch_history_page(db, user_id, persona, CONTEXT_MAX_TURNS,
+                                         hidden_before=counter['hiddenBefore'])
+    history_cache.store(user_id, persona, turns, has_more, counter['version'])
+    return counter, turns
+
+
+def load_summary(db, user_id, persona):
+    snapshot = summary_ref(db, user_id, persona).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+def clear_summaries(db, user_id, persona=None):
+    """Apagar os resumos quando o histórico é apagado"""
+    personas = [persona] if persona else VALID_PERSONAS
+    batch = db.batch()
+    for name in personas:
+        batch.delete(summary_ref(db, user_id, name))
+    batch.commit()
+
+
+def build_history_context(turns, summary, budget=CONTEXT_TOKEN_BUDGET):
+    """Texto com o resumo e as mensagens recentes que cabem no orçamento.
+
+    Devolve (texto, turnos_incluidos, tokens_estimados).
+    """
+    used = 0
+    sections = []
+    summary_text = (summary or {}).get('summary')
+    if summary_text:
+        summary_text = _truncate_to_tokens(summary_text, SUMMARY_MAX_TOKENS)
+        sections.append(f"Summary of your earlier conversation:\n{summary_text}")
+        used += estimate_tokens(summary_text)
+
+    # Do mais recente para o mais antigo, até esgotar o orçamento. O turno que já
+    # não cabe inteiro entra cortado ao que resta (mensagem e resposta a meias)
+    lines = []
+    for turn in reversed(turns):
+        message, reply = turn.get('message', ''), turn.get('reply', '')
+        entry = f"User: {message}\nLuna: {reply}"
+        cost = estimate_tokens(entry)
+        if used + cost > budget:
+            half = (budget - used - estimate_tokens("User: \nLuna: ...")) // 2
+            if half < MIN_TRUNCATED_TURN_TOKENS // 2:
+                break
+            entry = f"User: {_truncate_to_tokens(message, half)}\nLuna: {_truncate_to_tokens(reply, half)}"
+            cost = estimate_tokens(entry)
+            if used + cost > budget:
+                break
+            lines.append(entry)
+            used += cost
+            break
+        lines.append(entry)
+        used += cost
+    lines.reverse()
+    if lines:
+        sections.append("Recent messages:\n" + "\n".join(lines))
+
+    return "\n\n".join(sections), len(lines), used
+
+
+def summary_is_due(counter, summary, turns_in_context):
+    """O resumo só é refeito quando há mensagens suficientes fora da janela recente"""
+    summarized = (summary or {}).get('summarizedCount', 0)
+    outside_window = counter['messageCount'] - turns_in_context - summarized
+    return outside_window >= SUMMARY_REFRESH_EVERY
+
+
+def schedule_summary_refresh(db, generate, user_id, persona, keep_recent):
+    """Atualizar o resumo em background (no máximo um por conversa de cada vez).
+
+    `generate(prompt)` deve devolver o texto gerado pelo modelo.
+    """
+    key = (user_id, persona)
+    with _lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+        executor = _executor.get()
+    executor.submit(_refresh_summary, db, generate, user_id, persona, keep_recent)
+
+
+def _refresh_summary(db, generate, user_id, persona, keep_recent):
+    key = (user_id, persona)
+    try:
+        summary = load_summary(db, user_id, persona) or {}
+        since = summary.get('summarizedThrough')
+        # Mensagens escondidas por um pedido de apagar histórico não entram no resumo
+        hidden_before = get_counter(db, user_id, persona)['hiddenBefore']
+        if hidden_before and (not since or since < hidden_before):
+            since = hidden_before
+        query = db.collection('chats')\
+            .where(filter=firestore.FieldFilter('userId', '==', user_id))\
+            .where(filter=firestore.FieldFilter('persona', '==', persona))
+        if since:
+            query = query.where(filter=firestore.FieldFilter('timestamp', '>', since))
+        docs = list(query.order_by('timestamp').limit(SUMMARY_FOLD_BATCH + keep_recent).stream())
+        # As mensagens ainda na janela recente vão no prompt por inteiro, não no resumo
+        to_fold = [doc.to_dict() for doc in docs[:max(0, len(docs) - keep_recent)]]
+        if not to_fold:
+            return
+
+        transcript = "\n".join(f"User: {turn.get('message', '')}\nLuna: {turn.get('reply', '')}" for turn in to_fold)
+        prompt = f"""You maintain a short memory of a chat between a user and Luna.
+Update the summary with the new messages. Keep names, facts the user shared, preferences, plans and the emotional tone.
+Write at most {SUMMARY_MAX_TOKENS * 3 // 4} words, in the same language as the conversation.
+
+Current summary:
+{summary.get('summary') or '(none)'}
+
+New messages:
+{transcript}
+
+Updated summary:"""
+        new_summary = (generate(prompt) or '').strip()
+        if not new_summary:
+            return
+
+        summary_ref(db, user_id, persona).set({
+            'userId': user_id,
+            'persona': persona,
+            'summary': _truncate_to_tokens(new_summary, SUMMARY_MAX_TOKENS),
+            'summarizedThrough': to_fold[-1].get('timestamp'),
+            'summarizedCount': summary.get('summarizedCount', 0) + len(to_fold),
+            'updatedAt': datetime.now(timezone.utc)
+        })
+        log.info("Resumo atualizado: +%d mensagens", len(to_fold), extra=fields(userId=user_id, persona=persona))
+    except Exception as e:
+        log.warning("Erro ao atualizar resumo da conversa: %s", e, extra=fields(userId=user_id, persona=persona))
+    finally:
+        with _lock:
+            _refreshing.discard(key)
@@ -0,0 +1,203 @@
+"""Contadores materializados de mensagens por utilizador e persona.
+
+Cada par (userId, persona) tem um documento em `chat_counters` com o número de
+mensagens trocadas. O contador é atualizado no mesmo batch que grava o chat,
+por isso o `chat()` só precisa de ler um documento para saber o contexto.
+"""
+import sys
+from datetime import datetime, timezone
+from firebase_admin import firestore
+from utils import VALID_PERSONAS
+
+COUNTERS_COLLECTION = 'chat_counters'
+
+
+def counter_ref(db, user_id, persona):
+    """Referência do documento contador para (userId, persona)"""
+    return db.collection(COUNTERS_COLLECTION).document(f"{user_id}__{persona}")
+
+
+def get_counter(db, user_id, persona):
+    """Documento contador (messageCount, version, lastMessageAt, hiddenBefore) - 1 leitura.
+
+    `version` muda sempre que a conversa muda (mensagem nova ou apagada), por
+    isso serve de watermark para o histórico. Mensagens com timestamp <=
+    `hiddenBefore` estão a ser apagadas e não devem ser mostradas.
+    """
+    snapshot = counter_ref(db, user_id, persona).get()
+    data = snapshot.to_dict() if snapshot.exists else {}
+    return {
+        'messageCount': data.get('messageCount', 0) or 0,
+        'version': data.get('version', 0) or 0,
+        'lastMessageAt': data.get('lastMessageAt'),
+        'hiddenBefore': data.get('hiddenBefore')
+    }
+
+
+def get_message_count(db, user_id, persona):
+    """Número de mensagens trocadas com a persona (1 leitura)"""
+    return get_counter(db, user_id, persona)['messageCount']
+
+
+def add_turns_to_batch(db, batch, turns):
+    """Adicionar turnos (dicts com id, userId, persona, message, reply, timestamp)
+    a um batch, com um único incremento por contador.
+
+    Os documentos em `chats` são criados com `create` (falha com AlreadyExists se
+    o id já existir). Como o batch é atómico, voltar a gravar um turno já gravado
+    é recusado por inteiro e o contador nunca é incrementado duas vezes.
+    """
+    increments = {}
+    for turn in turns:
+        batch.create(db.collection('chats').document(turn['id']), {
+            'userId': turn['userId'],
+            'persona': turn['persona'],
+            'message': turn['message'],
+            'reply': turn['reply'],
+            'timestamp': turn['timestamp']
+        })
+        key = (turn['userId'], turn['persona'])
+        count, last = increments.get(key, (0, None))
+        if last is None or turn['timestamp'] > last:
+            last = turn['timestamp']
+        increments[key] = (count + 1, last)
+
+    for (user_id, persona), (count, last) in increments.items():
+        batch.set(counter_ref(db, user_id, persona), {
+            'userId': user_id,
+            'persona': persona,
+            'messageCount': firestore.Increment(count),
+            # Um por turno, a mesma unidade do HistoryCache.append (que soma 1 por turno)
+            'version': firestore.Increment(count),
+            'lastMessageAt': last
+        }, merge=True)
+
+
+@firestore.transactional
+def _commit_turns_in_transaction(transaction, db, turns):
+    refs = [counter_ref(db, user_id, persona) for user_id, persona in {(t['userId'], t['persona']) for t in turns}]
+    hidden = {}
+    for snapshot in db.get_all(refs, transaction=transaction):
+        if snapshot.exists and (snapshot.to_dict() or {}).get('hiddenBefore'):
+            hidden[snapshot.id] = snapshot.get('hiddenBefore')
+    kept, dropped = [], []
+    for turn in turns:
+        hidden_before = hidden.get(f"{turn['userId']}__{turn['persona']}")
+        (dropped if hidden_before and turn['timestamp'] <= hidden_before else kept).append(turn)
+    if kept:
+        add_turns_to_batch(db, transaction, kept)
+    return [turn['id'] for turn in dropped]
+
+
+def commit_turns(db, turns):
+    """Gravar turnos numa transação que lê o `hiddenBefore` dos contadores.
+
+    Turnos com timestamp <= `hiddenBefore` pertencem a um histórico que o
+    utilizador mandou apagar (ex.: estavam na fila de escrita ou num spool
+    quando o job de apagar começou) e não são gravados. Devolve os ids
+    descartados.
+    """
+    return _commit_turns_in_transaction(db.transaction(), db, turns)
+
+
+def save_chat_turn(db, user_id, persona, message, reply):
+    """Guardar o turno em `chats` e incrementar o contador de forma atómica"""
+    batch = db.batch()
+    chat_id = db.collection('chats').document().id
+    add_turns_to_batch(db, batch, [{
+        'id': chat_id,
+        'userId': user_id,
+        'persona': persona,
+        'message': message,
+        'reply': reply,
+        'timestamp': datetime.now(timezone.utc)
+    }])
+    batch.commit()
+    return chat_id
+
+
+@firestore.transactional
+def _recount_in_transaction(transaction, db, user_id, persona):
+    query = db.collection('chats')\
+        .where(filter=firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.FieldFilter('persona', '==', persona))
+    result = query.count(alias='messages').get(transaction=transaction)
+    count = int(result[0][0].value)
+    transaction.set(counter_ref(db, user_id, persona), {
+        'userId': user_id,
+        'persona': persona,
+        'messageCount': count,
+        'version': firestore.Increment(1)
+    }, merge=True)
+    return count
+
+
+def recount_counters(db, user_id, personas):
+    """Recalcular `messageCount` das personas com uma agregação count() -> {persona: contagem}.
+
+    Ao contrário de descontar as mensagens apagadas, pode repetir-se sem errar
+    o contador (ex.: um job de apagar retomado por outro worker).
+    """
+    return {persona: _recount_in_transaction(db.transaction(), db, user_id, persona)
+            for persona in personas if persona in VALID_PERSONAS}
+
+
+def backfill_counters(db, user_id=None):
+    """Recalcular os contadores a partir da coleção `chats`.
+
+    Se `user_id` for passado, só recalcula esse utilizador. Devolve o número de
+    contadores escritos.
+    """
+    query = db.collection('chats')
+    if user_id:
+        query = query.where(filter=firestore.FieldFilter('userId', '==', user_id))
+
+    totals = {}
+    for doc in query.stream():
+        data = doc.to_dict()
+        key = (data.get('userId'), data.get('persona'))
+        if not key[0] or key[1] not in VALID_PERSONAS:
+            continue
+        entry = totals.setdefault(key, {'messageCount': 0, 'lastMessageAt': None})
+        entry['messageCount'] += 1
+        timestamp = data.get('timestamp')
+        if timestamp and (entry['lastMessageAt'] is None or timestamp > entry['lastMessageAt']):
+            entry['lastMessageAt'] = timestamp
+
+    batch = db.batch()
+    written = 0
+    for (uid, persona), entry in totals.items():
+        batch.set(counter_ref(db, uid, persona), {
+            'userId': uid,
+            'persona': persona,
+            'messageCount': entry['messageCount'],
+            'version': firestore.Increment(1),
+            'lastMessageAt': entry['lastMessageAt']
+        }, merge=True)
+        written += 1
+        # Firestore batch limit is 500
+        if written % 400 == 0:
+            batch.commit()
+            batch = db.batch()
+    if written % 400 != 0:
+        batch.commit()
+    return written
+
+
+if __name__ == '__main__':
+    # Uso: python counters.py backfill [userId]
+    if len(sys.argv) < 2 or sys.argv[1] != 'backfill':
+        print("Uso: python counters.py backfill [userId]")
+        sys.exit(1)
+
+    from dotenv import load_dotenv
+    from clients import get_db
+    load_dotenv()
+    db = get_db()
+    if not db:
+        print("❌ Firebase não configurado")
+        sys.exit(1)
+
+    target_user = sys.argv[2] if len(sys.argv) > 2 else None
+    total = backfill_counters(db, target_user)
+    print(f"✅ {total} contadores recalculados")
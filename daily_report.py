@@ -0,0 +1,183 @@
+"""Métricas do relatório diário (novos utilizadores, mensagens e subscrições).
+
+As fontes são lidas ao mesmo tempo, cada uma com o seu timeout:
+
+- Rollups (`stats/{yyyy-mm-dd-hh}`, ver rollups.py): quando cobrem o dia inteiro,
+  as mensagens, subscrições e limites atingidos vêm daqui, com 24 leituras.
+- Firestore (sem rollups para o dia): `count()` de agregação sobre `chats` no intervalo do dia, calculado
+  no servidor (uma leitura por cada 1000 documentos contados, sem os transferir).
+- Stripe (sem rollups para o dia): listagem com auto-paginação, por isso já não pára nas 100 primeiras.
+- Firebase Auth: não tem contagem nem filtro por data de criação, por isso
+  continua a ser uma listagem completa; se o timeout chegar a meio, o valor é
+  parcial e aparece como "N+".
+
+O relatório inclui quanto tempo demorou cada fonte.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+from firebase_admin import auth, firestore
+import stripe
+from helpers import timed
+from rollups import rollups_since, load_rollups, merge_rollups
+from logs import get_logger
+
+log = get_logger('daily_report')
+
+AUTH_TIMEOUT_SECONDS = float(os.getenv("REPORT_AUTH_TIMEOUT", "60"))
+FIRESTORE_TIMEOUT_SECONDS = float(os.getenv("REPORT_FIRESTORE_TIMEOUT", "20"))
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("REPORT_STRIPE_TIMEOUT", "30"))
+
+ROLLUP_METRICS = ('messages_sent', 'new_subs', 'limit_hit_users')
+
+SOURCE_LABELS = {
+    'new_users': 'Auth',
+    'messages_sent': 'Firestore',
+    'new_subs': 'Stripe',
+    'rollups': 'Rollups'
+}
+
+
+class DailyMetrics:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.values = {}
+        self.errors = {}
+        self.timings = {}
+        self.total_ms = 0.0
+
+    def display(self, name):
+        """Valor para o relatório: número, "N+" se for parcial, ou "?" se falhou"""
+        if name not in self.values:
+            return "?"
+        count, partial = self.values[name]
+        return f"{count}+" if partial else count
+
+    def timings_summary(self):
+        parts = [f"{SOURCE_LABELS.get(name, name)} {ms / 1000:.1f}s" for name, ms in self.timings.items()]
+        return ", ".join(parts) + f" (total {self.total_ms / 1000:.1f}s)"
+
+
+def report_window(now=None):
+    """Início e fim do dia anterior (UTC)"""
+    now = now or datetime.now(timezone.utc)
+    yesterday = now - timedelta(days=1)
+    start = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
+    return start, end
+
+
+def count_new_users(start, end, deadline):
+    """Utilizadores do Firebase Auth criados no intervalo -> (contagem, parcial)"""
+    start_ms = start.timestamp() * 1000
+    end_ms = end.timestamp() * 1000
+    count = 0
+    for user in auth.list_users().iterate_all():
+        if time.monotonic() > deadline:
+            return count, True
+        # creation_timestamp is in milliseconds
+        if start_ms <= user.user_metadata.creation_timestamp <= end_ms:
+            count += 1
+    return count, False
+
+
+def count_messages(db, start, end, timeout):
+    """Mensagens no intervalo com uma agregação count() no Firestore -> (contagem, False)"""
+    query = db.collection('chats')\
+        .where(filter=firestore.FieldFilter('timestamp', '>=', start))\
+        .where(filter=firestore.FieldFilter('timestamp', '<=', end))
+    result = query.count(alias='messages').get(timeout=timeout)
+    return int(result[0][0].value), False
+
+
+def count_new_subscriptions(start, end, deadline):
+    """Subscrições do Stripe criadas no intervalo, com auto-paginação -> (contagem, parcial)"""
+    subs = stripe.Subscription.list(
+        created={'gte': int(start.timestamp()), 'lte': int(end.timestamp())},
+        limit=100
+    )
+    count = 0
+    for _ in subs.auto_paging_iter():
+        if time.monotonic() > deadline:
+            return count, True
+        count += 1
+    return count, False
+
+
+def read_rollups(db, start, end, timeout):
+    """Totais do dia a partir dos rollups horários -> {métrica: (contagem, False)}"""
+    totals = merge_rollups(load_rollups(db, start, end, timeout=timeout))
+    return {
+        'messages_sent': (totals.get('chatTurns', 0), False),
+        'new_subs': (totals.get('subscriptions', {}).get('created', 0), False),
+        'limit_hit_users': (totals.get('limitHitUsersDistinct', 0), False)
+    }
+
+
+def _rollups_cover(db, start):
+    try:
+        since = rollups_since(db)
+        return since is not None and since <= start
+    except Exception as e:
+        log.warning("Error reading rollups metadata: %s", e)
+        return False
+
+
+def _drop_values(metrics, name):
+    # Uma fonte que falhou aparece como "?" (os rollups fornecem várias métricas)
+    for metric in (ROLLUP_METRICS if name == 'rollups' else (name,)):
+        metrics.values.pop(metric, None)
+
+
+def collect_daily_metrics(db, now=None):
+    """Ler as fontes em paralelo, cada uma limitada pelo seu timeout"""
+    start, end = report_window(now)
+    metrics = DailyMetrics(start, end)
+    began = time.monotonic()
+
+    # As listagens param 1s antes do timeout para devolverem o valor parcial
+    timeouts = {'new_users': AUTH_TIMEOUT_SECONDS}
+    sources = {}
+    sources['new_users'] = lambda: count_new_users(start, end, began + AUTH_TIMEOUT_SECONDS - 1)
+    # Fontes não configuradas contam como 0, como antes
+    metrics.values = {'messages_sent': (0, False), 'new_subs': (0, False)}
+    if db and _rollups_cover(db, start):
+        # O(horas): mensagens e subscrições vêm dos rollups, sem Firestore count() nem Stripe
+        timeouts['rollups'] = FIRESTORE_TIMEOUT_SECONDS
+        sources['rollups'] = lambda: read_rollups(db, start, end, FIRESTORE_TIMEOUT_SECONDS)
+    elif db:
+        timeouts['messages_sent'] = FIRESTORE_TIMEOUT_SECONDS
+        sources['messages_sent'] = lambda: count_messages(db, start, end, FIRESTORE_TIMEOUT_SECONDS)
+    if stripe.api_key and 'rollups' not in sources:
+        timeouts['new_subs'] = STRIPE_TIMEOUT_SECONDS
+        sources['new_subs'] = lambda: count_new_subscriptions(start, end, began + STRIPE_TIMEOUT_SECONDS - 1)
+
+    # Executor próprio: uma fonte lenta não ocupa as threads do pre-flight do chat
+    executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='daily-report')
+    futures = {name: executor.submit(timed, fn) for name, fn in sources.items()}
+    for name, future in futures.items():
+        remaining = max(0.0, began + timeouts[name] - time.monotonic())
+        try:
+            value, error, elapsed_ms = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            _drop_values(metrics, name)
+            metrics.errors[name] = TimeoutError(f"{SOURCE_LABELS[name]} timed out after {timeouts[name]:.0f}s")
+            metrics.timings[name] = timeouts[name] * 1000
+            continue
+        metrics.timings[name] = elapsed_ms
+        if error is not None:
+            _drop_values(metrics, name)
+            metrics.errors[name] = error
+        elif name == 'rollups':
+            metrics.values.update(value)
+        else:
+            metrics.values[name] = value
+    # Não esperar por fontes que passaram do timeout
+    executor.shutdown(wait=False)
+
+    metrics.total_ms = (time.monotonic() - began) * 1000
+    for name, error in metrics.errors.items():
+        log.warning("Error collecting %s metrics: %s", SOURCE_LABELS[name], error)
+    return metrics
@@ -0,0 +1,333 @@
+"""Jobs em background para apagar o histórico de conversas.
+
+O `DELETE /api/v1/chat/history` apagava tudo dentro do pedido HTTP e, para
+utilizadores com muitas mensagens, chegava ao timeout do gunicorn a meio. Agora
+o endpoint cria um documento em `delete_jobs` e devolve o id; o job corre numa
+thread do worker e apaga as mensagens com o `BulkWriter` do Firestore (deletes
+em paralelo, com limite de operações por segundo).
+
+As mensagens ficam escondidas logo na criação do job: o contador de cada
+conversa afetada recebe `hiddenBefore` (instante do pedido) e o histórico e o
+contexto do Gemini ignoram mensagens com timestamp <= `hiddenBefore`. Mensagens
+enviadas depois do pedido não são apagadas.
+
+Cada job tem um lease renovado por uma thread de heartbeat enquanto o job corre
+(como no job_lease.py). Se o worker morrer, o lease expira e outro worker retoma
+o job (o varrimento corre em background em todos os workers); como só são
+apagadas mensagens que ainda existem, retomar é seguro. No fim, o `messageCount`
+de cada conversa é recalculado com um count() em vez de descontado por bloco,
+por isso um bloco apagado duas vezes não desconta duas vezes. Turnos anteriores
+ao pedido que ainda estavam na fila de escrita (ou num spool) são descartados pelo
+chat_writer ao ler o `hiddenBefore`, por isso não aparecem depois da varredura.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+from firebase_admin import firestore
+from counters import counter_ref, recount_counters
+from helpers import ProcessExecutor, iso, utc_now
+from job_lease import LeaseLost
+from utils import VALID_PERSONAS
+from logs import get_logger, fields
+
+log = get_logger('delete_jobs')
+
+JOBS_COLLECTION = 'delete_jobs'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Documentos lidos e apagados de cada vez (o progresso é gravado por bloco)
+CHUNK_SIZE = 500
+DELETE_MAX_OPS_PER_SECOND = int(os.getenv("DELETE_MAX_OPS_PER_SECOND", "500"))
+LEASE_SECONDS = 60
+SWEEP_INTERVAL_SECONDS = 30
+MAX_ATTEMPTS = 5
+
+
+def job_ref(db, job_id):
+    return db.collection(JOBS_COLLECTION).document(job_id)
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def serialize_job(job_id, data):
+    """Estado público de um job (para o endpoint de estado)"""
+    return {
+        'jobId': job_id,
+        'userId': data.get('userId'),
+        'persona': data.get('persona'),
+        'status': data.get('status'),
+        'deleted': data.get('deleted', 0),
+        'deletedByPersona': data.get('deletedByPersona', {}),
+        'attempts': data.get('attempts', 0),
+        'error': data.get('error'),
+        'cutoff': iso(data.get('cutoff')),
+        'createdAt': iso(data.get('createdAt')),
+        'updatedAt': iso(data.get('updatedAt')),
+        'finishedAt': iso(data.get('finishedAt'))
+    }
+
+
+@firestore.transactional
+def _claim_in_transaction(transaction, ref, owner, now):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    data = snapshot.to_dict()
+    if data.get('status') not in (PENDING, RUNNING):
+        return None
+    lease_until = data.get('leaseUntil')
+    if lease_until and lease_until.timestamp() > now.timestamp():
+        return None  # Outro worker está a tratar deste job
+    transaction.update(ref, {
+        'status': RUNNING,
+        'owner': owner,
+        'leaseUntil': datetime.fromtimestamp(now.timestamp() + LEASE_SECONDS, timezone.utc),
+        'updatedAt': now
+    })
+    return data
+
+
+@firestore.transactional
+def _renew_in_transaction(transaction, ref, owner):
+    snapshot = ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    if data.get('owner') != owner or data.get('status') != RUNNING:
+        raise LeaseLost(f"Lease do job de apagar {ref.id} perdido")
+    transaction.update(ref, {
+        'leaseUntil': datetime.fromtimestamp(time.time() + LEASE_SECONDS, timezone.utc)
+    })
+
+
+def _heartbeat(db, ref, owner, stop, lost):
+    while not stop.wait(LEASE_SECONDS / 3):
+        try:
+            _renew_in_transaction(db.transaction(), ref, owner)
+        except LeaseLost as e:
+            log.warning("%s", e, extra=fields(jobId=ref.id))
+            lost.set()
+            return
+        except Exception as e:
+            log.warning("Erro ao renovar lease do job de apagar %s: %s", ref.id, e, extra=fields(jobId=ref.id))
+
+
+class DeleteJobRunner:
+    def __init__(self):
+        self._db = None
+        self._executor = ProcessExecutor(2, 'delete-jobs')
+        self._pid = None
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def attach(self, db):
+        """Ativar o varrimento de jobs órfãos (de workers que morreram)"""
+        self._db = db
+        self._ensure_started()
+
+    def create_job(self, db, user_id, persona=None):
+        """Criar o job, esconder as mensagens de imediato e começar a apagar.
+
+        Devolve o id do job.
+        """
+        self._db = self._db or db
+        job_id = uuid.uuid4().hex
+        now = utc_now()
+        batch = db.batch()
+        batch.set(job_ref(db, job_id), {
+            'userId': user_id,
+            'persona': persona,
+            'status': PENDING,
+            'cutoff': now,
+            'deleted': 0,
+            'deletedByPersona': {},
+            'attempts': 0,
+            'leaseUntil': None,
+            'createdAt': now,
+            'updatedAt': now
+        })
+        # Esconder as mensagens até ao instante do pedido (e invalidar ETags/caches)
+        for name in ([persona] if persona else VALID_PERSONAS):
+            batch.set(counter_ref(db, user_id, name), {
+                'userId': user_id,
+                'persona': name,
+                'hiddenBefore': now,
+                'version': firestore.Increment(1)
+            }, merge=True)
+        batch.commit()
+        self._submit(job_id)
+        return job_id
+
+    def get_job(self, db, job_id):
+        snapshot = job_ref(db, job_id).get()
+        return serialize_job(job_id, snapshot.to_dict()) if snapshot.exists else None
+
+    # ---------- Execução ----------
+
+    def _ensure_started(self):
+        # Thread de varrimento por processo (fork-safe)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._active = set()
+            self._pid = os.getpid()
+            threading.Thread(target=self._sweep_loop, name='delete-jobs-sweep', daemon=True).start()
+
+    def _submit(self, job_id):
+        self._ensure_started()
+        with self._lock:
+            if job_id in self._active:
+                return
+            self._active.add(job_id)
+        self._executor.submit(self._run, job_id)
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL_SECONDS)
+            if self._pid != os.getpid():
+                return
+            try:
+                self._resume_orphans()
+            except Exception as e:
+                log.warning("Erro ao procurar jobs de apagar pendentes: %s", e)
+
+    def _resume_orphans(self):
+        if not self._db:
+            return
+        now = utc_now().timestamp()
+        docs = self._db.collection(JOBS_COLLECTION)\
+            .where(filter=firestore.FieldFilter('status', 'in', [PENDING, RUNNING]))\
+            .limit(50)\
+            .stream()
+        for doc in docs:
+            lease_until = doc.to_dict().get('leaseUntil')
+            if not lease_until or lease_until.timestamp() <= now:
+                self._submit(doc.id)
+
+    def _run(self, job_id):
+        db = self._db
+        ref = job_ref(db, job_id)
+        owner = _owner()
+        stop, lost = threading.Event(), threading.Event()
+        try:
+            job = _claim_in_transaction(db.transaction(), ref, owner, utc_now())
+            if job is None:
+                return
+            log.info("Job de apagar %s a correr", job_id,
+                     extra=fields(jobId=job_id, userId=job['userId'], persona=job.get('persona') or 'todas'))
+            threading.Thread(target=_heartbeat, args=(db, ref, owner, stop, lost),
+                             name='delete-jobs-lease', daemon=True).start()
+            deleted = self._delete_messages(db, ref, job, lost)
+            # Manter os contadores materializados em sincronia (contagem das mensagens que restam)
+            recount_counters(db, job['userId'], [job['persona']] if job.get('persona') else VALID_PERSONAS)
+            ref.update({
+                'status': DONE,
+                'leaseUntil': None,
+                'error': None,
+                'updatedAt': utc_now(),
+                'finishedAt': utc_now()
+            })
+            log.info("Job de apagar %s concluído: %d mensagens", job_id, deleted, extra=fields(jobId=job_id))
+        except LeaseLost as e:
+            # Outro worker ficou com o job: é ele que o termina
+            log.warning("Job de apagar %s interrompido: %s", job_id, e, extra=fields(jobId=job_id))
+        except Exception as e:
+            log.error("Erro no job de apagar %s: %s", job_id, e, extra=fields(jobId=job_id))
+            try:
+                attempts = (ref.get().to_dict() or {}).get('attempts', 0) + 1
+                # O lease expira e o varrimento volta a tentar, até MAX_ATTEMPTS
+                ref.update({
+                    'status': FAILED if attempts >= MAX_ATTEMPTS else PENDING,
+                    'attempts': attempts,
+                    'error': str(e),
+                    'leaseUntil': datetime.fromtimestamp(time.time() + LEASE_SECONDS * attempts, timezone.utc),
+                    'updatedAt': utc_now()
+                })
+            except Exception as update_error:
+                log.warning("Erro ao atualizar job %s: %s", job_id, update_error, extra=fields(jobId=job_id))
+        finally:
+            stop.set()
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _delete_messages(self, db, ref, job, lost):
+        user_id, persona, cutoff = job['userId'], job.get('persona'), job['cutoff']
+        total = 0
+        previous_ids = None
+        bulk = db.bulk_writer(BulkWriterOptions(
+            initial_ops_per_second=min(DELETE_MAX_OPS_PER_SECOND, 500),
+            max_ops_per_second=DELETE_MAX_OPS_PER_SECOND
+        ))
+        try:
+            while True:
+                if lost.is_set():
+                    raise LeaseLost(f"Lease do job de apagar {ref.id} perdido")
+                docs = _next_chunk(db, user_id, persona, cutoff)
+                if not docs:
+                    return total
+                ids = [doc.id for doc in docs]
+                if ids == previous_ids:
+                    raise RuntimeError("BulkWriter não conseguiu apagar o último bloco")
+                previous_ids = ids
+
+                deleted_by_persona = {}
+                for doc in docs:
+                    bulk.delete(doc.reference)
+                    doc_persona = doc.to_dict().get('persona')
+                    deleted_by_persona[doc_persona] = deleted_by_persona.get(doc_persona, 0) + 1
+                bulk.flush()
+                total += len(docs)
+
+                # Gravar o progresso (o lease também é renovado pelo heartbeat)
+                progress = {
+                    'deleted': firestore.Increment(len(docs)),
+                    'leaseUntil': datetime.fromtimestamp(time.time() + LEASE_SECONDS, timezone.utc),
+                    'updatedAt': utc_now()
+                }
+                for name, count in deleted_by_persona.items():
+                    progress[f"deletedByPersona.`{name or 'unknown'}`"] = firestore.Increment(count)
+                ref.update(progress)
+        finally:
+            bulk.close()
+
+
+def _next_chunk(db, user_id, persona, cutoff):
+    """Próximo bloco de mensagens a apagar (timestamp <= cutoff)"""
+    query = db.collection('chats').where(filter=firestore.FieldFilter('userId', '==', user_id))
+    if persona:
+        query = query.where(filter=firestore.FieldFilter('persona', '==', persona))
+    try:
+        return list(query
+                    .where(filter=firestore.FieldFilter('timestamp', '<=', cutoff))
+                    .order_by('timestamp')
+                    .limit(CHUNK_SIZE)
+                    .stream())
+    except FailedPrecondition as e:
+        # Índice composto ainda não criado: filtrar em memória
+        log.warning("Índice de chats em falta (firebase deploy --only firestore:indexes): %s", e)
+        docs = []
+        for doc in db.collection('chats').where(filter=firestore.FieldFilter('userId', '==', user_id)).stream():
+            data = doc.to_dict()
+            timestamp = data.get('timestamp')
+            if persona and data.get('persona') != persona:
+                continue
+            if timestamp and timestamp > cutoff:
+                continue
+            docs.append(doc)
+            if len(docs) >= CHUNK_SIZE:
+                break
+        return docs
+
+
+delete_jobs = DeleteJobRunner()
@@ -0,0 +1,134 @@
+"""Cache local (TTL + LRU) das subscrições dos utilizadores.
+
+O `chat()` e o `get_subscription_status` partilham este cache em vez de lerem
+`subscriptions/{userId}` em cada pedido. Quando o webhook do Stripe altera uma
+subscrição, o worker que o recebeu invalida a sua entrada e escreve um marcador
+em `entitlement_invalidations/{userId}`. Cada worker tem um listener Firestore
+nessa coleção e invalida a entrada correspondente assim que o marcador chega.
+O TTL limita a desatualização caso o listener falhe.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from logs import get_logger
+
+log = get_logger('entitlements')
+
+INVALIDATIONS_COLLECTION = 'entitlement_invalidations'
+
+_MISSING = object()
+
+
+class EntitlementCache:
+    def __init__(self, max_entries=10000, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listener_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, db, user_id):
+        """Dados da subscrição do utilizador (ou None se não existir)"""
+        self._ensure_listener(db)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id, _MISSING)
+            if entry is not _MISSING and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            epoch = self.invalidations
+
+        snapshot = db.collection('subscriptions').document(user_id).get()
+        data = snapshot.to_dict() if snapshot.exists else None
+
+        with self._lock:
+            # Se houve uma invalidação durante a leitura, não guardar o valor lido
+            if self.invalidations != epoch:
+                return data
+            self._entries[user_id] = (data, now + self.ttl_seconds)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return data
+
+    def peek(self, user_id):
+        """(True, dados) se houver uma entrada válida em cache, sem ir ao Firestore"""
+        with self._lock:
+            entry = self._entries.get(user_id, _MISSING)
+            if entry is not _MISSING and entry[1] > time.monotonic():
+                return True, entry[0]
+        return False, None
+
+    def is_plus(self, db, user_id):
+        data = self.get(db, user_id)
+        return bool(data) and data.get('status') == 'active'
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'listening': self._listener is not None and self._listener_pid == os.getpid()
+            }
+
+    def _ensure_listener(self, db):
+        # O listener é criado de forma lazy para que cada worker do gunicorn
+        # (processo após o fork) tenha o seu próprio stream
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            try:
+                # Só interessam marcadores recentes: os mais antigos já expiraram pelo TTL
+                since = datetime.now(timezone.utc) - timedelta(seconds=self.ttl_seconds)
+                query = db.collection(INVALIDATIONS_COLLECTION)\
+                    .where(filter=firestore.FieldFilter('updatedAt', '>=', since))
+                self._listener = query.on_snapshot(self._on_invalidation)
+                self._listener_pid = os.getpid()
+            except Exception as e:
+                log.warning("Erro ao iniciar listener de subscrições (só TTL ativo): %s", e)
+                self._listener = None
+                self._listener_pid = os.getpid()
+
+    def _on_invalidation(self, col_snapshot, changes, read_time):
+        for change in changes:
+            self.invalidate(change.document.id)
+
+
+entitlement_cache = EntitlementCache(
+    max_entries=int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000")),
+    ttl_seconds=int(os.getenv("ENTITLEMENT_CACHE_TTL", "300"))
+)
+
+
+def invalidate_entitlement(db, user_id):
+    """Invalidar a subscrição do utilizador neste worker e em todos os outros"""
+    entitlement_cache.invalidate(user_id)
+    try:
+        db.collection(INVALIDATIONS_COLLECTION).document(user_id).set({
+            'userId': user_id,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        log.warning("Erro ao publicar invalidação de subscrição: %s", e)
@@ -0,0 +1,82 @@
+"""Configuração do gunicorn (usada pelo Procfile).
+
+Com workers síncronos cada pedido de chat ocupava um worker durante toda a
+chamada ao Gemini: duas gerações lentas bloqueavam tudo, incluindo o `/health`.
+As chamadas ao Gemini, ao Firestore e ao Stripe passam quase todo o tempo à
+espera de rede, por isso cada worker passa a servir muitos pedidos ao mesmo
+tempo. O perfil escolhe-se com `GUNICORN_WORKER_CLASS`:
+
+- `gthread` (padrão): `GUNICORN_THREADS` threads por worker. Não precisa de
+  dependências extra e as bibliotecas bloqueantes libertam o GIL durante o I/O.
+- `gevent`: `GUNICORN_WORKER_CONNECTIONS` greenlets por worker (centenas de
+  chats em curso por processo). Requer `pip install gevent`; o app.py liga o
+  gRPC do Firestore ao gevent (ver serving.py).
+- `sync`: o comportamento antigo (um pedido por worker).
+
+As pools internas dependem desta concorrência: a pool do pre-flight
+(`PREFLIGHT_WORKERS`) é por defeito 4x `GUNICORN_THREADS` (ou 4x
+`GUNICORN_WORKER_CONNECTIONS` no gevent). Ao subir a concorrência, rever também
+`GEMINI_MAX_CONCURRENCY` (as chamadas ao Gemini em simultâneo; as restantes
+esperam na fila de admissão) e `CHAT_WRITER_QUEUE_SIZE` (os turnos à espera de
+gravação).
+
+Com `GUNICORN_PRELOAD` (padrão nos perfis gthread/sync) o master importa a app
+uma vez e os workers arrancam com um fork; os clientes (Firestore, Gemini,
+Stripe) e as threads de background são criados em cada worker no hook
+`post_worker_init`. No perfil gevent o preload fica desligado: o monkey
+patching tem de acontecer antes de a app ser importada.
+
+Medir com `python loadtest.py` (ver o README); os tempos de arranque de cada
+worker aparecem no log e em `/api/v1/admin/boot`.
+
+As métricas Prometheus de cada worker ficam em ficheiros no
+`PROMETHEUS_MULTIPROC_DIR` (limpo quando o master arranca) e o `/metrics`
+agrega-as (ver metrics.py).
+"""
+import os
+import glob
+import tempfile
+from dotenv import load_dotenv
+
+# As variáveis GUNICORN_* e PROMETHEUS_MULTIPROC_DIR também podem vir do .env
+load_dotenv()
+# Antes de a app ser importada: o prometheus_client escolhe o modo multiprocess no import
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "luna-prometheus"))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "64"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "false" if worker_class == "gevent" else "true").lower() == "true"
+# O streaming SSE mantém a ligação aberta; keep-alive curto para o resto
+keepalive = 5
+graceful_timeout = 30
+
+accesslog = "-"
+errorlog = "-"
+loglevel = "info"
+# Access log em JSON, como os logs da app (logs.py), com o request id da resposta
+access_log_format = ('{"logger": "gunicorn.access", "ts": "%(t)s", "method": "%(m)s", "path": "%(U)s", '
+                     '"status": %(s)s, "durationMs": %(M)s, "bytes": "%(B)s", "requestId": "%({x-request-id}o)s"}')
+
+
+def post_worker_init(worker):
+    """Depois do fork: clientes e threads de background deste worker"""
+    import app as luna
+    luna.init_worker()
+
+
+def on_starting(server):
+    """No master, antes dos workers: apagar as métricas de uma execução anterior"""
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    """Um worker saiu: as métricas dele continuam somadas, os gauges live deixam de contar"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
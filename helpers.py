@@ -0,0 +1,65 @@
+"""Funções partilhadas pelos módulos de background.
+
+- `utc_now()` e `iso()`: instante atual em UTC e serialização de timestamps do
+  Firestore para os endpoints de estado.
+- `timed()`: corre uma função e devolve `(valor, erro, ms)`, para leituras em
+  paralelo que reportam quanto demorou cada fonte.
+- `claim()`: reclama um documento de uma fila no Firestore com um update
+  condicional (`last_update_time`); se outro worker já mexeu no documento, não
+  é nosso.
+- `ProcessExecutor`: pool de threads criada de forma lazy e recriada após fork,
+  para cada worker do gunicorn ter as suas threads.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from google.api_core.exceptions import FailedPrecondition
+
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+
+def iso(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def timed(fn):
+    started = time.perf_counter()
+    try:
+        return fn(), None, (time.perf_counter() - started) * 1000
+    except Exception as e:
+        return None, e, (time.perf_counter() - started) * 1000
+
+
+def claim(db, doc, now, seconds):
+    """Adiar o `nextAttemptAt` de `doc` se ninguém lhe mexeu desde a leitura"""
+    try:
+        doc.reference.update({
+            'nextAttemptAt': now + timedelta(seconds=seconds)
+        }, option=db.write_option(last_update_time=doc.update_time))
+        return True
+    except FailedPrecondition:
+        return False
+
+
+class ProcessExecutor:
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix)
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.get().submit(fn, *args, **kwargs)
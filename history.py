@@ -0,0 +1,160 @@
+"""Histórico de conversas paginado por cursor.
+
+A filtragem por persona e a ordenação são feitas pelo Firestore com o índice
+composto (userId, persona, timestamp) definido em `firestore.indexes.json`. Os
+cursores são o timestamp ISO 8601 da mensagem mais antiga (`before`) ou mais
+recente (`after`) da página.
+
+O ETag é calculado a partir do contador da conversa (`chat_counters`), cuja
+`version` muda sempre que há mensagens novas ou apagadas. Um cliente que repete
+o pedido com `If-None-Match` recebe 304 com uma única leitura, sem ler `chats`.
+
+Os turnos gravados em background (chat_writer) só mudam a `version` depois do
+commit. O worker que os enfileirou põe o último turno pendente no ETag, por isso
+não responde 304 sem ele; outro worker não os conhece e, até ao commit (~200ms),
+ainda pode responder com a página anterior ou um 304.
+"""
+import hashlib
+from datetime import datetime, timezone
+from google.api_core.exceptions import FailedPrecondition
+from firebase_admin import firestore
+from logs import get_logger
+
+log = get_logger('history')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def parse_limit(value):
+    if value is None or value == '':
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    if limit < 1 or limit > MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def parse_cursor(value):
+    """Converter um cursor ISO 8601 em datetime UTC (ou None)"""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise InvalidCursor("Invalid cursor")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def format_cursor(timestamp):
+    """Cursor em UTC com sufixo Z (seguro para usar diretamente na query string)"""
+    if not timestamp or not hasattr(timestamp, 'isoformat'):
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp.isoformat() + 'Z'
+
+
+def history_etag(user_id, persona, counter, limit, before, after, pending_id=None):
+    """ETag da página: muda quando a conversa muda, com um turno novo ainda por
+    gravar (`pending_id`, o último) ou quando os parâmetros mudam"""
+    raw = f"{user_id}|{persona}|{counter['version']}|{counter['messageCount']}|{limit}|{before}|{after}|{pending_id}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+
+
+def merge_pending(messages, has_more, pending, limit, after=None):
+    """Juntar a uma página lida do Firestore os turnos deste worker ainda por gravar"""
+    known = {message['id'] for message in messages}
+    extra = [turn for turn in pending if turn['id'] not in known and (after is None or turn['timestamp'] > after)]
+    if not extra:
+        return messages, has_more
+    merged = messages + extra
+    if len(merged) > limit:
+        # Página `after` avança a partir do cursor; a mais recente fica com as últimas
+        merged = merged[:limit] if after else merged[-limit:]
+        has_more = True
+    return merged, has_more
+
+
+def _serialize(doc_id, data):
+    return {
+        'id': doc_id,
+        'message': data.get('message', ''),
+        'reply': data.get('reply', ''),
+        'timestamp': data.get('timestamp')
+    }
+
+
+def fetch_history_page(db, user_id, persona, limit, before=None, after=None, hidden_before=None):
+    """Página do histórico por ordem cronológica.
+
+    Sem cursor devolve as `limit` mensagens mais recentes. Devolve
+    (mensagens, has_more), onde has_more indica se há mais mensagens na
+    direção pedida. Mensagens com timestamp <= `hidden_before` (a ser apagadas
+    por um job) não são devolvidas.
+    """
+    query = db.collection('chats')\
+        .where(filter=firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.FieldFilter('persona', '==', persona))
+
+    if hidden_before and after and after < hidden_before:
+        after = hidden_before
+
+    try:
+        if after:
+            docs = list(query
+                        .where(filter=firestore.FieldFilter('timestamp', '>', after))
+                        .order_by('timestamp', direction=firestore.Query.ASCENDING)
+                        .limit(limit + 1)
+                        .stream())
+            messages = [_serialize(doc.id, doc.to_dict()) for doc in docs[:limit]]
+        else:
+            if before:
+                query = query.where(filter=firestore.FieldFilter('timestamp', '<', before))
+            if hidden_before:
+                query = query.where(filter=firestore.FieldFilter('timestamp', '>', hidden_before))
+            docs = list(query
+                        .order_by('timestamp', direction=firestore.Query.DESCENDING)
+                        .limit(limit + 1)
+                        .stream())
+            messages = [_serialize(doc.id, doc.to_dict()) for doc in docs[:limit]]
+            messages.reverse()
+        return messages, len(docs) > limit
+    except FailedPrecondition as e:
+        # Índice composto ainda não criado: filtrar em memória como antes
+        log.warning("Índice do histórico em falta (firebase deploy --only firestore:indexes): %s", e)
+        return _fetch_history_page_in_memory(db, user_id, persona, limit, before, after, hidden_before)
+
+
+def _fetch_history_page_in_memory(db, user_id, persona, limit, before, after, hidden_before=None):
+    docs = db.collection('chats')\
+        .where(filter=firestore.FieldFilter('userId', '==', user_id))\
+        .stream()
+    messages = []
+    for doc in docs:
+        data = doc.to_dict()
+        timestamp = data.get('timestamp')
+        if data.get('persona') != persona or not timestamp:
+            continue
+        if before and timestamp >= before:
+            continue
+        if after and timestamp <= after:
+            continue
+        if hidden_before and timestamp <= hidden_before:
+            continue
+        messages.append(_serialize(doc.id, data))
+
+    messages.sort(key=lambda x: x['timestamp'])
+    has_more = len(messages) > limit
+    if after:
+        return messages[:limit], has_more
+    return messages[-limit:], has_more
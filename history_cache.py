@@ -0,0 +1,160 @@
+"""Cache write-through das últimas mensagens de cada conversa.
+
+O frontend volta a pedir o histórico logo a seguir a cada mensagem. Este cache
+guarda as últimas N mensagens por (userId, persona): é preenchido quando o
+histórico é lido do Firestore, atualizado pelo `chat()` quando grava um turno e
+limpo quando o histórico é apagado. A página mais recente é servida da memória;
+páginas mais antigas (cursor `before`/`after`) continuam a ir ao Firestore.
+
+Cada entrada guarda a `version` do contador da conversa que reflete. O endpoint
+compara-a com a versão no Firestore: se outro worker alterou a conversa a versão
+remota é maior e a entrada é ignorada. Turnos gravados por este worker que ainda
+estão na fila de escrita fazem a versão local ficar à frente da remota, e a
+entrada continua válida.
+
+A memória é limitada por um total aproximado de bytes, com eviction LRU.
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+RECENT_TURNS = int(os.getenv("HISTORY_CACHE_TURNS", "100"))
+MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Estimativa do custo fixo de cada mensagem em memória (dict, id, timestamp)
+TURN_OVERHEAD_BYTES = 300
+
+
+def _turn_size(turn):
+    return len(turn.get('message') or '') + len(turn.get('reply') or '') + TURN_OVERHEAD_BYTES
+
+
+class _Entry:
+    def __init__(self, turns, complete, version):
+        self.turns = turns
+        self.complete = complete  # True se `turns` contém a conversa inteira
+        self.version = version
+        self.size = sum(_turn_size(turn) for turn in turns)
+
+
+class HistoryCache:
+    def __init__(self, max_turns=RECENT_TURNS, max_bytes=MAX_BYTES):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, user_id, persona):
+        """Versão local da conversa (0 se não estiver em cache)"""
+        with self._lock:
+            entry = self._entries.get((user_id, persona))
+            return entry.version if entry else 0
+
+    def get_page(self, user_id, persona, limit, remote_version, hidden_before=None):
+        """Página mais recente em memória, ou None se for preciso ir ao Firestore.
+
+        Uma entrada com mensagens escondidas (timestamp <= `hidden_before`, a ser
+        apagadas por um job) é descartada. Devolve (mensagens, has_more).
+        """
+        key = (user_id, persona)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and hidden_before and entry.turns and (entry.turns[0]['timestamp'] or hidden_before) <= hidden_before:
+                self._remove(key)
+                entry = None
+            if entry is None or entry.version < remote_version or (len(entry.turns) < limit and not entry.complete):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            page = list(entry.turns[-limit:])
+            has_more = len(entry.turns) > limit or not entry.complete
+            return page, has_more
+
+    def store(self, user_id, persona, turns, has_more, version):
+        """Guardar a página mais recente lida do Firestore"""
+        complete = not has_more
+        if len(turns) > self.max_turns:
+            turns = turns[-self.max_turns:]
+            complete = False
+        key = (user_id, persona)
+        with self._lock:
+            current = self._entries.get(key)
+            # Não substituir uma entrada mais recente (ex.: turno acabado de gravar)
+            if current is not None and current.version > version:
+                return
+            self._replace(key, _Entry(list(turns), complete, version))
+
+    def append(self, user_id, persona, turn, base_version=None, earlier=()):
+        """Write-through: acrescentar um turno gravado por este worker.
+
+        Numa conversa sem mensagens gravadas, `base_version` é a versão do contador
+        e `earlier` os turnos deste worker ainda na fila de escrita: sem entrada em
+        memória, a conversa fica em cache completa só com eles e o turno novo.
+        """
+        key = (user_id, persona)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if base_version is not None:
+                    turns = list(earlier) + [turn]
+                    self._replace(key, _Entry(turns, True, base_version + len(turns)))
+                return  # Sem a conversa em memória não sabemos o estado completo
+            turns = entry.turns + [turn]
+            complete = entry.complete
+            if len(turns) > self.max_turns:
+                turns = turns[-self.max_turns:]
+                complete = False
+            self._replace(key, _Entry(turns, complete, entry.version + 1))
+
+    def invalidate(self, user_id, persona=None):
+        with self._lock:
+            if persona is not None:
+                self._remove((user_id, persona))
+                return
+            for key in [key for key in self._entries if key[0] == user_id]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / total, 3) if total else 0.0,
+                'evictions': self.evictions
+            }
+
+    def _replace(self, key, entry):
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+
+history_cache = HistoryCache()
+
+
+def turn_from_queued(turn):
+    """Converter um turno da fila de escrita no formato devolvido pelo histórico"""
+    return {
+        'id': turn['id'],
+        'message': turn['message'],
+        'reply': turn['reply'],
+        'timestamp': datetime.fromisoformat(turn['timestamp'])
+    }
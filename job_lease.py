@@ -0,0 +1,196 @@
+"""Execução única de jobs agendados com um lease no Firestore.
+
+O `BackgroundScheduler` arranca em todos os workers de todas as instâncias, por
+isso cada job agendado disparava várias vezes. Cada job tem um documento em
+`scheduled_jobs/{nome}` e só corre no worker que conseguir o lease numa
+transação (compare-and-set sobre `holder`/`leaseUntil`):
+
+- `runKey` identifica a execução (ex.: a data do relatório). Quando uma execução
+  termina, `lastCompletedKey` passa a ser essa chave e os outros workers deixam
+  de a tentar.
+- O lease expira se não for renovado (a thread de heartbeat renova-o enquanto
+  o job corre). Se o worker morrer a meio, outro worker apanha o lease na
+  próxima tentativa e continua a partir do `checkpoint` gravado pelo job.
+- `holder`, `lastRunStartedAt`, `lastRunFinishedAt`, `lastRunStatus` e
+  `lastError` ficam no documento para se ver quem tem o job e quando correu.
+"""
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+from firebase_admin import firestore
+from helpers import iso, utc_now
+from logs import get_logger
+
+log = get_logger('jobs')
+
+JOBS_COLLECTION = 'scheduled_jobs'
+DEFAULT_LEASE_SECONDS = 300
+# Depois de MAX_ATTEMPTS falhas na mesma execução, desistir até à próxima
+MAX_ATTEMPTS = 3
+
+# Execuções que este processo já sabe estarem concluídas (evita a transação)
+_completed = set()
+
+
+def _holder_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def job_ref(db, name):
+    return db.collection(JOBS_COLLECTION).document(name)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class JobRun:
+    """Execução em curso: checkpoint para retomar e gravação do progresso"""
+
+    def __init__(self, db, name, run_key, holder, checkpoint, lease_seconds):
+        self.db = db
+        self.name = name
+        self.run_key = run_key
+        self.holder = holder
+        self.checkpoint = dict(checkpoint or {})
+        self.lease_seconds = lease_seconds
+        self.resumed = bool(checkpoint)
+
+    def save(self, **fields):
+        """Gravar progresso no checkpoint (só se ainda formos o holder)"""
+        self.checkpoint.update(fields)
+        _update_if_holder(self.db.transaction(), job_ref(self.db, self.name), self.holder, {
+            'checkpoint': self.checkpoint,
+            'leaseUntil': utc_now() + timedelta(seconds=self.lease_seconds),
+            'updatedAt': utc_now()
+        })
+
+    def renew(self):
+        _update_if_holder(self.db.transaction(), job_ref(self.db, self.name), self.holder, {
+            'leaseUntil': utc_now() + timedelta(seconds=self.lease_seconds)
+        })
+
+
+@firestore.transactional
+def _acquire_in_transaction(transaction, ref, run_key, holder, lease_seconds):
+    snapshot = ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    now = utc_now()
+    if data.get('lastCompletedKey') == run_key:
+        _completed.add((ref.id, run_key))
+        return None  # Esta execução já foi feita
+    lease_until = data.get('leaseUntil')
+    if data.get('holder') and lease_until and lease_until > now:
+        return None  # Outro worker tem o lease
+    same_run = data.get('runKey') == run_key
+    attempts = data.get('attempts', 0) if same_run else 0
+    transaction.set(ref, {
+        'runKey': run_key,
+        'holder': holder,
+        'leaseUntil': now + timedelta(seconds=lease_seconds),
+        'attempts': attempts + 1,
+        # Uma execução nova começa sem checkpoint; a mesma execução retoma do último
+        'checkpoint': data.get('checkpoint', {}) if same_run else {},
+        'lastRunStartedAt': now,
+        'lastRunStatus': 'running',
+        'updatedAt': now
+    }, merge=True)
+    return {'checkpoint': data.get('checkpoint', {}) if same_run else {}, 'attempts': attempts + 1}
+
+
+@firestore.transactional
+def _update_if_holder(transaction, ref, holder, fields):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get('holder') != holder:
+        raise LeaseLost(f"Lease de {ref.id} perdido")
+    transaction.update(ref, fields)
+
+
+def _heartbeat(run, stop):
+    while not stop.wait(run.lease_seconds / 3):
+        try:
+            run.renew()
+        except LeaseLost:
+            log.warning("Lease do job %s perdido para outro worker", run.name)
+            return
+        except Exception as e:
+            log.warning("Erro ao renovar lease do job %s: %s", run.name, e)
+
+
+def run_exclusive(db, name, run_key, fn, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """Correr `fn(run)` se este worker conseguir o lease da execução `run_key`.
+
+    Devolve True se o job correu (com sucesso ou não) neste worker.
+    """
+    if (name, run_key) in _completed:
+        return False
+    ref = job_ref(db, name)
+    holder = _holder_id()
+    claimed = _acquire_in_transaction(db.transaction(), ref, run_key, holder, lease_seconds)
+    if claimed is None:
+        return False
+
+    run = JobRun(db, name, run_key, holder, claimed['checkpoint'], lease_seconds)
+    log.info("Job %s (%s) a correr neste worker%s", name, run_key, " (a retomar)" if run.resumed else "")
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(run, stop), name=f"lease-{name}", daemon=True).start()
+    try:
+        fn(run)
+        _update_if_holder(db.transaction(), ref, holder, {
+            'holder': None,
+            'leaseUntil': None,
+            'lastCompletedKey': run_key,
+            'lastRunStatus': 'success',
+            'lastRunFinishedAt': utc_now(),
+            'lastError': None,
+            'checkpoint': {},
+            'updatedAt': utc_now()
+        })
+        _completed.add((name, run_key))
+        log.info("Job %s (%s) concluído", name, run_key)
+    except LeaseLost as e:
+        log.warning("Job %s (%s): %s", name, run_key, e)
+    except Exception as e:
+        log.error("Job %s (%s) falhou (tentativa %d): %s", name, run_key, claimed['attempts'], e)
+        fields = {
+            'holder': None,
+            'leaseUntil': None,
+            'lastRunStatus': 'failed',
+            'lastRunFinishedAt': utc_now(),
+            'lastError': str(e),
+            'updatedAt': utc_now()
+        }
+        if claimed['attempts'] >= MAX_ATTEMPTS:
+            # Desistir desta execução; a próxima (runKey nova) volta a tentar
+            fields['lastCompletedKey'] = run_key
+            fields['lastRunStatus'] = 'gave_up'
+        try:
+            _update_if_holder(db.transaction(), ref, holder, fields)
+        except Exception as release_err:
+            log.warning("Erro ao libertar lease do job %s: %s", name, release_err)
+    finally:
+        stop.set()
+    return True
+
+
+def list_jobs(db):
+    """Estado dos jobs agendados (holder, lease e última execução)"""
+    jobs = []
+    for doc in db.collection(JOBS_COLLECTION).stream():
+        data = doc.to_dict()
+        jobs.append({
+            'name': doc.id,
+            'holder': data.get('holder'),
+            'leaseUntil': iso(data.get('leaseUntil')),
+            'runKey': data.get('runKey'),
+            'attempts': data.get('attempts', 0),
+            'lastCompletedKey': data.get('lastCompletedKey'),
+            'lastRunStatus': data.get('lastRunStatus'),
+            'lastRunStartedAt': iso(data.get('lastRunStartedAt')),
+            'lastRunFinishedAt': iso(data.get('lastRunFinishedAt')),
+            'lastError': data.get('lastError'),
+            'checkpoint': sorted((data.get('checkpoint') or {}).keys())
+        })
+    return jobs
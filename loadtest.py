@@ -0,0 +1,95 @@
+"""Teste de carga simples: throughput e latência com concorrência crescente.
+
+Serve para comparar os perfis de workers do gunicorn (ver gunicorn.conf.py):
+
+    GUNICORN_WORKER_CLASS=sync gunicorn app:app -c gunicorn.conf.py
+    python loadtest.py --levels 1,10,50,100,200
+
+    GUNICORN_WORKER_CLASS=gthread gunicorn app:app -c gunicorn.conf.py
+    python loadtest.py --levels 1,10,50,100,200 --chat
+
+Com `--chat` cada pedido é um POST /api/v1/chat com um userId diferente (para
+não bater no rate limit por utilizador); estas chamadas vão ao Gemini e ao
+Firestore de verdade, por isso usar um projeto de teste. Sem `--chat` o alvo é
+o `--path` (por defeito /health).
+"""
+import argparse
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _one_request(session, args):
+    started = time.perf_counter()
+    try:
+        if args.chat:
+            resp = session.post(f"{args.url}/api/v1/chat", json={
+                'userId': f"loadtest{uuid.uuid4().hex}",
+                'persona': args.persona,
+                'message': args.message
+            }, timeout=args.timeout)
+        else:
+            resp = session.get(f"{args.url}{args.path}", timeout=args.timeout)
+        status = resp.status_code
+    except requests.RequestException as e:
+        status = type(e).__name__
+    return status, (time.perf_counter() - started) * 1000
+
+
+def run_level(concurrency, args):
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    total = max(args.requests, concurrency)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: _one_request(session, args), range(total)))
+    elapsed = time.perf_counter() - started
+    statuses = Counter(status for status, _ in results)
+    latencies = [ms for status, ms in results if status == 200]
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'ok': statuses.get(200, 0),
+        'statuses': dict(statuses),
+        'throughput': statuses.get(200, 0) / elapsed if elapsed else 0.0,
+        'p50': _percentile(latencies, 50),
+        'p95': _percentile(latencies, 95),
+        'p99': _percentile(latencies, 99)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do Luna Backend")
+    parser.add_argument('--url', default="http://localhost:5001")
+    parser.add_argument('--path', default="/health")
+    parser.add_argument('--chat', action='store_true', help="POST /api/v1/chat em vez de GET --path")
+    parser.add_argument('--persona', default="Luna")
+    parser.add_argument('--message', default="hi")
+    parser.add_argument('--levels', default="1,10,50,100", help="Níveis de concorrência (separados por vírgula)")
+    parser.add_argument('--requests', type=int, default=200, help="Pedidos por nível")
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    target = "POST /api/v1/chat" if args.chat else f"GET {args.path}"
+    print(f"🎯 {target} em {args.url}")
+    print(f"{'conc':>6} {'ok':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  estados")
+    for level in [int(value) for value in args.levels.split(",") if value.strip()]:
+        result = run_level(level, args)
+        print(f"{result['concurrency']:>6} {result['ok']:>6} {result['throughput']:>8.1f} "
+              f"{result['p50']:>8.0f} {result['p95']:>8.0f} {result['p99']:>8.0f}  {result['statuses']}")
+
+
+if __name__ == '__main__':
+    main()
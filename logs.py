@@ -0,0 +1,215 @@
+"""Logs estruturados (JSON, uma linha por registo) escritos por uma thread em background.
+
+Os handlers usavam `print`, várias vezes por pedido de chat: cada linha era
+uma escrita síncrona no stdout dentro do pedido, sem formato que se pudesse
+filtrar. Agora:
+
+- Os módulos usam `get_logger('<subsistema>')` (loggers `luna.*`). O root tem
+  um handler que só põe o registo numa fila limitada; uma thread por processo
+  formata em JSON e escreve no stdout. Com a fila cheia o registo é descartado
+  (e contado), o pedido nunca espera pelo I/O dos logs.
+- Cada pedido HTTP tem um request id (o header `X-Request-ID` do cliente ou um
+  novo), incluído em todas as linhas desse pedido e devolvido na resposta.
+- Linhas de alto volume (ex.: uma por mensagem de chat) passam
+  `fields(sample='chave', ...)` e só uma fração é escrita (`LOG_SAMPLE_RATE`,
+  ou por chave em `LOG_SAMPLE_RATES`). A decisão é feita pelo request id, por
+  isso as linhas amostradas de um pedido aparecem todas ou nenhuma. Avisos e
+  erros nunca são amostrados.
+- `LOG_LEVEL` define o nível dos loggers da app e `LOG_LEVELS` o de cada
+  subsistema, ex.: `LOG_LEVELS=chat=WARNING,stripe_events=DEBUG`. Nomes com um
+  ponto são usados tal como estão (ex.: `apscheduler.scheduler=INFO`); as
+  bibliotecas ficam em WARNING.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+import zlib
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOGGER_PREFIX = 'luna'
+QUEUE_MAX_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+DEFAULT_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+_handler = None
+_exception_formatter = logging.Formatter()
+
+
+def _parse_pairs(value):
+    """"a=1,b=2" -> {'a': '1', 'b': '2'}"""
+    pairs = {}
+    for item in (value or "").split(","):
+        name, sep, setting = item.partition("=")
+        if sep and name.strip() and setting.strip():
+            pairs[name.strip()] = setting.strip()
+    return pairs
+
+
+def get_logger(subsystem):
+    """Logger de um subsistema (`luna.<subsistema>`)"""
+    return logging.getLogger(f"{LOGGER_PREFIX}.{subsystem}")
+
+
+def fields(sample=None, **values):
+    """`extra=` de um registo: campos adicionais no JSON e, com `sample`, a chave de amostragem"""
+    extra = {'fields': values}
+    if sample:
+        extra['sample'] = sample
+    return extra
+
+
+def set_request_id(value=None):
+    """Request id do pedido atual (o do cliente se for válido, senão um novo)"""
+    request_id = value if value and REQUEST_ID_PATTERN.match(value) else uuid.uuid4().hex
+    _request_id.set(request_id)
+    return request_id
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['requestId'] = request_id
+        sample_rate = getattr(record, 'sample_rate', None)
+        if sample_rate is not None:
+            entry['sampleRate'] = sample_rate
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _ContextFilter(logging.Filter):
+    """Juntar o request id e aplicar a amostragem (corre na thread do pedido)"""
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        request_id = _request_id.get()
+        record.request_id = request_id
+        key = getattr(record, 'sample', None)
+        if key and record.levelno < logging.WARNING:
+            rate = self.sample_rates.get(key, DEFAULT_SAMPLE_RATE)
+            if request_id:
+                keep = zlib.crc32(request_id.encode()) % 10000 < rate * 10000
+            else:
+                keep = random.random() < rate
+            if not keep:
+                self.sampled_out += 1
+                return False
+            record.sample_rate = rate
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler com uma thread de escrita por processo e descarte quando a fila enche"""
+
+    def __init__(self, target, max_size=QUEUE_MAX_SIZE):
+        super().__init__(None)
+        self.target = target
+        self.max_size = max_size
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+
+    def enqueue(self, record):
+        # Chamado com o lock do handler (que o logging reinicia depois de um fork)
+        if self._pid != os.getpid():
+            # Primeiro registo deste processo: a thread do pai não existe depois do fork
+            self.queue = queue.Queue(self.max_size)
+            self._listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Só o necessário para a thread de escrita: a mensagem final e o traceback em texto
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def flush_and_stop(self):
+        if self._listener is None or self._pid != os.getpid():
+            return
+        try:
+            self._listener.stop()
+        except queue.Full:
+            pass
+        self._listener = None
+        self._pid = None
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self._pid == os.getpid() else 0,
+            'maxSize': self.max_size,
+            'dropped': self.dropped
+        }
+
+
+def configure_logging():
+    """Instalar o handler JSON no root (idempotente); níveis e amostragem vêm do ambiente"""
+    global _handler
+    if _handler is not None:
+        return _handler
+
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+    _handler = NonBlockingQueueHandler(target)
+    _handler.addFilter(_ContextFilter({name: float(rate) for name, rate in
+                                       _parse_pairs(os.getenv("LOG_SAMPLE_RATES")).items()}))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    # Bibliotecas (apscheduler, urllib3, ...) só com avisos; LOG_LEVEL é o nível dos loggers da app
+    root.setLevel(logging.WARNING)
+    logging.getLogger(LOGGER_PREFIX).setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    for subsystem, level in _parse_pairs(os.getenv("LOG_LEVELS")).items():
+        name = subsystem if subsystem.startswith(LOGGER_PREFIX) or '.' in subsystem \
+            else f"{LOGGER_PREFIX}.{subsystem}"
+        logging.getLogger(name).setLevel(level.upper())
+    atexit.register(_handler.flush_and_stop)
+    return _handler
+
+
+def log_stats():
+    """Fila de escrita e linhas descartadas/amostradas neste processo"""
+    if _handler is None:
+        return {}
+    sampler = _handler.filters[0]
+    return dict(_handler.stats(), sampledOut=sampler.sampled_out)
@@ -0,0 +1,131 @@
+"""Métricas Prometheus do caminho quente (servidas em `/metrics`).
+
+Os prints com emojis ("📊 Tokens", "✅ MODELO USADO") não permitem ver
+percentis. Aqui cada etapa do chat tem um histograma de latência
+(`luna_chat_stage_seconds{stage=...}`):
+
+- `validation`, `persona_count`, `summary`, `subscription_lookup`, `quota_scan`
+  (leituras do pre-flight), `quota_reserve`, `admission_wait`, `save_enqueue`
+  (o turno entra na fila de escrita) e `firestore_save` (o batch commit feito
+  pelo chat_writer em background), mais `total` para o `/api/v1/chat`;
+- cada tentativa de um modelo Gemini em `luna_gemini_attempt_seconds`
+  (modelo, `generate`/`stream` e resultado);
+- contadores de fallbacks de modelo, pedidos recusados pela quota diária e
+  eventos do webhook do Stripe, e o tamanho das páginas de histórico servidas.
+
+Com o gunicorn cada worker escreve as suas métricas em ficheiros no
+`PROMETHEUS_MULTIPROC_DIR` (definido no gunicorn.conf.py) e o `/metrics` de
+qualquer worker agrega todos. Sem o `prometheus_client` instalado as funções
+de registo não fazem nada e o `/metrics` responde 501.
+"""
+import os
+import time
+from contextlib import contextmanager
+from logs import get_logger
+
+log = get_logger('metrics')
+
+try:
+    from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY,
+                                   CONTENT_TYPE_LATEST, generate_latest, multiprocess)
+except ImportError:
+    Counter = Histogram = None
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Do pre-flight (~10ms) até uma geração longa do Gemini (~40s)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+HISTORY_SIZE_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 200)
+
+# Nome da leitura no run_preflight -> etapa do chat
+PREFLIGHT_STAGES = {
+    'conversation': 'persona_count',
+    'summary': 'summary',
+    'subscription': 'subscription_lookup',
+    'quota_usage': 'quota_scan'
+}
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = Histogram is not None
+        if not self.enabled:
+            log.warning("prometheus_client não instalado: /metrics desligado (pip install prometheus-client)")
+            return
+        if MULTIPROC_DIR:
+            os.makedirs(MULTIPROC_DIR, exist_ok=True)
+        self.stage_seconds = Histogram(
+            'luna_chat_stage_seconds', 'Latência de cada etapa do chat',
+            ['stage'], buckets=LATENCY_BUCKETS)
+        self.gemini_attempt_seconds = Histogram(
+            'luna_gemini_attempt_seconds', 'Latência de cada tentativa de um modelo Gemini',
+            ['model', 'mode', 'outcome'], buckets=LATENCY_BUCKETS)
+        self.model_fallbacks = Counter(
+            'luna_model_fallbacks_total', 'Tentativas falhadas que passaram ao próximo modelo',
+            ['model', 'reason'])
+        self.quota_rejections = Counter(
+            'luna_quota_rejections_total', 'Pedidos de chat recusados pelo limite diário free')
+        self.webhook_events = Counter(
+            'luna_webhook_events_total', 'Eventos recebidos no webhook do Stripe',
+            ['type', 'result'])
+        self.history_size = Histogram(
+            'luna_history_page_messages', 'Mensagens devolvidas por página de histórico',
+            ['source'], buckets=HISTORY_SIZE_BUCKETS)
+
+    def observe_stage(self, stage, seconds):
+        if self.enabled:
+            self.stage_seconds.labels(stage=stage).observe(seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        """Medir o bloco como a etapa `stage` (também quando levanta exceção)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def observe_preflight(self, timings):
+        """Registar os tempos (ms) das leituras do pre-flight"""
+        for name, elapsed_ms in timings.items():
+            self.observe_stage(PREFLIGHT_STAGES.get(name, name), elapsed_ms / 1000)
+
+    def record_model_attempt(self, model, mode, outcome, seconds):
+        if not self.enabled:
+            return
+        self.gemini_attempt_seconds.labels(model=model, mode=mode, outcome=outcome).observe(seconds)
+        if outcome != 'ok':
+            self.model_fallbacks.labels(model=model, reason=outcome).inc()
+
+    def record_quota_rejection(self):
+        if self.enabled:
+            self.quota_rejections.inc()
+
+    def record_webhook_event(self, event_type, result):
+        if self.enabled:
+            self.webhook_events.labels(type=event_type or 'unknown', result=result).inc()
+
+    def record_history_size(self, source, count):
+        if self.enabled:
+            self.history_size.labels(source=source).observe(count)
+
+    def render(self):
+        """Texto de exposição do Prometheus -> (corpo, content type), ou None se desligado"""
+        if not self.enabled:
+            return None
+        if MULTIPROC_DIR:
+            # Agregar os ficheiros de todos os workers (incluindo os que já morreram)
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Chamado pelo master do gunicorn quando um worker sai (hook child_exit)"""
+    if MULTIPROC_DIR and Histogram is not None:
+        multiprocess.mark_process_dead(pid)
+
+
+metrics = Metrics()
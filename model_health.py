@@ -0,0 +1,195 @@
+"""Circuit breaker por modelo para a cadeia de fallback do Gemini.
+
+Quando um modelo devolve 404, 429 ou RESOURCE_EXHAUSTED o circuito abre e o
+modelo é saltado durante um cooldown que duplica a cada falha seguida. Depois do
+cooldown o circuito fica half-open: um único pedido de teste passa e, se correr
+bem, o circuito fecha. Assim os pedidos vão diretos ao primeiro modelo saudável
+em vez de pagarem o round trip falhado em cada mensagem.
+
+As transições são publicadas em `model_health/{modelo}` e cada worker sincroniza
+esse estado periodicamente, para que um modelo aberto num worker fique aberto
+nos restantes.
+"""
+import os
+import threading
+import time
+from firebase_admin import firestore
+from logs import get_logger
+
+log = get_logger('model_health')
+
+HEALTH_COLLECTION = 'model_health'
+
+BASE_COOLDOWN_SECONDS = float(os.getenv("MODEL_BREAKER_BASE_COOLDOWN", "30"))
+MAX_COOLDOWN_SECONDS = float(os.getenv("MODEL_BREAKER_MAX_COOLDOWN", "1800"))
+SYNC_INTERVAL_SECONDS = float(os.getenv("MODEL_BREAKER_SYNC_INTERVAL", "30"))
+PROBE_TIMEOUT_SECONDS = 120
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def is_breaker_error(error):
+    """Erros que indicam que o modelo não está disponível (e não um erro do pedido)"""
+    error_str = str(error)
+    return ('404' in error_str or 'NOT_FOUND' in error_str or '429' in error_str
+            or 'RESOURCE_EXHAUSTED' in error_str or 'quota' in error_str.lower())
+
+
+class _ModelState:
+    def __init__(self):
+        self.state = CLOSED
+        self.open_until = 0.0  # epoch (time.time) para poder ser partilhado entre workers
+        self.cooldown = 0.0
+        self.consecutive_failures = 0
+        self.probing = False
+        self.probe_started = 0.0
+        self.last_error = None
+        self.changed_at = time.time()
+
+
+class ModelHealthTracker:
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._last_sync = 0.0
+        self._syncing = False
+
+    def attach(self, db):
+        """Ativar a partilha de estado entre workers através do Firestore"""
+        self._db = db
+
+    def _get(self, model):
+        if model not in self._models:
+            self._models[model] = _ModelState()
+        return self._models[model]
+
+    def candidates(self, models):
+        """Modelos a tentar, por ordem de preferência, saltando circuitos abertos.
+
+        Um circuito cujo cooldown expirou passa a half-open e deixa passar um
+        único pedido de teste. Se todos estiverem abertos, devolve o que fecha
+        mais cedo para não falhar sem tentar nada.
+        """
+        self._maybe_sync()
+        now = time.time()
+        allowed = []
+        with self._lock:
+            for model in models:
+                state = self._get(model)
+                if state.state == CLOSED:
+                    allowed.append(model)
+                # Cooldown expirado: deixar passar um teste (ou outro, se o anterior nunca reportou)
+                elif now >= state.open_until and (not state.probing or now - state.probe_started > PROBE_TIMEOUT_SECONDS):
+                    state.state = HALF_OPEN
+                    state.probing = True
+                    state.probe_started = now
+                    allowed.append(model)
+            if not allowed and models:
+                allowed.append(min(models, key=lambda m: self._get(m).open_until))
+        return allowed
+
+    def record_success(self, model):
+        with self._lock:
+            state = self._get(model)
+            was_open = state.state != CLOSED
+            state.state = CLOSED
+            state.consecutive_failures = 0
+            state.cooldown = 0.0
+            state.open_until = 0.0
+            state.probing = False
+            state.changed_at = time.time()
+        if was_open:
+            log.info("Circuito do modelo %s fechado", model)
+            self._publish(model)
+
+    def record_failure(self, model, error):
+        with self._lock:
+            state = self._get(model)
+            state.consecutive_failures += 1
+            state.last_error = str(error)[:200]
+            state.probing = False
+            if not is_breaker_error(error):
+                # Erros transitórios não abrem o circuito; um teste falhado volta a abrir
+                if state.state == HALF_OPEN:
+                    state.state = OPEN
+                    state.open_until = time.time() + (state.cooldown or BASE_COOLDOWN_SECONDS)
+                return
+            if state.cooldown:
+                state.cooldown = min(state.cooldown * 2, MAX_COOLDOWN_SECONDS)
+            else:
+                state.cooldown = BASE_COOLDOWN_SECONDS
+            state.state = OPEN
+            state.open_until = time.time() + state.cooldown
+            state.changed_at = time.time()
+            cooldown = state.cooldown
+        log.warning("Circuito do modelo %s aberto por %.0fs", model, cooldown)
+        self._publish(model)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {
+                model: {
+                    'state': state.state,
+                    'consecutiveFailures': state.consecutive_failures,
+                    'cooldownSeconds': state.cooldown,
+                    'retryInSeconds': max(0.0, round(state.open_until - now, 1)) if state.state != CLOSED else 0.0,
+                    'lastError': state.last_error
+                }
+                for model, state in self._models.items()
+            }
+
+    def _publish(self, model):
+        if not self._db:
+            return
+        with self._lock:
+            state = self._get(model)
+            payload = {
+                'state': CLOSED if state.state == CLOSED else OPEN,
+                'openUntil': state.open_until,
+                'cooldownSeconds': state.cooldown,
+                'changedAt': state.changed_at,
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            }
+        try:
+            self._db.collection(HEALTH_COLLECTION).document(model).set(payload)
+        except Exception as e:
+            log.warning("Erro ao publicar estado do modelo %s: %s", model, e)
+
+    def _maybe_sync(self):
+        # A sincronização corre numa thread para não atrasar o pedido
+        if not self._db or self._syncing or time.time() - self._last_sync < SYNC_INTERVAL_SECONDS:
+            return
+        self._syncing = True
+        self._last_sync = time.time()
+        threading.Thread(target=self._sync, daemon=True).start()
+
+    def _sync(self):
+        try:
+            for doc in self._db.collection(HEALTH_COLLECTION).stream():
+                remote = doc.to_dict()
+                with self._lock:
+                    state = self._get(doc.id)
+                    # Só adotar estados mais recentes do que o local
+                    if remote.get('changedAt', 0) <= state.changed_at:
+                        continue
+                    state.changed_at = remote.get('changedAt', 0)
+                    state.cooldown = remote.get('cooldownSeconds', 0.0)
+                    if remote.get('state') == OPEN:
+                        state.state = OPEN
+                        state.open_until = remote.get('openUntil', 0.0)
+                    else:
+                        state.state = CLOSED
+                        state.open_until = 0.0
+                        state.consecutive_failures = 0
+                    state.probing = False
+        except Exception as e:
+            log.warning("Erro ao sincronizar estado dos modelos: %s", e)
+        finally:
+            self._syncing = False
+
+
+model_health = ModelHealthTracker()
@@ -0,0 +1,298 @@
+"""Outbox de notificações do Telegram com envio em background.
+
+O `report_issue` e o relatório diário faziam `requests.post` ao Telegram dentro
+do pedido e, se o envio falhasse, a notificação perdia-se. Agora a notificação é
+gravada em `notifications_outbox` (no caso dos reports, no mesmo batch que o
+report) e uma thread em cada worker envia-a:
+
+- Uma única `requests.Session` por processo (ligação reutilizada).
+- Ritmo mínimo entre mensagens e respeito pelo `retry_after` dos 429.
+- Retry com backoff exponencial; depois de `MAX_ATTEMPTS` a notificação fica
+  `failed` no outbox.
+- Rajadas de reports que chegam dentro de `NOTIFY_DIGEST_WINDOW` segundos são
+  enviadas numa só mensagem (digest).
+
+Cada notificação é reclamada por um worker com um update condicional
+(`last_update_time`) que adia o `nextAttemptAt`; se esse worker morrer, a
+notificação volta a estar pronta quando o prazo passar e outro worker envia-a.
+"""
+import os
+import threading
+import time
+from datetime import timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from google.api_core.exceptions import AlreadyExists
+from firebase_admin import firestore
+from helpers import claim, utc_now
+from logs import get_logger
+
+log = get_logger('notifications')
+
+OUTBOX_COLLECTION = 'notifications_outbox'
+
+DIGEST_WINDOW_SECONDS = float(os.getenv("NOTIFY_DIGEST_WINDOW", "5"))
+POLL_INTERVAL_SECONDS = 15
+# O Telegram aceita ~1 mensagem por segundo no mesmo chat
+MIN_SEND_INTERVAL_SECONDS = 1.1
+MAX_ATTEMPTS = 10
+MAX_BACKOFF_SECONDS = 3600
+CLAIM_SECONDS = 60
+BATCH_LIMIT = 50
+# Limite do Telegram é 4096 caracteres por mensagem
+MAX_MESSAGE_CHARS = 4000
+DIGEST_DESCRIPTION_CHARS = 300
+
+
+def telegram_config():
+    """(token, chat_id) ou (None, None) se o Telegram não estiver configurado"""
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    chat_id = os.getenv("TELEGRAM_CHAT_ID")
+    if token and chat_id:
+        return token, chat_id
+    return None, None
+
+
+def format_report(user_id, email, severity, page, description):
+    """Mensagem completa e linha de digest de um report"""
+    text = f"🚨 *New Report from Luna AI*\n\n" \
+           f"👤 *User:* `{user_id or 'Anonymous'}`\n" \
+           f"📧 *Email:* `{email or 'N/A'}`\n" \
+           f"⚠️ *Severity:* {severity.upper()}\n" \
+           f"📄 *Page:* `{page}`\n\n" \
+           f"📝 *Description:*\n{description}"
+    short = description if len(description) <= DIGEST_DESCRIPTION_CHARS else description[:DIGEST_DESCRIPTION_CHARS] + '...'
+    digest = f"⚠️ *{severity.upper()}* · `{page}` · `{user_id or 'Anonymous'}`\n{short}"
+    return text, digest
+
+
+class TelegramError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class NotificationOutbox:
+    def __init__(self):
+        self._db = None
+        self._session = None
+        self._pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._last_send = 0.0
+        self.sent = 0
+        self.digests = 0
+        self.failures = 0
+        self.retries = 0
+
+    def attach(self, db):
+        self._db = db
+        self._ensure_started()
+
+    # ---------- Enfileirar ----------
+
+    def add_to_batch(self, batch, kind, text, digest=None, parse_mode=None):
+        """Acrescentar a notificação a um batch (gravada atomicamente com o resto).
+
+        Chamar `wake()` depois do commit.
+        """
+        ref = self._db.collection(OUTBOX_COLLECTION).document()
+        batch.set(ref, self._document(kind, text, digest, parse_mode))
+        return ref
+
+    def enqueue(self, kind, text, parse_mode=None, dedupe_key=None):
+        """Gravar uma notificação no outbox e acordar o sender.
+
+        Com `dedupe_key` o id do documento é fixo: enfileirar de novo a mesma
+        notificação (ex.: um job retomado) não a duplica.
+        """
+        collection = self._db.collection(OUTBOX_COLLECTION)
+        ref = collection.document(dedupe_key) if dedupe_key else collection.document()
+        try:
+            ref.create(self._document(kind, text, None, parse_mode))
+        except AlreadyExists:
+            log.info("Notificação %s já estava no outbox", dedupe_key)
+        self.wake()
+        return ref.id
+
+    def wake(self):
+        self._ensure_started()
+        self._wake.set()
+
+    def _document(self, kind, text, digest, parse_mode):
+        now = utc_now()
+        return {
+            'kind': kind,
+            'text': text,
+            'digest': digest,
+            'parseMode': parse_mode,
+            'status': 'pending',
+            'attempts': 0,
+            'nextAttemptAt': now,
+            'createdAt': now
+        }
+
+    # ---------- Sender ----------
+
+    def _ensure_started(self):
+        # Thread e sessão HTTP por processo (fork-safe)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            self._session = session
+            self._wake = threading.Event()
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='notifications', daemon=True).start()
+
+    def _run(self):
+        while self._pid == os.getpid():
+            woken = self._wake.wait(POLL_INTERVAL_SECONDS)
+            self._wake.clear()
+            if woken:
+                # Juntar a rajada num digest
+                time.sleep(DIGEST_WINDOW_SECONDS)
+            try:
+                self.drain()
+            except Exception as e:
+                log.warning("Erro no envio de notificações: %s", e)
+
+    def drain(self):
+        """Enviar as notificações pendentes que já estão prontas"""
+        if not self._db:
+            return
+        token, chat_id = telegram_config()
+        if not token:
+            return
+        now = utc_now()
+        docs = self._db.collection(OUTBOX_COLLECTION)\
+            .where(filter=firestore.FieldFilter('status', '==', 'pending'))\
+            .where(filter=firestore.FieldFilter('nextAttemptAt', '<=', now))\
+            .order_by('nextAttemptAt')\
+            .limit(BATCH_LIMIT)\
+            .stream()
+        claimed = [doc for doc in docs if claim(self._db, doc, now, CLAIM_SECONDS)]
+        if not claimed:
+            return
+
+        reports = [doc for doc in claimed if doc.to_dict().get('kind') == 'report']
+        others = [doc for doc in claimed if doc.to_dict().get('kind') != 'report']
+        for doc in others:
+            data = doc.to_dict()
+            self._deliver([doc], data['text'], data.get('parseMode'), token, chat_id)
+        if len(reports) == 1:
+            data = reports[0].to_dict()
+            self._deliver(reports, data['text'], data.get('parseMode'), token, chat_id)
+        elif reports:
+            for group, text in _build_digests(reports):
+                self._deliver(group, text, 'Markdown', token, chat_id)
+                self.digests += 1
+
+    def _deliver(self, docs, text, parse_mode, token, chat_id):
+        try:
+            self._send(text, parse_mode, token, chat_id)
+        except Exception as e:
+            self.failures += 1
+            log.warning("Erro ao enviar notificação Telegram (%d no envio): %s", len(docs), e)
+            self._mark_failed(docs, e)
+            return
+        self.sent += len(docs)
+        sent_at = utc_now()
+        batch = self._db.batch()
+        for doc in docs:
+            batch.update(doc.reference, {'status': 'sent', 'sentAt': sent_at, 'digestSize': len(docs)})
+        batch.commit()
+        log.info("Telegram: %d notificação(ões) enviada(s)", len(docs))
+
+    def _mark_failed(self, docs, error):
+        batch = self._db.batch()
+        for doc in docs:
+            attempts = doc.to_dict().get('attempts', 0) + 1
+            fields = {'attempts': attempts, 'lastError': str(error)}
+            if attempts >= MAX_ATTEMPTS:
+                fields['status'] = 'failed'
+            else:
+                self.retries += 1
+                backoff = getattr(error, 'retry_after', None) or min(5 * (2 ** (attempts - 1)), MAX_BACKOFF_SECONDS)
+                fields['nextAttemptAt'] = utc_now() + timedelta(seconds=backoff)
+            batch.update(doc.reference, fields)
+        batch.commit()
+
+    def _send(self, text, parse_mode, token, chat_id):
+        # Ritmo mínimo entre mensagens (limite do Telegram por chat)
+        wait = self._last_send + MIN_SEND_INTERVAL_SECONDS - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        payload = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        waited = False
+        while True:
+            resp = self._session.post(f"https://api.telegram.org/bot{token}/sendMessage", json=payload, timeout=10)
+            self._last_send = time.monotonic()
+            if resp.status_code == 200:
+                return
+            body = _json_or_empty(resp)
+            retry_after = (body.get('parameters') or {}).get('retry_after')
+            if resp.status_code == 429 and retry_after and retry_after <= 30 and not waited:
+                waited = True
+                time.sleep(retry_after)
+                continue
+            if resp.status_code == 400 and 'parse_mode' in payload:
+                # Texto do utilizador com Markdown inválido: enviar como texto simples
+                payload.pop('parse_mode')
+                continue
+            raise TelegramError(f"{resp.status_code} - {body.get('description') or resp.text[:200]}", retry_after)
+
+    def send_now(self, text, parse_mode=None):
+        """Envio síncrono, só para quando não há Firestore para o outbox"""
+        token, chat_id = telegram_config()
+        self._ensure_started()
+        self._send(text, parse_mode, token, chat_id)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'digests': self.digests,
+            'failures': self.failures,
+            'retries': self.retries,
+            'running': self._pid == os.getpid()
+        }
+
+
+def _json_or_empty(resp):
+    try:
+        return resp.json()
+    except ValueError:
+        return {}
+
+
+def _build_digests(reports):
+    """Agrupar reports em mensagens de digest até ao limite de caracteres.
+
+    Devolve [(documentos, texto)].
+    """
+    digests = []
+    group, lines = [], []
+    size = 0
+    for doc in reports:
+        data = doc.to_dict()
+        line = data.get('digest') or data.get('text', '')
+        if group and size + len(line) + 2 > MAX_MESSAGE_CHARS - 100:
+            digests.append((group, lines))
+            group, lines, size = [], [], 0
+        group.append(doc)
+        lines.append(line)
+        size += len(line) + 2
+    if group:
+        digests.append((group, lines))
+    return [
+        (docs, f"🚨 *{len(docs)} new reports from Luna AI*\n\n" + "\n\n".join(lines))
+        for docs, lines in digests
+    ]
+
+
+notifications = NotificationOutbox()
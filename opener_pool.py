@@ -0,0 +1,169 @@
+"""Respostas pré-geradas para a primeira mensagem quando é só um cumprimento.
+
+Grande parte das conversas novas começa com "hi", "olá", "hey"... e cada uma
+custava uma chamada completa ao Gemini. Um classificador local (sem chamar a API)
+deteta estes cumprimentos e a língua; o `chat()` responde com uma variante do pool
+de (persona, língua). Cada variante é servida uma única vez e o pool é reposto em
+background quando desce abaixo de metade, com várias variantes geradas numa só
+chamada para as respostas não se repetirem.
+
+O pool é por worker e começa vazio: o primeiro cumprimento de cada (persona,
+língua) vai ao Gemini como antes e dispara o preenchimento.
+"""
+import os
+import re
+import threading
+import unicodedata
+from collections import deque
+from helpers import ProcessExecutor
+from logs import get_logger
+
+log = get_logger('opener_pool')
+
+POOL_SIZE = int(os.getenv("OPENER_POOL_SIZE", "8"))
+# Repor o pool quando tiver menos do que isto
+LOW_WATER = max(1, POOL_SIZE // 2)
+# Cumprimentos mais compridos do que isto já não são "triviais"
+MAX_GREETING_CHARS = 40
+VARIANT_SEPARATOR = '###'
+
+LANGUAGE_NAMES = {
+    'en': 'English',
+    'pt': 'Portuguese',
+    'es': 'Spanish',
+    'fr': 'French',
+    'de': 'German',
+    'it': 'Italian'
+}
+
+# Cumprimentos já normalizados (minúsculas, sem acentos nem pontuação)
+GREETINGS = {
+    'en': {'hi', 'hello', 'hey', 'hiya', 'heya', 'yo', 'sup', 'howdy', 'hi there', 'hey there',
+           'hello there', 'whats up', 'wassup', 'good morning', 'good afternoon', 'good evening',
+           'hi how are you', 'hey how are you', 'hello how are you'},
+    'pt': {'oi', 'oie', 'ola', 'ei', 'e ai', 'eai', 'bom dia', 'boa tarde', 'boa noite', 'tudo bem',
+           'oi tudo bem', 'ola tudo bem', 'oi tudo bom', 'ola tudo bom', 'oi como estas', 'ola como estas'},
+    'es': {'hola', 'buenas', 'buenos dias', 'buenas tardes', 'buenas noches', 'que tal', 'hola que tal',
+           'hola como estas'},
+    'fr': {'salut', 'bonjour', 'bonsoir', 'coucou', 'salut ca va', 'bonjour ca va'},
+    'de': {'hallo', 'moin', 'servus', 'guten morgen', 'guten tag', 'guten abend', 'hallo wie gehts'},
+    'it': {'ciao', 'buongiorno', 'buonasera', 'ciao come stai'}
+}
+
+# Palavras ignoradas no fim do cumprimento ("hi luna", "olá querida")
+_TRAILING_WORDS = {'luna', 'babe', 'baby', 'dear', 'querida', 'linda', 'guapa', 'bella'}
+
+
+def _normalize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^a-z\s]", ' ', text)
+    words = text.split()
+    while len(words) > 1 and words[-1] in _TRAILING_WORDS:
+        words.pop()
+    return ' '.join(words)
+
+
+def classify_greeting(message):
+    """Língua do cumprimento ('en', 'pt', ...) ou None se não for só um cumprimento"""
+    if not message or len(message) > MAX_GREETING_CHARS:
+        return None
+    text = _normalize(message)
+    if not text:
+        return None
+    # "heyyy", "oiii", "helloooo" -> "hey", "oi", "hello"
+    candidates = (text, re.sub(r'(\w)\1{2,}', r'\1', text), re.sub(r'(\w)\1+', r'\1', text))
+    for language, greetings in GREETINGS.items():
+        if any(candidate in greetings for candidate in candidates):
+            return language
+    return None
+
+
+def _build_opener_prompt(language, count):
+    language_name = LANGUAGE_NAMES[language]
+    return f"""This is the FIRST message in your conversation: someone new just said hi to you in {language_name}.
+Write {count} different replies you could send back. Be friendly, curious and show genuine interest in getting to know them.
+Every reply must be in {language_name}. Vary the wording, the length and the question you ask.
+Separate the replies with a line containing only {VARIANT_SEPARATOR}. Do not number them or write anything else."""
+
+
+def _parse_variants(text):
+    variants = []
+    for part in (text or '').split(VARIANT_SEPARATOR):
+        variant = part.strip()
+        if variant and variant not in variants:
+            variants.append(variant)
+    return variants
+
+
+class OpenerPool:
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._pools = {}  # (persona, língua) -> deque de variantes
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._executor = ProcessExecutor(1, 'openers')
+        self.greetings = 0
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_errors = 0
+
+    def take(self, persona, language, generate):
+        """Tirar uma variante do pool (ou None) e repor em background se preciso.
+
+        `generate(prompt, persona)` deve devolver o texto gerado pelo modelo.
+        """
+        key = (persona, language)
+        with self._lock:
+            self.greetings += 1
+            pool = self._pools.setdefault(key, deque())
+            reply = pool.popleft() if pool else None
+            if reply:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if len(pool) < LOW_WATER and key not in self._refilling:
+                self._refilling.add(key)
+                self._executor.submit(self._refill, key, generate)
+        return reply
+
+    def clear(self):
+        with self._lock:
+            self._pools.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'greetings': self.greetings,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / self.greetings, 3) if self.greetings else 0.0,
+                'refills': self.refills,
+                'refillErrors': self.refill_errors,
+                'pools': {f"{persona}|{language}": len(pool) for (persona, language), pool in self._pools.items()}
+            }
+
+    def _refill(self, key, generate):
+        persona, language = key
+        try:
+            with self._lock:
+                missing = self.size - len(self._pools.get(key, ()))
+            if missing <= 0:
+                return
+            variants = _parse_variants(generate(_build_opener_prompt(language, missing), persona))
+            with self._lock:
+                pool = self._pools.setdefault(key, deque())
+                pool.extend(v for v in variants[:missing] if v not in pool)
+                self.refills += 1
+            log.info("Pool de cumprimentos reposto: %s / %s (+%d)", persona, language, min(len(variants), missing))
+        except Exception as e:
+            with self._lock:
+                self.refill_errors += 1
+            log.warning("Erro ao repor pool de cumprimentos (%s / %s): %s", persona, language, e)
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+
+opener_pool = OpenerPool()
@@ -0,0 +1,110 @@
+"""Leituras de pre-flight do chat executadas em paralelo.
+
+As leituras ao Firestore antes da chamada ao Gemini (contador da persona,
+subscrição e quota) são independentes, por isso são lançadas ao mesmo tempo num
+pool de threads limitado (dimensionado pela concorrência do worker). A latência
+total fica próxima da leitura mais lenta em vez da soma de todas.
+
+O timeout de cada leitura conta a partir do momento em que ela começa a correr,
+não do submit: uma leitura à espera na fila da pool não expira sem ter
+começado. Se a pool estiver ocupada (a leitura não começou dentro de
+`PREFLIGHT_QUEUE_WAIT`), a leitura é cancelada na pool e corre na thread do
+pedido.
+"""
+import contextvars
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from helpers import ProcessExecutor, timed
+from serving import request_concurrency
+
+# Até 4 leituras por pedido: por defeito a pool acompanha a concorrência do
+# worker (GUNICORN_THREADS no gthread, GUNICORN_WORKER_CONNECTIONS no gevent)
+READS_PER_REQUEST = 4
+PREFLIGHT_WORKERS = int(os.getenv("PREFLIGHT_WORKERS") or READS_PER_REQUEST * request_concurrency())
+PREFLIGHT_TIMEOUT = float(os.getenv("PREFLIGHT_TIMEOUT", "10"))
+PREFLIGHT_QUEUE_WAIT = float(os.getenv("PREFLIGHT_QUEUE_WAIT", "0.05"))
+
+_executor = ProcessExecutor(PREFLIGHT_WORKERS, 'preflight')
+
+
+class PreflightResult:
+    def __init__(self):
+        self.values = {}
+        self.errors = {}
+        self.timings = {}
+        self.total_ms = 0.0
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def timings_summary(self):
+        parts = [f"{name}={ms:.0f}ms" for name, ms in self.timings.items()]
+        return f"total={self.total_ms:.0f}ms " + " ".join(parts)
+
+
+class _Task:
+    """Leitura submetida à pool; guarda quando começou a correr"""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.started_at = None
+
+    def __call__(self):
+        self.started_at = time.monotonic()
+        return timed(self.fn)
+
+
+def _store(result, name, outcome):
+    value, error, elapsed_ms = outcome
+    result.timings[name] = elapsed_ms
+    if error is not None:
+        result.errors[name] = error
+    else:
+        result.values[name] = value
+
+
+def run_preflight(tasks, timeout=PREFLIGHT_TIMEOUT, queue_wait=PREFLIGHT_QUEUE_WAIT):
+    """Executar `tasks` ({nome: função}) em paralelo e juntar os resultados.
+
+    Os erros de cada leitura ficam em `errors[nome]` para o chamador decidir o
+    fallback; leituras que não terminam dentro do `timeout` (contado desde que
+    começaram) contam como erro.
+    """
+    result = PreflightResult()
+    start = time.perf_counter()
+    executor = _executor.get()
+    submitted_at = time.monotonic()
+    pending = {name: _Task(fn) for name, fn in tasks.items()}
+    # Cada leitura corre com o contexto do pedido (request id nos logs)
+    futures = {name: executor.submit(contextvars.copy_context().run, task) for name, task in pending.items()}
+
+    while pending:
+        now = time.monotonic()
+        deadlines = []
+        for name, task in list(pending.items()):
+            future = futures[name]
+            if future.done():
+                _store(result, name, future.result())
+                del pending[name]
+            elif task.started_at is None:
+                if now - submitted_at < queue_wait:
+                    deadlines.append(submitted_at + queue_wait)
+                elif future.cancel():
+                    # Pool ocupada: a leitura ainda não começou, corre aqui
+                    _store(result, name, timed(task.fn))
+                    del pending[name]
+                else:
+                    deadlines.append(now + 0.001)  # Começou entretanto
+            elif now - task.started_at >= timeout:
+                result.errors[name] = TimeoutError(f"Pre-flight '{name}' timed out")
+                result.timings[name] = timeout * 1000
+                del pending[name]
+            else:
+                deadlines.append(task.started_at + timeout)
+        if pending:
+            wait([futures[name] for name in pending], timeout=max(0.001, min(deadlines) - time.monotonic()),
+                 return_when=FIRST_COMPLETED)
+
+    result.total_ms = (time.perf_counter() - start) * 1000
+    return result
@@ -0,0 +1,190 @@
+"""Context caching do Gemini para a parte estática do prompt.
+
+O prompt da persona (`PERSONA_PROMPTS`) e as `CRITICAL_RULES` não mudam entre
+pedidos, por isso vão como system instruction e são registados uma vez por
+(persona, modelo) como cached content. Cada pedido só envia a parte dinâmica
+(contexto da conversa e a mensagem do utilizador).
+
+Os handles ficam em `prompt_caches/{persona}__{modelo}` para serem partilhados
+pelos workers, com o hash do texto estático: se o prompt de uma persona mudar, o
+hash deixa de coincidir e o cache é recriado. O TTL é renovado em background
+antes de expirar. Enquanto não há cache (ou se o modelo o recusar), o texto
+estático segue como system instruction normal.
+
+O Gemini só aceita cached content a partir de um número mínimo de tokens (4096
+nos modelos 2.x, 32768 nos 1.5). Um prefixo mais curto nunca é enviado para o
+`caches.create`: a estimativa de tokens é feita localmente e, abaixo do mínimo
+do modelo, o pedido usa logo a system instruction. Com os prompts atuais (~300
+tokens) é sempre esse o caminho; o cache passa a ser usado se o texto estático
+crescer acima do mínimo.
+"""
+import hashlib
+import os
+import threading
+import time
+from google.genai import types
+from helpers import ProcessExecutor
+from utils import PERSONA_PROMPTS, CRITICAL_RULES
+from logs import get_logger
+
+log = get_logger('prompt_cache')
+
+CACHES_COLLECTION = 'prompt_caches'
+
+CACHE_TTL_SECONDS = int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+# Renovar o TTL quando faltar menos do que isto para expirar
+REFRESH_MARGIN_SECONDS = 300
+# Depois de uma falha a criar o cache, esperar antes de tentar de novo
+FAILURE_BACKOFF_SECONDS = 3600
+# Mínimo de tokens do cached content por família de modelo (prefixo do nome)
+MIN_CACHE_TOKENS = {'gemini-1.5': 32768}
+DEFAULT_MIN_CACHE_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "4096"))
+# Estimativa conservadora (texto em inglês/português): ~4 caracteres por token
+CHARS_PER_TOKEN = 4
+
+
+def static_prefix(persona):
+    """Texto estático da persona: prompt da personalidade + regras"""
+    persona_prompt = PERSONA_PROMPTS.get(persona, PERSONA_PROMPTS['Luna'])
+    return f"{persona_prompt}\n\n{CRITICAL_RULES}"
+
+
+def uncached_config(persona):
+    return types.GenerateContentConfig(system_instruction=static_prefix(persona))
+
+
+def min_cache_tokens(model):
+    for family, minimum in MIN_CACHE_TOKENS.items():
+        if model.startswith(family):
+            return minimum
+    return DEFAULT_MIN_CACHE_TOKENS
+
+
+def cacheable(model, prefix):
+    """True se o prefixo pode chegar ao mínimo de tokens do cached content do modelo"""
+    return len(prefix) / CHARS_PER_TOKEN >= min_cache_tokens(model)
+
+
+def _prefix_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class PromptCacheRegistry:
+    def __init__(self):
+        self._entries = {}  # (persona, modelo) -> {'name', 'hash', 'expires_at'}
+        self._failures = {}  # (persona, modelo) -> instante da última falha
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._executor = ProcessExecutor(1, 'prompt-cache')
+        self._db = None
+
+    def attach(self, db):
+        """Partilhar os handles dos caches entre workers através do Firestore"""
+        self._db = db
+
+    def generation_config(self, client, model, persona):
+        """GenerateContentConfig com o cached content, ou com a system instruction
+        enquanto o cache não estiver disponível"""
+        prefix = static_prefix(persona)
+        if not cacheable(model, prefix):
+            # Curto demais para o Gemini aceitar o cache: nem tentar o create
+            return uncached_config(persona)
+        prefix_hash = _prefix_hash(prefix)
+        key = (persona, model)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            valid = entry is not None and entry['hash'] == prefix_hash and entry['expires_at'] > now + 5
+            needs_work = not valid or entry['expires_at'] - now < REFRESH_MARGIN_SECONDS
+            backing_off = now - self._failures.get(key, 0) < FAILURE_BACKOFF_SECONDS
+            if needs_work and not backing_off and key not in self._in_flight:
+                self._in_flight.add(key)
+                self._executor.submit(self._ensure_cache, client, model, persona, prefix, prefix_hash, entry if valid else None)
+
+        if valid:
+            return types.GenerateContentConfig(cached_content=entry['name'])
+        return uncached_config(persona)
+
+    def invalidate(self, persona, model):
+        """Esquecer um cache que o modelo recusou (expirado ou apagado)"""
+        with self._lock:
+            self._entries.pop((persona, model), None)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {
+                f"{persona}|{model}": {
+                    'name': entry['name'],
+                    'hash': entry['hash'],
+                    'expiresInSeconds': round(entry['expires_at'] - now)
+                }
+                for (persona, model), entry in self._entries.items()
+            }
+
+    def _ensure_cache(self, client, model, persona, prefix, prefix_hash, current):
+        key = (persona, model)
+        try:
+            if current is not None:
+                # Cache válido mas perto de expirar: só renovar o TTL
+                client.caches.update(name=current['name'], config=types.UpdateCachedContentConfig(ttl=f"{CACHE_TTL_SECONDS}s"))
+                self._set_entry(key, current['name'], prefix_hash, time.time() + CACHE_TTL_SECONDS)
+                return
+
+            shared = self._load_shared(key)
+            if shared and shared.get('hash') == prefix_hash and shared.get('expiresAt', 0) > time.time() + REFRESH_MARGIN_SECONDS:
+                self._set_entry(key, shared['name'], prefix_hash, shared['expiresAt'], publish=False)
+                return
+
+            cache = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"luna-{persona}-{prefix_hash}",
+                    system_instruction=prefix,
+                    ttl=f"{CACHE_TTL_SECONDS}s"
+                )
+            )
+            self._set_entry(key, cache.name, prefix_hash, time.time() + CACHE_TTL_SECONDS)
+            log.info("Prompt cache criado: %s / %s (%s)", persona, model, cache.name)
+
+            # Um cache antigo (prompt da persona alterado) deixa de ser usado
+            if shared and shared.get('name') and shared.get('hash') != prefix_hash:
+                try:
+                    client.caches.delete(name=shared['name'])
+                except Exception:
+                    pass
+        except Exception as e:
+            with self._lock:
+                self._failures[key] = time.time()
+                self._entries.pop(key, None)
+            log.warning("Prompt cache indisponível para %s / %s (a usar system instruction): %s", persona, model, e)
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def _set_entry(self, key, name, prefix_hash, expires_at, publish=True):
+        with self._lock:
+            self._entries[key] = {'name': name, 'hash': prefix_hash, 'expires_at': expires_at}
+            self._failures.pop(key, None)
+        if publish and self._db:
+            try:
+                self._db.collection(CACHES_COLLECTION).document(f"{key[0]}__{key[1]}").set({
+                    'name': name,
+                    'hash': prefix_hash,
+                    'expiresAt': expires_at
+                })
+            except Exception as e:
+                log.warning("Erro ao publicar prompt cache: %s", e)
+
+    def _load_shared(self, key):
+        if not self._db:
+            return None
+        try:
+            snapshot = self._db.collection(CACHES_COLLECTION).document(f"{key[0]}__{key[1]}").get()
+            return snapshot.to_dict() if snapshot.exists else None
+        except Exception:
+            return None
+
+
+prompt_cache = PromptCacheRegistry()
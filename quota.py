@@ -0,0 +1,88 @@
+"""Quota diária dos utilizadores free (janela deslizante de 24h).
+
+O uso de cada utilizador fica num único documento `quotas/{userId}` com um
+contador por hora (`buckets`). A janela de 24h é a soma dos últimos 24 buckets,
+por isso a verificação custa sempre uma leitura, independentemente do histórico.
+A reserva é feita numa transação antes da chamada ao Gemini e libertada se a
+chamada falhar.
+"""
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+
+QUOTAS_COLLECTION = 'quotas'
+FREE_DAILY_LIMIT = 20
+WINDOW_HOURS = 24
+
+
+def _bucket_key(moment):
+    return moment.strftime('%Y%m%d%H')
+
+
+def _window_buckets(buckets, now):
+    """Manter apenas os buckets dentro da janela de 24h"""
+    oldest = _bucket_key(now - timedelta(hours=WINDOW_HOURS - 1))
+    return {key: count for key, count in buckets.items() if key >= oldest and count > 0}
+
+
+def quota_ref(db, user_id):
+    return db.collection(QUOTAS_COLLECTION).document(user_id)
+
+
+def get_usage(db, user_id, now=None):
+    """Mensagens usadas nas últimas 24h (1 leitura, sem reservar)"""
+    now = now or datetime.now(timezone.utc)
+    snapshot = quota_ref(db, user_id).get()
+    if not snapshot.exists:
+        return 0
+    buckets = snapshot.to_dict().get('buckets', {})
+    return sum(_window_buckets(buckets, now).values())
+
+
+@firestore.transactional
+def _reserve_in_transaction(transaction, ref, now, limit):
+    snapshot = ref.get(transaction=transaction)
+    buckets = snapshot.to_dict().get('buckets', {}) if snapshot.exists else {}
+    buckets = _window_buckets(buckets, now)
+    used = sum(buckets.values())
+    if used >= limit:
+        return False, used, None
+
+    key = _bucket_key(now)
+    buckets[key] = buckets.get(key, 0) + 1
+    transaction.set(ref, {
+        'buckets': buckets,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    })
+    return True, used + 1, key
+
+
+def reserve_slot(db, user_id, limit=FREE_DAILY_LIMIT, now=None):
+    """Reservar uma mensagem na janela de 24h.
+
+    Devolve (permitido, usadas, bucket). O bucket deve ser passado a
+    `release_slot` se a mensagem não chegar a ser respondida.
+    """
+    now = now or datetime.now(timezone.utc)
+    return _reserve_in_transaction(db.transaction(), quota_ref(db, user_id), now, limit)
+
+
+@firestore.transactional
+def _release_in_transaction(transaction, ref, bucket):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return
+    buckets = snapshot.to_dict().get('buckets', {})
+    if buckets.get(bucket, 0) <= 0:
+        return
+    buckets[bucket] -= 1
+    transaction.set(ref, {
+        'buckets': buckets,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    })
+
+
+def release_slot(db, user_id, bucket):
+    """Devolver uma reserva feita com `reserve_slot`"""
+    if not bucket:
+        return
+    _release_in_transaction(db.transaction(), quota_ref(db, user_id), bucket)
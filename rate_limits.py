@@ -0,0 +1,199 @@
+"""Rate limiting por utilizador e por tier, partilhado entre workers.
+
+O `Limiter` usava o IP (`get_remote_address`) e `memory://`: cada worker do
+gunicorn tinha a sua própria cópia de "10 per minute" e utilizadores atrás do
+mesmo NAT da operadora gastavam o limite uns dos outros.
+
+- A chave dos limites de cada endpoint é o `userId` do pedido (query string ou
+  corpo JSON) quando é válido; sem `userId` continua a ser o IP.
+- O `userId` não é autenticado, por isso rodar ids não pode furar os limites:
+  esses endpoints têm também um teto por IP (`RATE_LIMIT_CHAT_IP` no chat,
+  `RATE_LIMIT_IP` nos outros), alto o suficiente para vários utilizadores atrás
+  do mesmo NAT. Os limites por defeito (endpoints sem limite próprio) são só
+  por IP.
+- Os endpoints de chat têm orçamentos diferentes para free e Plus
+  (`RATE_LIMIT_CHAT_FREE`/`RATE_LIMIT_CHAT_PLUS`); o tier vem do cache de
+  subscrições.
+- O estado fica num store partilhado (`RATE_LIMIT_STORAGE`): `sqlite:///caminho`
+  para uma só máquina (todos os workers usam o mesmo ficheiro) ou `redis://...`
+  quando há várias instâncias. Se o store falhar, o flask-limiter passa para
+  memória local até ele voltar.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from flask import request
+from flask_limiter.util import get_remote_address
+from limits.storage import Storage
+from entitlements import entitlement_cache
+from utils import validate_user_id
+from logs import get_logger
+
+log = get_logger('rate_limits')
+
+DEFAULT_SQLITE_PATH = os.path.join(tempfile.gettempdir(), 'luna-rate-limits.sqlite')
+DEFAULT_STORAGE = f"sqlite://{DEFAULT_SQLITE_PATH}"
+
+TIER_LIMITS = {
+    'chat': {
+        'free': os.getenv("RATE_LIMIT_CHAT_FREE", "10 per minute"),
+        'plus': os.getenv("RATE_LIMIT_CHAT_PLUS", "30 per minute")
+    }
+}
+
+# Teto por IP por cima dos limites por utilizador
+IP_LIMITS = {
+    'chat': os.getenv("RATE_LIMIT_CHAT_IP", "60 per minute;1000 per day"),
+    'default': os.getenv("RATE_LIMIT_IP", "300 per minute")
+}
+
+# Apagar janelas expiradas a cada N incrementos
+CLEANUP_EVERY = 1000
+
+
+class SQLiteStorage(Storage):
+    """Store de janelas fixas num ficheiro SQLite partilhado pelos workers.
+
+    Registado no `limits` pelo esquema `sqlite://` (basta importar o módulo).
+    """
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        path = (uri or "")[len("sqlite://"):] or DEFAULT_SQLITE_PATH
+        self.path = path
+        self._local = threading.local()
+        self._increments = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits "
+                "(key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL NOT NULL)"
+            )
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        # Uma ligação por thread e por processo (as ligações não sobrevivem ao fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value, expires FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value, expires = amount, now + expiry
+            else:
+                value = row[0] + amount
+                expires = now + expiry if elastic_expiry else row[1]
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, expires)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._increments += 1
+        if self._increments % CLEANUP_EVERY == 0:
+            conn.execute("DELETE FROM rate_limits WHERE expires <= ?", (now,))
+        return value
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM rate_limits WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self._connection().execute(
+            "SELECT expires FROM rate_limits WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self._connection().execute("DELETE FROM rate_limits").rowcount
+
+    def clear(self, key):
+        self._connection().execute("DELETE FROM rate_limits WHERE key = ?", (key,))
+
+
+def _request_user_id():
+    user_id = request.args.get('userId')
+    if not user_id and request.is_json:
+        user_id = (request.get_json(silent=True) or {}).get('userId')
+    return user_id if user_id and validate_user_id(user_id) else None
+
+
+def rate_limit_key():
+    """Chave do rate limit: o utilizador se o pedido o identificar, senão o IP"""
+    user_id = _request_user_id()
+    return f"user:{user_id}" if user_id else f"ip:{get_remote_address()}"
+
+
+class TierLimits:
+    def __init__(self):
+        self._db = None
+        self._lock = threading.Lock()
+        self._checks = {}
+        self._breaches = {}
+
+    def attach(self, db):
+        self._db = db
+
+    def tier(self):
+        user_id = _request_user_id()
+        if not user_id or not self._db:
+            return 'free'
+        try:
+            return 'plus' if entitlement_cache.is_plus(self._db, user_id) else 'free'
+        except Exception as e:
+            log.warning("Erro ao ler tier para rate limit (a usar free): %s", e)
+            return 'free'
+
+    def limit_for(self, scope):
+        """Callable para `limiter.limit`: o orçamento do tier do pedido atual"""
+        def resolve():
+            tier = self.tier()
+            with self._lock:
+                self._checks[(scope, tier)] = self._checks.get((scope, tier), 0) + 1
+            return TIER_LIMITS[scope][tier]
+        return resolve
+
+    def on_breach(self, request_limit):
+        scope = request.endpoint or 'default'
+        kind = 'user' if 'user:' in (request_limit.key or '') else 'ip'
+        with self._lock:
+            self._breaches[(scope, kind)] = self._breaches.get((scope, kind), 0) + 1
+        log.warning("Rate limit atingido: %s (%s) por %s", scope, request_limit.limit, kind)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checks': {f"{scope}:{tier}": count for (scope, tier), count in self._checks.items()},
+                'breaches': {f"{scope}:{kind}": count for (scope, kind), count in self._breaches.items()},
+                'limits': TIER_LIMITS
+            }
+
+
+tier_limits = TierLimits()
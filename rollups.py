@@ -0,0 +1,230 @@
+"""Métricas agregadas por hora em `stats/{yyyy-mm-dd-hh}`.
+
+Perguntas como "mensagens por persona ontem" ou "utilizadores free que chegaram
+ao limite esta semana" obrigavam a percorrer `chats`. Os eventos (turnos de chat
+por persona e tier, limites atingidos, checkouts, alterações de subscrição e
+reports) passam a incrementar contadores no documento da hora em que acontecem.
+
+Para não fazer uma escrita por evento (nem disputar o mesmo documento entre
+workers), cada worker junta os incrementos em memória e grava-os a cada
+`ROLLUP_FLUSH_SECONDS` com um único `set(merge=True)` por hora, usando
+`Increment` e `ArrayUnion`. Uma consulta de um intervalo lê um documento por hora
+(O(horas)), independentemente do volume de dados.
+
+O documento `stats_meta/rollups` guarda desde quando há rollups (`since`), para
+o relatório diário saber se pode confiar neles.
+"""
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from logs import get_logger
+
+log = get_logger('rollups')
+
+STATS_COLLECTION = 'stats'
+META_COLLECTION = 'stats_meta'
+FLUSH_INTERVAL_SECONDS = float(os.getenv("ROLLUP_FLUSH_SECONDS", "10"))
+# Consultas maiores do que isto são recusadas (~3 meses de documentos horários)
+MAX_QUERY_HOURS = 24 * 93
+
+
+def hour_key(moment):
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%d-%H')
+
+
+def hour_start(moment):
+    return moment.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _merge_counts(target, source):
+    """Somar recursivamente mapas de contadores"""
+    for key, value in source.items():
+        if isinstance(value, dict):
+            _merge_counts(target.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)):
+            target[key] = target.get(key, 0) + value
+
+
+def _as_increments(counts):
+    return {
+        key: _as_increments(value) if isinstance(value, dict) else firestore.Increment(value)
+        for key, value in counts.items()
+    }
+
+
+class RollupRecorder:
+    def __init__(self):
+        self._pending = {}  # hora -> {'counts': {...}, 'unique': {campo: set()}}
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._marked_since = False
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def attach(self, db):
+        self._db = db
+
+    # ---------- Eventos ----------
+
+    def record_chat_turn(self, persona, is_plus):
+        tier = 'plus' if is_plus else 'free'
+        self._add({'chatTurns': 1, 'chatTurnsByPersona': {persona: {tier: 1}}, 'chatTurnsByTier': {tier: 1}})
+
+    def record_limit_hit(self, user_id):
+        self._add({'limitHits': 1}, unique={'limitHitUsers': user_id})
+
+    def record_checkout(self, stage):
+        """`stage`: 'created' (sessão criada) ou 'completed' (pagamento concluído)"""
+        self._add({'checkouts': {stage: 1}})
+
+    def record_subscription_change(self, change):
+        """`change`: 'created', 'updated' ou 'cancelled'"""
+        self._add({'subscriptions': {change: 1}})
+
+    def record_report(self, severity):
+        self._add({'reports': {severity or 'unknown': 1}, 'reportsTotal': 1})
+
+    # ---------- Escrita ----------
+
+    def _add(self, counts, unique=None):
+        if not self._db:
+            return
+        self._ensure_started()
+        key = hour_key(datetime.now(timezone.utc))
+        with self._lock:
+            entry = self._pending.setdefault(key, {'counts': {}, 'unique': {}})
+            _merge_counts(entry['counts'], counts)
+            for field, value in (unique or {}).items():
+                entry['unique'].setdefault(field, set()).add(value)
+
+    def _ensure_started(self):
+        # Thread de flush por processo (fork-safe)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pending = {}
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='rollups', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while self._pid == os.getpid():
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+            self.flush()
+
+    def flush(self):
+        """Gravar os incrementos pendentes (um set por hora)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or not self._db:
+            return
+        try:
+            batch = self._db.batch()
+            for key, entry in pending.items():
+                data = _as_increments(entry['counts'])
+                for field, values in entry['unique'].items():
+                    data[field] = firestore.ArrayUnion(sorted(values))
+                data['hour'] = datetime.strptime(key, '%Y-%m-%d-%H').replace(tzinfo=timezone.utc)
+                data['updatedAt'] = firestore.SERVER_TIMESTAMP
+                batch.set(self._db.collection(STATS_COLLECTION).document(key), data, merge=True)
+            batch.commit()
+            self.flushes += 1
+        except Exception as e:
+            self.flush_errors += 1
+            log.warning("Erro ao gravar rollups (os incrementos voltam à fila): %s", e)
+            with self._lock:
+                for key, entry in pending.items():
+                    current = self._pending.setdefault(key, {'counts': {}, 'unique': {}})
+                    _merge_counts(current['counts'], entry['counts'])
+                    for field, values in entry['unique'].items():
+                        current['unique'].setdefault(field, set()).update(values)
+            return
+        try:
+            self._mark_since()
+        except Exception as e:
+            # Os incrementos já foram gravados: a marca é tentada de novo no próximo flush
+            log.warning("Erro ao marcar o início dos rollups: %s", e)
+
+    def _mark_since(self):
+        # Marca desde quando há rollups (só é escrita se ainda não existir)
+        if self._marked_since:
+            return
+        ref = self._db.collection(META_COLLECTION).document('rollups')
+        snapshot = ref.get()
+        if not (snapshot.to_dict() or {}).get('since'):
+            ref.set({'since': datetime.now(timezone.utc)}, merge=True)
+        self._marked_since = True
+
+    def stats(self):
+        with self._lock:
+            pending_hours = len(self._pending)
+        return {'pendingHours': pending_hours, 'flushes': self.flushes, 'flushErrors': self.flush_errors}
+
+
+rollups = RollupRecorder()
+
+
+# ---------- Leitura ----------
+
+def rollups_since(db):
+    """Instante desde o qual há rollups (ou None)"""
+    snapshot = db.collection(META_COLLECTION).document('rollups').get()
+    return (snapshot.to_dict() or {}).get('since') if snapshot.exists else None
+
+
+def load_rollups(db, start, end, timeout=None):
+    """Documentos horários entre `start` e `end` (inclusive), por ordem"""
+    docs = db.collection(STATS_COLLECTION)\
+        .where(filter=firestore.FieldFilter('hour', '>=', hour_start(start)))\
+        .where(filter=firestore.FieldFilter('hour', '<=', hour_start(end)))\
+        .order_by('hour')\
+        .stream(timeout=timeout)
+    return [(doc.id, doc.to_dict()) for doc in docs]
+
+
+def merge_rollups(documents):
+    """Juntar documentos horários: contadores somados, listas únicas contadas"""
+    totals = {}
+    unique = {}
+    for _, data in documents:
+        for field, value in data.items():
+            if field in ('hour', 'updatedAt'):
+                continue
+            if isinstance(value, list):
+                unique.setdefault(field, set()).update(value)
+            elif isinstance(value, dict):
+                _merge_counts(totals.setdefault(field, {}), value)
+            elif isinstance(value, (int, float)):
+                totals[field] = totals.get(field, 0) + value
+    for field, values in unique.items():
+        # "limitHitUsers" -> "limitHitUsersDistinct"
+        totals[f"{field}Distinct"] = len(values)
+    return totals
+
+
+def query_range(db, start, end, group='total'):
+    """Totais de um intervalo; com `group` 'hour' ou 'day' também a série"""
+    if end < start:
+        raise ValueError("'to' must be after 'from'")
+    if (end - start) > timedelta(hours=MAX_QUERY_HOURS):
+        raise ValueError(f"Range too large (max {MAX_QUERY_HOURS} hours)")
+    documents = load_rollups(db, start, end)
+    result = {
+        'from': hour_start(start).isoformat(),
+        'to': hour_start(end).isoformat(),
+        'hoursWithData': len(documents),
+        'totals': merge_rollups(documents)
+    }
+    if group in ('hour', 'day'):
+        buckets = {}
+        for key, data in documents:
+            bucket = key if group == 'hour' else key[:10]
+            buckets.setdefault(bucket, []).append((key, data))
+        result['series'] = [{'bucket': bucket, **merge_rollups(docs)} for bucket, docs in buckets.items()]
+    return result
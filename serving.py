@@ -0,0 +1,39 @@
+"""Ajustes de runtime para o perfil de workers do gunicorn (ver gunicorn.conf.py)."""
+import os
+from logs import get_logger
+
+log = get_logger('serving')
+
+
+def worker_class():
+    return os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+
+
+def request_concurrency():
+    """Pedidos em simultâneo por worker no perfil atual (os padrões são os do gunicorn.conf.py)"""
+    if worker_class() == "gevent":
+        return int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+    if worker_class() == "gthread":
+        return int(os.getenv("GUNICORN_THREADS", "64"))
+    return 1
+
+
+def init_async_runtime():
+    """Preparar o processo para o perfil gevent (antes de criar clientes gRPC).
+
+    O worker gevent do gunicorn faz o monkey patching antes de carregar a app,
+    mas o gRPC (Firestore) tem o seu próprio I/O em C e bloquearia o loop do
+    gevent; `init_gevent()` põe-no a cooperar com os greenlets.
+    """
+    if worker_class() != "gevent":
+        return
+    try:
+        from gevent import monkey
+        if not monkey.is_module_patched('socket'):
+            return
+        import grpc.experimental.gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+        log.info("gRPC integrado com o gevent")
+    except ImportError as e:
+        log.warning("Perfil gevent sem suporte completo (%s); pip install gevent", e)
+
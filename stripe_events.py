@@ -0,0 +1,350 @@
+"""Fila idempotente dos eventos do webhook do Stripe.
+
+O webhook lia e escrevia no Firestore dentro do pedido e não guardava que
+eventos já tinha tratado: os reenvios do Stripe voltavam a escrever (e a contar
+nos rollups) e um `customer.subscription.updated` atrasado podia repor um estado
+antigo depois de um `deleted`.
+
+Agora o webhook só grava o evento em `stripe_events/{event_id}` com `create()`
+(um reenvio com o mesmo id dá `AlreadyExists` e é ignorado) e responde 200. Uma
+thread em cada worker processa os eventos pendentes por ordem de `created`:
+
+- Cada evento é aplicado numa transação que lê `subscriptions/{userId}` e
+  compara `(created, rank)` do evento com o do último evento aplicado
+  (`lastEventCreated`/`lastEventRank`). Eventos mais antigos ficam `stale` e
+  não mexem na subscrição, por isso a ordem de chegada não altera o estado
+  final e reprocessar o registo de eventos dá sempre o mesmo resultado.
+- O evento passa a `processed` na mesma transação em que a subscrição é escrita.
+- Um `updated`/`deleted` que chega antes do `checkout.session.completed` (ainda
+  não há utilizador para a subscrição) é adiado com backoff até o checkout ser
+  processado.
+
+O utilizador de um `updated`/`deleted` é encontrado com um get direto nos
+índices inversos `stripe_subscriptions/{subscriptionId}` e
+`stripe_customers/{customerId}`, escritos na mesma transação que aplica o
+`checkout.session.completed` (em vez de uma query por `subscriptionId` em cada
+evento). Subscrições anteriores aos índices: `python backfill_stripe_index.py`.
+
+Os eventos são reclamados com um update condicional (`last_update_time`), como
+no outbox de notificações; se o worker morrer, o evento volta a ficar pronto.
+"""
+import os
+import threading
+from datetime import timedelta
+from google.api_core.exceptions import AlreadyExists
+from firebase_admin import firestore
+from entitlements import invalidate_entitlement
+from helpers import claim, utc_now
+from rollups import rollups
+from logs import get_logger
+
+log = get_logger('stripe_events')
+
+EVENTS_COLLECTION = 'stripe_events'
+SUBSCRIPTION_INDEX_COLLECTION = 'stripe_subscriptions'
+CUSTOMER_INDEX_COLLECTION = 'stripe_customers'
+
+PENDING = 'pending'
+PROCESSED = 'processed'
+STALE = 'stale'
+IGNORED = 'ignored'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# Desempate para eventos no mesmo segundo (o `created` do Stripe é em segundos):
+# o cancelamento prevalece sobre a atualização e esta sobre o checkout
+EVENT_RANKS = {
+    'checkout.session.completed': 0,
+    'customer.subscription.updated': 1,
+    'customer.subscription.deleted': 2
+}
+
+POLL_INTERVAL_SECONDS = 30
+CLAIM_SECONDS = 60
+BATCH_LIMIT = 100
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SECONDS = 600
+
+
+def subscription_index_ref(db, subscription_id):
+    return db.collection(SUBSCRIPTION_INDEX_COLLECTION).document(subscription_id)
+
+
+def customer_index_ref(db, customer_id):
+    return db.collection(CUSTOMER_INDEX_COLLECTION).document(customer_id)
+
+
+def write_reverse_index(writer, db, user_id, subscription_id, customer_id):
+    """Escrever os índices subscriptionId/customerId -> userId (transação ou batch)"""
+    if subscription_id:
+        writer.set(subscription_index_ref(db, subscription_id), {
+            'userId': user_id,
+            'customerId': customer_id,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        })
+    if customer_id:
+        writer.set(customer_index_ref(db, customer_id), {
+            'userId': user_id,
+            'subscriptionId': subscription_id,
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        })
+
+
+def find_user(db, subscription_id, customer_id=None):
+    """userId dono da subscrição (ou do customer), com gets diretos aos índices"""
+    if subscription_id:
+        snapshot = subscription_index_ref(db, subscription_id).get()
+        if snapshot.exists:
+            return snapshot.to_dict().get('userId')
+    if customer_id:
+        snapshot = customer_index_ref(db, customer_id).get()
+        if snapshot.exists:
+            return snapshot.to_dict().get('userId')
+    return None
+
+
+def backfill_reverse_index(db, dry_run=False):
+    """Criar os índices inversos para as subscrições que já existiam -> nº de subscrições"""
+    count = 0
+    batch = db.batch()
+    pending = 0
+    for doc in db.collection('subscriptions').stream():
+        data = doc.to_dict()
+        subscription_id, customer_id = data.get('subscriptionId'), data.get('customerId')
+        if not subscription_id and not customer_id:
+            continue
+        count += 1
+        if dry_run:
+            continue
+        write_reverse_index(batch, db, doc.id, subscription_id, customer_id)
+        pending += 2
+        # Um batch aceita até 500 escritas
+        if pending >= 400:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return count
+
+
+def normalize_event(event):
+    """Campos do evento necessários para o aplicar (sem guardar o payload inteiro)"""
+    obj = event['data']['object']
+    data = {
+        'type': event['type'],
+        'created': int(event['created']),
+        'rank': EVENT_RANKS.get(event['type'], 0)
+    }
+    if event['type'] == 'checkout.session.completed':
+        metadata = obj.get('metadata') or {}
+        data.update({
+            'userId': obj.get('client_reference_id') or metadata.get('user_id'),
+            'subscriptionId': obj.get('subscription'),
+            'customerId': obj.get('customer'),
+            'planId': metadata.get('plan_id', 'monthly')
+        })
+    elif event['type'] in EVENT_RANKS:
+        data.update({
+            'subscriptionId': obj.get('id'),
+            'customerId': obj.get('customer'),
+            'stripeStatus': obj.get('status')
+        })
+    return data
+
+
+def _subscription_fields(event, current):
+    """Campos a escrever em `subscriptions/{userId}` para o evento"""
+    if event['type'] == 'checkout.session.completed':
+        fields = {
+            'subscriptionId': event.get('subscriptionId'),
+            'customerId': event.get('customerId'),
+            'status': 'active',
+            'planId': event.get('planId', 'monthly')
+        }
+        if current.get('subscriptionId') != event.get('subscriptionId'):
+            fields['createdAt'] = firestore.SERVER_TIMESTAMP
+    elif event['type'] == 'customer.subscription.updated':
+        fields = {'status': 'active' if event.get('stripeStatus') == 'active' else 'inactive'}
+    else:
+        fields = {'status': 'cancelled'}
+    fields['updatedAt'] = firestore.SERVER_TIMESTAMP
+    return fields
+
+
+@firestore.transactional
+def _apply_in_transaction(transaction, db, event_ref, user_id):
+    """Aplicar o evento à subscrição -> 'applied', 'stale' ou None (já tratado)"""
+    event_snapshot = event_ref.get(transaction=transaction)
+    event = event_snapshot.to_dict() or {}
+    if event.get('status') != PENDING:
+        return None
+    sub_ref = db.collection('subscriptions').document(user_id)
+    snapshot = sub_ref.get(transaction=transaction)
+    current = snapshot.to_dict() if snapshot.exists else {}
+
+    last_key = (current.get('lastEventCreated', 0), current.get('lastEventRank', -1))
+    is_older = (event['created'], event['rank']) < last_key
+    # Eventos de uma subscrição antiga não mexem na subscrição atual do utilizador
+    other_subscription = event['type'] != 'checkout.session.completed' \
+        and current.get('subscriptionId') not in (None, event.get('subscriptionId'))
+    if event['type'] == 'checkout.session.completed':
+        # O índice é escrito mesmo que o evento seja antigo (a subscrição é deste utilizador)
+        write_reverse_index(transaction, db, user_id, event.get('subscriptionId'), event.get('customerId'))
+    if is_older or other_subscription:
+        transaction.update(event_ref, {'status': STALE, 'userId': user_id, 'processedAt': utc_now()})
+        return STALE
+
+    fields = _subscription_fields(event, current)
+    fields.update({
+        'lastEventId': event_ref.id,
+        'lastEventCreated': event['created'],
+        'lastEventRank': event['rank']
+    })
+    transaction.set(sub_ref, fields, merge=True)
+    transaction.update(event_ref, {'status': PROCESSED, 'userId': user_id, 'processedAt': utc_now()})
+    return 'applied'
+
+
+class StripeEventQueue:
+    def __init__(self):
+        self._db = None
+        self._pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.received = 0
+        self.duplicates = 0
+        self.applied = 0
+        self.stale = 0
+        self.deferred = 0
+        self.failures = 0
+
+    def attach(self, db):
+        self._db = db
+        self._ensure_started()
+
+    def enqueue(self, event):
+        """Gravar o evento (idempotente pelo id) e acordar o processador.
+
+        Devolve False se o evento já tinha sido recebido.
+        """
+        data = normalize_event(event)
+        handled = event['type'] in EVENT_RANKS
+        now = utc_now()
+        data.update({
+            'status': PENDING if handled else IGNORED,
+            'attempts': 0,
+            'nextAttemptAt': now,
+            'receivedAt': now
+        })
+        try:
+            self._db.collection(EVENTS_COLLECTION).document(event['id']).create(data)
+        except AlreadyExists:
+            self.duplicates += 1
+            return False
+        self.received += 1
+        if handled:
+            self.wake()
+        return True
+
+    def wake(self):
+        self._ensure_started()
+        self._wake.set()
+
+    # ---------- Processamento ----------
+
+    def _ensure_started(self):
+        # Thread por processo (fork-safe)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._wake = threading.Event()
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='stripe-events', daemon=True).start()
+
+    def _run(self):
+        while self._pid == os.getpid():
+            self._wake.wait(POLL_INTERVAL_SECONDS)
+            self._wake.clear()
+            try:
+                self.drain()
+            except Exception as e:
+                log.warning("Erro ao processar eventos do Stripe: %s", e)
+
+    def drain(self):
+        """Processar os eventos pendentes que já estão prontos, por ordem de `created`"""
+        if not self._db:
+            return
+        now = utc_now()
+        docs = self._db.collection(EVENTS_COLLECTION)\
+            .where(filter=firestore.FieldFilter('status', '==', PENDING))\
+            .where(filter=firestore.FieldFilter('nextAttemptAt', '<=', now))\
+            .order_by('nextAttemptAt')\
+            .limit(BATCH_LIMIT)\
+            .stream()
+        claimed = [doc for doc in docs if claim(self._db, doc, now, CLAIM_SECONDS)]
+        claimed.sort(key=lambda doc: (doc.to_dict()['created'], doc.to_dict()['rank']))
+        for doc in claimed:
+            self._process(doc)
+
+    def _process(self, doc):
+        event = doc.to_dict()
+        try:
+            user_id = event.get('userId') or find_user(self._db, event.get('subscriptionId'), event.get('customerId'))
+            if not user_id:
+                # O checkout desta subscrição ainda não foi processado
+                self.deferred += 1
+                self._retry(doc, event, "Subscrição ainda sem utilizador", SKIPPED)
+                return
+            outcome = _apply_in_transaction(self._db.transaction(), self._db, doc.reference, user_id)
+        except Exception as e:
+            self.failures += 1
+            log.error("Erro ao aplicar evento Stripe %s: %s", doc.id, e)
+            self._retry(doc, event, e, FAILED)
+            return
+
+        if outcome == STALE:
+            self.stale += 1
+            log.info("Evento Stripe %s (%s) ignorado: mais antigo do que o estado atual", doc.id, event['type'])
+            return
+        if outcome is None:
+            return
+        self.applied += 1
+        invalidate_entitlement(self._db, user_id)
+        if event['type'] == 'checkout.session.completed':
+            rollups.record_checkout('completed')
+            rollups.record_subscription_change('created')
+            log.info("Subscrição criada para user: %s", user_id)
+        elif event['type'] == 'customer.subscription.updated':
+            rollups.record_subscription_change('updated')
+            log.info("Subscrição atualizada: %s -> %s", event.get('subscriptionId'), event.get('stripeStatus'))
+        else:
+            rollups.record_subscription_change('cancelled')
+            log.info("Subscrição cancelada: %s", event.get('subscriptionId'))
+
+    def _retry(self, doc, event, error, final_status):
+        attempts = event.get('attempts', 0) + 1
+        fields = {'attempts': attempts, 'lastError': str(error)}
+        if attempts >= MAX_ATTEMPTS:
+            fields['status'] = final_status
+            log.warning("Evento Stripe %s (%s) desistido: %s", doc.id, event['type'], error)
+        else:
+            backoff = min(5 * (2 ** (attempts - 1)), MAX_BACKOFF_SECONDS)
+            fields['nextAttemptAt'] = utc_now() + timedelta(seconds=backoff)
+        doc.reference.update(fields)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'applied': self.applied,
+            'stale': self.stale,
+            'deferred': self.deferred,
+            'failures': self.failures,
+            'running': self._pid == os.getpid()
+        }
+
+
+stripe_events = StripeEventQueue()